@@ -17,7 +17,6 @@
           aiohttp
           aiosqlite
           beautifulsoup4
-          feedparser
           ipython
           mypy
           pandas
@@ -28,6 +27,7 @@
           pytest
           pytest-asyncio
           pytest-bdd
+          pytest-benchmark
           pyxdg
           requests
           sqlalchemy
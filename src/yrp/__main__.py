@@ -0,0 +1,6 @@
+import sys
+
+from yrp.cli import main
+
+
+sys.exit(main())
@@ -1,28 +1,39 @@
 import asyncio
-import aiofiles
-from collections.abc import Callable, Sequence
-from dataclasses import InitVar, dataclass, field
+from collections.abc import Callable, Collection, Container, Sequence
 from datetime import datetime
-from time import mktime, struct_time
 from pathlib import Path
-from typing import Any, TypedDict, Iterable, Optional
+from threading import Lock
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+from weakref import WeakValueDictionary
+import hashlib
 import re
 import logging
 
-from aiohttp.client import ClientSession
 import yrp.config as config
 
-import feedparser
-from sqlalchemy import delete, select, update, insert
+from sqlalchemy import Select, delete, exists, select, update, insert
+from sqlalchemy.orm import joinedload
 
 from yrp import db as db
-from yrp.download import download_video
+from yrp.download import download_video, get_thumbnail_url, info_cache
+from yrp.feed import (
+    Feed, FeedParser, FeedValidators, ParsedFeed, VideoEntry
+)
+from yrp.ingest import (
+    FeedUpdate, FeedUpdateQueue, ingest_feed_updates, write_feed_updates
+)
+from yrp.metrics import metrics
 from yrp.observer import Observable, Observable
-import aiohttp
+from yrp.thumbnails import thumbnail_cache
 
-import gi
-gi.require_version("Notify", "0.7")
-from gi.repository import GLib, Notify
+# The HTTP client and gi are only imported once feeds are refreshed or a
+# notification is shown, to keep them out of the startup of the window
+if TYPE_CHECKING:
+    from aiohttp import ClientResponse, ClientSession
+    from yrp.config_watcher import ConfigDelta
+    from gi.repository import Notify
+    from yrp.scheduler import Scheduler
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +43,11 @@ VIDEO_ATTRIBUTES = [
     "published",
 ]
 VIDEO_FORMAT = "mkv"
-THUMBNAIL_FORMAT = "jpg"
+FEED_CHUNK_SIZE = 4096
+# Keeps the number of bound parameters of bulk statements under the limit
+# of SQLite
+BULK_CHUNK_SIZE = 500
+THUMBNAIL_CHUNK_SIZE = 16384
 FEED_PREFIX = "https://www.youtube.com/feeds/videos.xml?channel_id="
 channel_id_regex = re.compile(re.escape(FEED_PREFIX) + r"([\w-]{24})")
 FEEDS = [
@@ -41,52 +56,93 @@ FEEDS = [
 ]
 
 
-def get_thumbnail_path(id: str) -> Path:
-    return config.thumbnail_dir.absolute() / f"{id}.{THUMBNAIL_FORMAT}"
+def get_thumbnail_path(id: str) -> Optional[Path]:
+    return thumbnail_cache.get(id)
 
 
 def get_video_path(id: str) -> Path:
     return config.video_dir.absolute() / f"{id}.{VIDEO_FORMAT}"
 
 
-def update_channels(channel_ids: set[str]) -> None:
+def add_channels(channel_ids: Collection[str]) -> None:
+    if not channel_ids:
+        return
+    values = [dict(id=channel_id) for channel_id in channel_ids]
     with db.Session.begin() as session:
-        query_result = session.scalars(select(db.Channel.id))
-        existing_channel_ids = set(query_result)
-        unused_channel_ids = existing_channel_ids - channel_ids
-        if unused_channel_ids:
-            session.execute(
-                delete(db.Channel)
-                .where(db.Channel.id.in_(unused_channel_ids))
-            )
-            # db.Videos must be deleted explicitly because we are deleting in bulk
-            # using Core instead of using the cascade properties of ORM
-            session.execute(
-                delete(db.Video)
-                .where(db.Video.channel_id.in_(unused_channel_ids))
-            )
-        new_channel_ids = channel_ids - existing_channel_ids
-        if new_channel_ids:
-            values = [
-                dict(id=channel_id)
-                for channel_id in new_channel_ids
-            ]
-            session.execute(insert(db.Channel), values)
-
+        session.execute(insert(db.Channel).prefix_with("OR IGNORE"), values)
 
-class Feed(TypedDict):
-    title: str
 
-
-class VideoEntry(TypedDict):
-    yt_videoid: str
-    title: str
-    published_parsed: struct_time
+def remove_channels(channel_ids: Collection[str]) -> None:
+    if not channel_ids:
+        return
+    with db.Session.begin() as session:
+        session.execute(
+            delete(db.Channel)
+            .where(db.Channel.id.in_(channel_ids))
+        )
+        # db.Videos must be deleted explicitly because we are deleting in bulk
+        # using Core instead of using the cascade properties of ORM
+        deleted_video_ids = session.scalars(
+            delete(db.Video)
+            .where(db.Video.channel_id.in_(channel_ids))
+            .returning(db.Video.id)
+        ).all()
+        for i in range(0, len(deleted_video_ids), BULK_CHUNK_SIZE):
+            session.execute(
+                delete(db.DownloadJob)
+                .where(
+                    db.DownloadJob.video_id.in_(
+                        deleted_video_ids[i:i+BULK_CHUNK_SIZE]
+                    )
+                )
+            )
+        session.execute(
+            delete(db.FeedCache)
+            .where(db.FeedCache.channel_id.in_(channel_ids))
+        )
+    for video_id in deleted_video_ids:
+        video_map.invalidate(video_id)
 
 
-class ParsedFeed(TypedDict):
-    feed: Feed
-    entries: list[VideoEntry]
+def update_channels(channel_ids: set[str]) -> None:
+    with db.Session() as session:
+        existing_channel_ids = set(session.scalars(select(db.Channel.id)))
+    remove_channels(existing_channel_ids - channel_ids)
+    add_channels(channel_ids - existing_channel_ids)
+
+
+def refilter_videos(channel_ids: Collection[str]) -> list[str]:
+    """Delete the videos of channel_ids that their filters now reject
+
+    Descriptions are not stored, so only the title filters are applied.
+    Returns the ids of the deleted videos.
+    """
+    channel_filters = {
+        channel_id: [
+            channel_filter
+            for channel_filter in (
+                config.global_filter,
+                config.channel_filters.get(channel_id),
+            )
+            if channel_filter is not None
+        ]
+        for channel_id in channel_ids
+    }
+    with db.Session() as session:
+        videos = session.execute(
+            select(db.Video.id, db.Video.channel_id, db.Video.title)
+            .where(db.Video.channel_id.in_(channel_ids))
+        ).all()
+    rejected_video_ids = [
+        video_id
+        for video_id, channel_id, title in videos
+        if not all(
+            channel_filter.match(title)
+            for channel_filter in channel_filters[channel_id]
+        )
+    ]
+    delete_videos(rejected_video_ids)
+    return rejected_video_ids
 
 
 def extract_channel_id(feed: str) -> str:
@@ -97,137 +153,420 @@ def extract_channel_id(feed: str) -> str:
         return match.group(1)
 
 
-def make_video_row(entry: VideoEntry, channel_id: str) -> db.Video:
-    timestamp = mktime(entry["published_parsed"])
-    return db.Video(
-        id=entry["yt_videoid"],
-        channel_id=channel_id,
-        title=entry["title"],
-        publication_dt=datetime.fromtimestamp(timestamp),
-    )
+def get_conditional_headers(validators: FeedValidators) -> dict[str, str]:
+    headers = {}
+    if validators["etag"] is not None:
+        headers["If-None-Match"] = validators["etag"]
+    if validators["last_modified"] is not None:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
 
 
-async def upload_feed_data(channel_id: str, parsed_feed: ParsedFeed) -> None:
-    async with db.AsyncSession.begin() as sa_session:
-        channel = await sa_session.get_one(db.Channel, channel_id)
-        channel.title = parsed_feed['feed']['title']
-        channel.last_updated = datetime.now()
-        sa_session.add(channel)
-        query = select(db.Video.id).filter_by(channel_id=channel_id)
-        existing_video_ids = set(await sa_session.scalars(query))
-        channel_filter = config.channel_filters.get(channel_id)
-        for entry in parsed_feed['entries']:
-            video_id = entry["yt_videoid"]
-            if video_id not in existing_video_ids:
-                continue
-            if channel_filter is not None and not channel_filter.filter(entry):
-                continue
-            video = make_video_row(entry, channel_id)
-            sa_session.add(video)
+async def upload_feed_data(
+    channel_id: str,
+    parsed_feed: ParsedFeed,
+    validators: Optional[FeedValidators] = None,
+) -> None:
+    feed_update = FeedUpdate(
+        channel_id=channel_id,
+        title=parsed_feed['feed']['title'],
+        entries=parsed_feed['entries'],
+        validators=validators,
+    )
+    await write_feed_updates([feed_update])
+
+
+async def read_new_entries(
+    resp: "ClientResponse",
+    channel_id: str,
+    known_video_ids: Container[str],
+) -> tuple[ParsedFeed, str]:
+    """Parse the feed entries that are newer than the first known video
+
+    Youtube feeds are sorted from newest to oldest so parsing stops once a
+    video that is already in the database is found. The rest of the body is
+    still read, for the SHA-256 of the whole body returned along with the
+    feed and so that the connection can be reused. Feeds are small enough
+    that reading them costs less than a new connection. The time spent
+    parsing, without waiting for the network, is recorded as the
+    feed_parse stage.
+    """
+    parser: Optional[FeedParser] = FeedParser()
+    title = None
+    entries: list[VideoEntry] = []
+    content_hash = hashlib.sha256()
+    byte_count = 0
+    parse_seconds = 0.0
+    async for chunk in resp.content.iter_chunked(FEED_CHUNK_SIZE):
+        byte_count += len(chunk)
+        content_hash.update(chunk)
+        if parser is None:
+            continue
+        start = perf_counter()
+        for entry in parser.feed(chunk):
+            if entry["yt_videoid"] in known_video_ids:
+                title = parser.title
+                parser = None
+                break
+            entries.append(entry)
+        parse_seconds += perf_counter() - start
+    if parser is not None:
+        parser.close()
+        title = parser.title
+    metrics.add_bytes("feed", byte_count)
+    metrics.observe("feed_parse", parse_seconds, channel_id=channel_id)
+    if title is None:
+        raise ValueError(f"Feed at {resp.url} does not have a title")
+    parsed_feed = ParsedFeed(feed=Feed(title=title), entries=entries)
+    return parsed_feed, content_hash.hexdigest()
 
 
 async def fetch_feed(
-    http_session: aiohttp.ClientSession,
-    channel_id: str
-) -> None:
+    http_session: "ClientSession",
+    channel_id: str,
+    known_video_ids: Container[str] = frozenset(),
+    validators: Optional[FeedValidators] = None,
+    scheduler: Optional["Scheduler"] = None,
+) -> FeedUpdate | None:
+    from yrp.scheduler import Scheduler
+
+    if scheduler is None:
+        scheduler = Scheduler(config.scheduler_config)
     feed_url = FEED_PREFIX + channel_id
-    async with http_session.get(feed_url) as resp:
+    headers = {}
+    if validators is not None:
+        headers = get_conditional_headers(validators)
+    request = scheduler.request(
+        http_session,
+        "GET",
+        feed_url,
+        stage="feed_request",
+        attributes=dict(channel_id=channel_id),
+        headers=headers,
+    )
+    start = perf_counter()
+    async with request as resp:
+        if resp.status == 304:
+            logger.debug(f"Feed of channel {channel_id} not modified")
+            return FeedUpdate(channel_id=channel_id)
         if resp.status != 200:
-            return
-        text = await resp.text()
-    parsed_feed = feedparser.parse(text)
-    await upload_feed_data(channel_id, parsed_feed)
+            return None
+        parsed_feed, content_hash = await read_new_entries(
+            resp,
+            channel_id,
+            known_video_ids,
+        )
+        new_validators = FeedValidators(
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+            content_hash=content_hash,
+        )
+    logger.debug(
+        f"Read {len(parsed_feed['entries'])} new entries of channel"
+        f" {channel_id} in {perf_counter() - start:.3f}s"
+    )
+    if validators is not None and (
+        not parsed_feed["entries"]
+        or validators["content_hash"] == content_hash
+    ):
+        # An identical body has nothing to write, even when its entries are
+        # not known because filters rejected them
+        logger.debug(f"No new videos in feed of channel {channel_id}")
+        if validators == new_validators:
+            return FeedUpdate(channel_id=channel_id)
+        # Remember the new validators so that the next request can be
+        # answered with a 304
+        return FeedUpdate(channel_id=channel_id, validators=new_validators)
+    return FeedUpdate(
+        channel_id=channel_id,
+        title=parsed_feed["feed"]["title"],
+        entries=parsed_feed["entries"],
+        validators=new_validators,
+    )
+
+
+async def fetch_feed_into_queue(
+    queue: FeedUpdateQueue,
+    http_session: "ClientSession",
+    channel_id: str,
+    known_video_ids: Container[str] = frozenset(),
+    validators: Optional[FeedValidators] = None,
+    scheduler: Optional["Scheduler"] = None,
+) -> None:
+    feed_update = await fetch_feed(
+        http_session,
+        channel_id,
+        known_video_ids,
+        validators,
+        scheduler,
+    )
+    if feed_update is not None:
+        await queue.put(feed_update)
+
+
+def query_feed_validators() -> dict[str, FeedValidators]:
+    with db.Session() as session:
+        feed_caches = session.scalars(select(db.FeedCache))
+        return {
+            feed_cache.channel_id: FeedValidators(
+                etag=feed_cache.etag,
+                last_modified=feed_cache.last_modified,
+                content_hash=feed_cache.content_hash,
+            )
+            for feed_cache in feed_caches
+        }
 
 
 async def download_thumbnail(
-    http_session: ClientSession,
+    http_session: "ClientSession",
     video_id: str,
     callback: Optional[Callable[[str], None]],
+    scheduler: Optional["Scheduler"] = None,
 ) -> None:
-    thumbnail_path = get_thumbnail_path(video_id)
-    if not thumbnail_path.is_file():
-        url = f"http://img.youtube.com/vi/{video_id}/mqdefault.jpg"
-        async with aiohttp.ClientSession() as http_session:
-            async with http_session.get(url) as resp:
+    import aiofiles
+    from yrp.scheduler import Scheduler
+
+    if scheduler is None:
+        scheduler = Scheduler(config.scheduler_config)
+    url = get_thumbnail_url(video_id=video_id)
+    # Partial downloads are written to a hidden file and only moved into the
+    # cache once complete so that a thumbnail is never seen half-written
+    tmp_path = thumbnail_cache.get_tmp_path(video_id)
+    file_hash = hashlib.sha256()
+    byte_count = 0
+    # The video is shown whether or not its thumbnail could be downloaded,
+    # cards without one show a placeholder
+    try:
+        with metrics.span("thumbnail", video_id=video_id):
+            async with scheduler.request(http_session, "GET", url) as resp:
                 if resp.status != 200:
                     return
-                async with aiofiles.open(thumbnail_path, mode='wb') as f:
-                    await f.write(await resp.read())
-    if callback is not None:
-        await asyncio.to_thread(callback, video_id)
+                chunks = resp.content.iter_chunked(THUMBNAIL_CHUNK_SIZE)
+                try:
+                    async with aiofiles.open(tmp_path, mode='wb') as f:
+                        async for chunk in chunks:
+                            byte_count += len(chunk)
+                            file_hash.update(chunk)
+                            await f.write(chunk)
+                    thumbnail_path = await asyncio.to_thread(
+                        thumbnail_cache.add,
+                        video_id,
+                        tmp_path,
+                        file_hash.hexdigest(),
+                    )
+                    video_map.apply(
+                        video_id,
+                        dict(thumbnail_path=thumbnail_path),
+                    )
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+                    metrics.add_bytes("thumbnail", byte_count)
+    finally:
+        if callback is not None:
+            await asyncio.to_thread(callback, video_id)
 
 
 async def fetch_feeds(
     callback: Optional[Callable[[str], None]] = None,
+    channel_ids: Optional[Collection[str]] = None,
+    refetch_channel_ids: Collection[str] = (),
 ) -> None:
+    """Fetch the feeds of the channels and the thumbnails of new videos
+
+    Every channel in the database is fetched unless channel_ids is given.
+    The feeds of refetch_channel_ids are read entirely, even when they were
+    not modified, so that entries a filter used to reject are added.
+    callback is called with the id of every video published within
+    config.no_older_than that was added by this refresh, as soon as the
+    download of its thumbnail is over, even if it failed.
+    """
+    from yrp.http_client import create_http_session, pool_stats
+    from yrp.scheduler import Scheduler
+
+    start = perf_counter()
     with db.Session() as session:
-        channel_ids = set(session.scalars(select(db.Channel.id)))
-    async with aiohttp.ClientSession() as http_session:
-        async with asyncio.TaskGroup() as tg:
-            for channel_id in channel_ids:
-                tg.create_task(fetch_feed(http_session, channel_id))
+        if channel_ids is None:
+            channel_ids = set(session.scalars(select(db.Channel.id)))
+        known_video_ids = frozenset(session.scalars(select(db.Video.id)))
+    feed_validators = query_feed_validators()
+    queue: FeedUpdateQueue = asyncio.Queue()
+    scheduler = Scheduler(config.scheduler_config)
+    cutoff_dt = datetime.now() - config.no_older_than
+    scheduled_thumbnails: set[str] = set()
+    async with (
+        create_http_session() as http_session,
+        asyncio.TaskGroup() as thumbnail_tg,
+    ):
+        def schedule_thumbnail(
+            video_id: str,
+            on_downloaded: Optional[Callable[[str], None]],
+        ) -> None:
+            scheduled_thumbnails.add(video_id)
+            cr = download_thumbnail(
+                http_session,
+                video_id,
+                on_downloaded,
+                scheduler,
+            )
+            name = f"Downloading thumbnail of video {video_id}"
+            thumbnail_tg.create_task(scheduler.isolate(name, cr))
+
+        def on_ingested(new_videos: dict[str, datetime]) -> None:
+            # Thumbnails are downloaded while other feeds are still being
+            # fetched so that new videos can be shown straight away
+            for video_id, publication_dt in new_videos.items():
+                if publication_dt > cutoff_dt:
+                    schedule_thumbnail(video_id, callback)
+
+        ingestion = asyncio.create_task(
+            ingest_feed_updates(queue, on_ingested)
+        )
+        # The feeds fetched before a failure or a cancellation are still
+        # written, and ingestion is never left pending
+        try:
+            async with asyncio.TaskGroup() as tg:
+                for channel_id in channel_ids:
+                    if channel_id in refetch_channel_ids:
+                        cr = fetch_feed_into_queue(
+                            queue,
+                            http_session,
+                            channel_id,
+                            scheduler=scheduler,
+                        )
+                    else:
+                        cr = fetch_feed_into_queue(
+                            queue,
+                            http_session,
+                            channel_id,
+                            known_video_ids,
+                            feed_validators.get(channel_id),
+                            scheduler,
+                        )
+                    name = f"Fetching feed of channel {channel_id}"
+                    tg.create_task(scheduler.isolate(name, cr))
+        finally:
+            await queue.put(None)
+            await ingestion
+        # Retry thumbnails that could not be downloaded by earlier refreshes
         with db.Session() as session:
-            cutoff_dt = datetime.now() - config.no_older_than
-            video_ids = set(session.scalars(
+            missing_thumbnail_ids = session.scalars(
                 select(db.Video.id)
                 .where(db.Video.publication_dt > cutoff_dt)
-            ))
-        async with asyncio.TaskGroup() as tg:
-            for video_id in video_ids:
-                cr = download_thumbnail(http_session, video_id, callback)
-                tg.create_task(cr)
-
-
-# def main() -> None:
-#     update_channels(config.channel_ids)
-#     asyncio.run(fetch_feeds())
-#
-#
-# class NewVideoEvent(Observable):
-#     def run(self) -> None:
-#         update_channels(config.channel_ids)
-#         def new_video_callback(video_id: str) -> None:
-#             self.notify_observers(video_id)
-#         asyncio.run(fetch_feeds(new_video_callback))
+                .where(~exists().where(db.Thumbnail.video_id == db.Video.id))
+            ).all()
+        for video_id in missing_thumbnail_ids:
+            if video_id not in scheduled_thumbnails:
+                schedule_thumbnail(video_id, None)
+    await asyncio.to_thread(thumbnail_cache.evict)
+    if scheduler.failures:
+        logger.warning(f"{len(scheduler.failures)} refresh tasks failed")
+    logger.info(f"HTTP connection pool: {pool_stats}")
+    metrics.observe(
+        "refresh",
+        perf_counter() - start,
+        channels=len(channel_ids),
+    )
+    await asyncio.to_thread(metrics.export)
 
 
-def query_video_ids(**kwargs: Any) -> Sequence[str]:
+async def apply_config_delta(
+    delta: "ConfigDelta",
+    callback: Optional[Callable[[str], None]] = None,
+) -> list[str]:
+    """Bring the channels up to date with a reloaded config
+
+    Only the channels in delta are written or fetched, callback is passed
+    on to fetch_feeds. Returns the ids of the videos deleted because their
+    channel filter now rejects them.
+    """
+    remove_channels(delta.removed_channel_ids)
+    add_channels(delta.added_channel_ids)
+    deleted_video_ids = refilter_videos(delta.refiltered_channel_ids)
+    channel_ids = delta.added_channel_ids | delta.refiltered_channel_ids
+    if channel_ids:
+        await fetch_feeds(callback, channel_ids, delta.refiltered_channel_ids)
+    return deleted_video_ids
+
+
+class NewVideoEvent(Observable):
+    """Refresh the feeds notifying observers of every new video id"""
+
+    def run(self) -> None:
+        update_channels(config.channel_ids)
+        asyncio.run(fetch_feeds(self.notify_observers))
+
+
+def select_video_ids(**kwargs: Any) -> Select[tuple[str]]:
     cutoff_dt = datetime.now() - config.no_older_than
+    return (
+        select(db.Video.id)
+        .where(db.Video.publication_dt > cutoff_dt)
+        .filter_by(**kwargs)
+    )
+
+
+def query_video_ids(**kwargs: Any) -> Sequence[str]:
     with db.Session() as session:
         query_result = session.scalars(
-            select(db.Video.id)
+            select_video_ids(**kwargs)
             .order_by(db.Video.publication_dt.desc())
-            .where(db.Video.publication_dt > cutoff_dt)
-            .filter_by(**kwargs)
         )
         return tuple(query_result)
 
 
 def clean_assets() -> None:
     """Delete videos and thumbnails from videos that either don't exist in the database or have been watched"""
-    video_ids = tuple(query_video_ids(watched=False))
+    video_ids = frozenset(query_video_ids(watched=False))
     for video_path in config.video_dir.iterdir():
-        if video_path.suffix != VIDEO_FORMAT:
-            video_path.unlink()
-        if video_path.stem not in video_ids:
+        # Also matches the partial files of downloads in progress
+        video_id = video_path.name.partition(".")[0]
+        if video_id not in video_ids:
             video_path.unlink()
-    for thumbnail_path in config.thumbnail_dir.iterdir():
-        if thumbnail_path.suffix != THUMBNAIL_FORMAT:
-            thumbnail_path.unlink()
-        if thumbnail_path.stem not in video_ids:
-            thumbnail_path.unlink()
+    thumbnail_cache.adopt_loose_files()
+    thumbnail_cache.retain(select_video_ids(watched=False))
+    thumbnail_cache.evict()
+    info_cache.evict()
 
 
 def update_fields(id: str, **kwargs: Any) -> None:
+    update_videos([id], **kwargs)
+
+
+def update_videos(ids: Sequence[str], **kwargs: Any) -> None:
+    """Set the same values on every video of ids in one transaction"""
     with db.Session.begin() as session:
-        session.execute(
+        for i in range(0, len(ids), BULK_CHUNK_SIZE):
+            session.execute(
+                update(db.Video)
+                .where(db.Video.id.in_(ids[i:i+BULK_CHUNK_SIZE]))
+                .values(**kwargs)
+            )
+    for id in ids:
+        video_map.apply(id, kwargs)
+
+
+def start_downloading(id: str) -> bool:
+    """Set the downloading flag of video id unless it is already set
+
+    Returns whether this call set it. The check and the write are a single
+    statement, so only one of several processes or threads gets True.
+    """
+    with db.Session.begin() as session:
+        started = session.execute(
             update(db.Video)
-            .filter_by(id=id)
-            .values(**kwargs)
-        )
+            .where(db.Video.id == id, db.Video.downloading.is_not(True))
+            .values(downloading=True)
+        ).rowcount
+    if started:
+        video_map.apply(id, dict(downloading=True))
+    return bool(started)
+
 
+def create_notification(id: str) -> "Notify.Notification":
+    import gi
+    gi.require_version("Notify", "0.7")
+    from gi.repository import GLib, Notify
 
-def create_notification(id: str) -> Notify.Notification:
     Notify.init()
     with db.Session() as session:
         title = session.scalar(select(db.Video.title).filter_by(id=id))
@@ -239,8 +578,9 @@ def create_notification(id: str) -> Notify.Notification:
         )
     if channel_title is None:
         raise ValueError(f"db.Video with id {id} does not exist in the database")
-    thumbnail_path = str(get_thumbnail_path(id))
-    notification = Notify.Notification.new(channel_title, title, thumbnail_path)
+    thumbnail_path = get_thumbnail_path(id)
+    icon = None if thumbnail_path is None else str(thumbnail_path)
+    notification = Notify.Notification.new(channel_title, title, icon)
     notification.set_timeout(Notify.EXPIRES_NEVER)
     notification.set_app_name("yt-player")
     tag = GLib.Variant.new_string(id)
@@ -258,48 +598,105 @@ def download_video_with_notification(
     video_path = str(get_video_path(id))
     ytdlp_kwargs["merge_output_format"] = VIDEO_FORMAT
     ytdlp_kwargs["noprogress"] = VIDEO_FORMAT
-
-    download_video(
-        url=id,
-        path=video_path,
-        notification=notification,
-        **ytdlp_kwargs,
-    )
-    update_fields(id, downloading=False)
+    try:
+        download_video(
+            url=id,
+            path=video_path,
+            notification=notification,
+            **ytdlp_kwargs,
+        )
+    finally:
+        update_fields(id, downloading=False)
 
 
 def delete_video_assets(id: str) -> None:
-    video_path = get_video_path(id)
-    Path(video_path).unlink(missing_ok=True)
-    thumbnail_path = get_thumbnail_path(id)
-    Path(thumbnail_path).unlink(missing_ok=True)
+    delete_videos_assets([id])
+
+
+def delete_videos_assets(ids: Sequence[str]) -> None:
+    for id in ids:
+        get_video_path(id).unlink(missing_ok=True)
+    thumbnail_cache.discard_many(ids)
+    for id in ids:
+        video_map.apply(id, dict(thumbnail_path=None))
+
 
 def delete_video(id: str) -> None:
-    delete_video_assets(id)
+    delete_videos([id])
+
+
+def delete_videos(ids: Sequence[str]) -> None:
+    delete_videos_assets(ids)
     with db.Session.begin() as session:
-        with session.begin():
+        for i in range(0, len(ids), BULK_CHUNK_SIZE):
             session.execute(
                 delete(db.Video)
-                .filter_by(id=id)
+                .where(db.Video.id.in_(ids[i:i+BULK_CHUNK_SIZE]))
+            )
+            session.execute(
+                delete(db.DownloadJob)
+                .where(db.DownloadJob.video_id.in_(ids[i:i+BULK_CHUNK_SIZE]))
             )
+    for id in ids:
+        video_map.invalidate(id)
+
+
+def set_watched(ids: Sequence[str], watched: bool = True) -> None:
+    update_videos(ids, watched=watched)
+    if watched:
+        delete_videos_assets(ids)
+
 
-@dataclass
 class Video:
-    video: InitVar[db.Video]
-    id: str = field(init=False)
-    publication_dt: datetime = field(init=False)
-    title: str = field(init=False)
-    channel_id: str = field(init=False)
-    channel_title: str = field(init=False)
-
-    def __post_init__(self, video: db.Video) -> None:
-        self.path = get_video_path(video.id)
-        self.thumbnail_path = get_thumbnail_path(video.id)
+    """Snapshot of a video and its channel
+
+    Snapshots are shared through video_map, which keeps them up to date
+    with the writes made by update_fields, so reading them never queries
+    the database.
+    """
+
+    __slots__ = (
+        "id",
+        "path",
+        "publication_dt",
+        "title",
+        "channel_id",
+        "channel_title",
+        "_downloading",
+        "_watched",
+        "_thumbnail_path",
+        "__weakref__",
+    )
+
+    def __init__(
+        self,
+        video: db.Video,
+        thumbnail_path: Optional[Path] = None,
+    ) -> None:
         self.id = video.id
+        self.path = get_video_path(video.id)
+        self.refresh(video, thumbnail_path)
+
+    def refresh(
+        self,
+        video: db.Video,
+        thumbnail_path: Optional[Path] = None,
+    ) -> None:
         self.publication_dt = video.publication_dt
         self.title = video.title
         self.channel_id = video.channel.id
         self.channel_title = video.channel.title or "Missing channel title"
+        self._downloading = video.downloading
+        self._watched = video.watched
+        self._thumbnail_path = thumbnail_path
+
+    def apply(self, values: dict[str, Any]) -> None:
+        """Update the snapshot with values written to the database"""
+        for name, value in values.items():
+            if name in ("downloading", "watched", "thumbnail_path"):
+                setattr(self, f"_{name}", value)
+            elif name in ("publication_dt", "title"):
+                setattr(self, name, value)
 
     def download(self, **kwargs: Any) -> None:
         download_video_with_notification(self.id, **kwargs)
@@ -309,38 +706,24 @@ class Video:
         return Path(self.path).is_file()
 
     @property
-    def downloading(self) -> bool | None:
-        with db.Session() as session:
-            return session.scalar(
-                select(db.Video.downloading)
-                .filter_by(id=id)
-            )
+    def downloading(self) -> bool:
+        return self._downloading
 
     @property
-    def thumbnail_downloaded(self) -> bool:
-        return Path(self.thumbnail_path).is_file()
+    def thumbnail_path(self) -> Optional[Path]:
+        return self._thumbnail_path
 
-    # def download_thumbnail(self) -> None:
-    #     if not self.thumbnail_downloaded:
-    #         download_thumbnail(self.id, str(self.thumbnail_path))
+    @property
+    def thumbnail_downloaded(self) -> bool:
+        return self._thumbnail_path is not None
 
     @property
-    def watched(self) -> bool | None:
-        with db.Session() as session:
-            return session.scalar(
-                select(db.Video.watched)
-                .filter_by(id=id)
-            )
+    def watched(self) -> bool:
+        return self._watched
 
     @watched.setter
     def watched(self, value: bool) -> None:
-        with db.Session.begin() as session:
-            session.execute(
-                update(db.Video)
-                .filter_by(id=self.id)
-                .values(watched=value)
-            )
-        self.delete_assets()
+        set_watched([self.id], value)
 
     def delete_assets(self) -> None:
         delete_video_assets(self.id)
@@ -349,18 +732,86 @@ class Video:
         delete_video(self.id)
 
 
-def get_videos() -> Iterable[Video]:
-    cutoff_dt = datetime.now() - config.no_older_than
+class VideoMap:
+    """Identity map of the Video snapshots in use
+
+    Loading a video that already has a snapshot refreshes it in place, so
+    every holder sees the same state. Snapshots are dropped once nothing
+    refers to them anymore.
+    """
+
+    def __init__(self) -> None:
+        self._videos: WeakValueDictionary[str, Video] = WeakValueDictionary()
+        self._lock = Lock()
+
+    def load(
+        self,
+        video: db.Video,
+        thumbnail_digest: Optional[str] = None,
+    ) -> Video:
+        thumbnail_path = None
+        if thumbnail_digest is not None:
+            thumbnail_path = thumbnail_cache.get_blob_path(thumbnail_digest)
+            thumbnail_path = thumbnail_path.absolute()
+        with self._lock:
+            snapshot = self._videos.get(video.id)
+            if snapshot is None:
+                snapshot = Video(video, thumbnail_path)
+                self._videos[video.id] = snapshot
+            else:
+                snapshot.refresh(video, thumbnail_path)
+            return snapshot
+
+    def apply(self, id: str, values: dict[str, Any]) -> None:
+        with self._lock:
+            snapshot = self._videos.get(id)
+        if snapshot is not None:
+            snapshot.apply(values)
+
+    def invalidate(self, id: str) -> None:
+        with self._lock:
+            self._videos.pop(id, None)
+
+
+video_map = VideoMap()
+
+
+def get_videos(
+    watched: Optional[bool] = False,
+    since: Optional[datetime] = None,
+) -> Iterable[Video]:
+    """Videos published after since, newest first
+
+    since defaults to config.no_older_than ago. Watched and unwatched
+    videos are both returned when watched is None.
+    """
+    if since is None:
+        since = datetime.now() - config.no_older_than
+    query = (
+        select(db.Video, db.Thumbnail.digest)
+        .outerjoin(db.Thumbnail, db.Thumbnail.video_id == db.Video.id)
+        .options(joinedload(db.Video.channel))
+        .where(db.Video.publication_dt > since)
+        .order_by(db.Video.publication_dt.desc())
+    )
+    if watched is not None:
+        query = query.filter_by(watched=watched)
     with db.Session() as session:
-        videos = session.scalars(
-            select(db.Video)
-            .where(db.Video.publication_dt > cutoff_dt)
-            .order_by(db.Video.publication_dt.desc())
-            .filter_by(watched=False)
+        rows = session.execute(query)
+        return tuple(
+            video_map.load(video, thumbnail_digest)
+            for video, thumbnail_digest in rows
         )
-        return tuple(map(Video, videos))
 
 
 def create_video(id: str) -> Video:
     with db.Session() as session:
-        return Video(session.get_one(db.Video, id))
+        video = session.get_one(
+            db.Video,
+            id,
+            options=[joinedload(db.Video.channel)],
+        )
+        thumbnail_digest = session.scalar(
+            select(db.Thumbnail.digest).filter_by(video_id=id)
+        )
+        return video_map.load(video, thumbnail_digest)
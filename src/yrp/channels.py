@@ -0,0 +1,218 @@
+from collections.abc import Iterable
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+from urllib.parse import parse_qs, urlsplit
+from xml.etree import ElementTree
+import asyncio
+import csv
+import logging
+import re
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+import yrp.config as config
+from yrp import db as db
+
+if TYPE_CHECKING:
+    from aiohttp import ClientSession
+    from yrp.scheduler import Scheduler
+
+
+logger = logging.getLogger(__name__)
+
+YOUTUBE_URL = "https://www.youtube.com"
+YOUTUBE_HOSTS = {"youtube.com", "www.youtube.com", "m.youtube.com"}
+CHANNEL_PATH_REGEX = re.compile(r"/(@[^/]+|(?:c|user|channel)/[^/]+)")
+# The canonical link comes first in the page head, the channelId of the
+# page data is a fallback
+CHANNEL_ID_PATTERN = re.compile(
+    rb'<link rel="canonical" href="https://www\.youtube\.com/channel/'
+    rb'([\w-]{24})"'
+    rb'|"channelId":"([\w-]{24})"'
+)
+# Bytes kept from the end of a chunk so that matches split between two
+# chunks are found, longer than any match of CHANNEL_ID_PATTERN
+CHUNK_OVERLAP = 128
+PAGE_CHUNK_SIZE = 2**14
+
+
+def get_channel_path(reference: str) -> str:
+    """Path of the channel page of a handle or a channel URL
+
+    Handles are case insensitive, so they are lowercased to be looked up.
+    """
+    reference = reference.strip()
+    if reference.startswith("@"):
+        path = f"/{reference}"
+    else:
+        if "://" not in reference:
+            reference = f"https://{reference}"
+        url = urlsplit(reference)
+        if url.hostname not in YOUTUBE_HOSTS:
+            raise ValueError(f"{reference} is not a Youtube URL")
+        path = url.path
+    match = CHANNEL_PATH_REGEX.match(path)
+    if match is None:
+        raise ValueError(f"{reference} is not the URL of a channel")
+    path = match.group(1)
+    return f"/{path.lower() if path.startswith('@') else path}"
+
+
+def get_direct_channel_id(reference: str) -> Optional[str]:
+    """Channel id in reference, if it is a channel id or a channel URL"""
+    reference = reference.strip()
+    if config.channel_id_regex.fullmatch(reference) is not None:
+        return reference
+    try:
+        path = get_channel_path(reference)
+    except ValueError:
+        return None
+    channel_id = path.removeprefix("/channel/")
+    if channel_id == path:
+        return None
+    if config.channel_id_regex.fullmatch(channel_id) is None:
+        return None
+    return channel_id
+
+
+def query_channel_handles(paths: Iterable[str]) -> dict[str, str]:
+    with db.Session() as session:
+        return {
+            path: channel_id
+            for path, channel_id in session.execute(
+                select(db.ChannelHandle.path, db.ChannelHandle.channel_id)
+                .where(db.ChannelHandle.path.in_(paths))
+            )
+        }
+
+
+def save_channel_handles(channel_ids: dict[str, str]) -> None:
+    if not channel_ids:
+        return
+    query = insert(db.ChannelHandle)
+    query = query.on_conflict_do_update(
+        index_elements=[db.ChannelHandle.path],
+        set_=dict(channel_id=query.excluded.channel_id),
+    )
+    values = [
+        dict(path=path, channel_id=channel_id)
+        for path, channel_id in channel_ids.items()
+    ]
+    with db.Session.begin() as session:
+        session.execute(query, values)
+
+
+async def fetch_channel_id(
+    http_session: "ClientSession",
+    url: str,
+    scheduler: "Scheduler",
+) -> str:
+    """Channel id of the channel page at url
+
+    The page is scanned as it is downloaded, which stops at the first
+    match instead of parsing the whole document.
+    """
+    async with scheduler.request(http_session, "GET", url) as resp:
+        if resp.status != 200:
+            raise ValueError(f"Getting {url} failed with status {resp.status}")
+        tail = b""
+        async for chunk in resp.content.iter_chunked(PAGE_CHUNK_SIZE):
+            data = tail + chunk
+            match = CHANNEL_ID_PATTERN.search(data)
+            if match is not None:
+                return (match.group(1) or match.group(2)).decode()
+            tail = data[-CHUNK_OVERLAP:]
+    raise ValueError(f"Could not find a channelId in URL {url}")
+
+
+async def resolve_channels(
+    references: Iterable[str],
+    base_url: str = YOUTUBE_URL,
+) -> dict[str, str]:
+    """Channel ids of handles and channel URLs, keyed by reference
+
+    Channel ids and URLs containing one are answered straight away, as are
+    pages resolved before. The other pages are fetched concurrently and
+    remembered in the database. References that cannot be resolved are
+    logged and left out.
+    """
+    from yrp.http_client import create_http_session
+    from yrp.scheduler import Scheduler
+
+    channel_ids: dict[str, str] = {}
+    paths: dict[str, str] = {}
+    for reference in references:
+        channel_id = get_direct_channel_id(reference)
+        if channel_id is not None:
+            channel_ids[reference] = channel_id
+            continue
+        try:
+            paths[reference] = get_channel_path(reference)
+        except ValueError as e:
+            logger.warning(str(e))
+    resolved_paths = query_channel_handles(set(paths.values()))
+    missing_paths = set(paths.values()) - resolved_paths.keys()
+    if missing_paths:
+        logger.info(f"Resolving {len(missing_paths)} channels")
+        scheduler = Scheduler(config.scheduler_config)
+        async with (
+            create_http_session() as http_session,
+            asyncio.TaskGroup() as tg,
+        ):
+            tasks = {
+                path: tg.create_task(scheduler.isolate(
+                    f"Resolving channel {path}",
+                    fetch_channel_id(http_session, base_url + path, scheduler),
+                ))
+                for path in missing_paths
+            }
+        fetched_paths = {
+            path: task.result()
+            for path, task in tasks.items()
+            if task.result() is not None
+        }
+        save_channel_handles(fetched_paths)
+        resolved_paths |= fetched_paths
+    for reference, path in paths.items():
+        if path in resolved_paths:
+            channel_ids[reference] = resolved_paths[path]
+    return channel_ids
+
+
+def read_opml(path: Path) -> list[str]:
+    """Channels of an OPML export of subscriptions"""
+    references = []
+    for outline in ElementTree.parse(path).iter("outline"):
+        xml_url = outline.get("xmlUrl")
+        if xml_url is not None:
+            query = parse_qs(urlsplit(xml_url).query)
+            if "channel_id" in query:
+                references.append(query["channel_id"][0])
+                continue
+        html_url = outline.get("htmlUrl")
+        if html_url is not None:
+            references.append(html_url)
+    return references
+
+
+def read_takeout_csv(path: Path) -> list[str]:
+    """Channels of the subscriptions.csv of a Google Takeout export"""
+    with path.open(newline="", encoding="utf-8-sig") as file:
+        return [
+            row.get("Channel Id") or row["Channel Url"]
+            for row in csv.DictReader(file)
+        ]
+
+
+def read_subscriptions(path: Path) -> list[str]:
+    """Channels of an OPML or Takeout export, or of a list of references
+
+    Lists have one handle, channel URL or channel id per line.
+    """
+    if path.suffix in (".opml", ".xml"):
+        return read_opml(path)
+    if path.suffix == ".csv":
+        return read_takeout_csv(path)
+    with path.open() as file:
+        return [line.strip() for line in file if line.strip()]
@@ -0,0 +1,336 @@
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from threading import Thread
+from time import perf_counter
+from typing import Any, Optional
+import asyncio
+import json
+import logging
+import sys
+
+from sqlalchemy import func, select
+
+import yrp.config as config
+from yrp import db as db
+from yrp.backend import (
+    clean_assets, delete_videos, fetch_feeds, get_videos, set_watched,
+    update_channels
+)
+from yrp.channels import read_subscriptions, resolve_channels
+from yrp.download import close_youtube_dls
+from yrp.downloads import PRIORITY_USER, DownloadManager
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_video_ids(args: Namespace) -> list[str]:
+    """Video ids given as arguments, or one per line on stdin"""
+    if args.video_ids:
+        return args.video_ids
+    return [line.strip() for line in sys.stdin if line.strip()]
+
+
+def print_json(data: Any) -> None:
+    json.dump(data, sys.stdout, indent=2, default=str)
+    print()
+
+
+def refresh(args: Namespace) -> int:
+    update_channels(config.channel_ids)
+    new_video_ids: list[str] = []
+    start = perf_counter()
+    channel_ids = args.channel_ids or None
+    asyncio.run(fetch_feeds(new_video_ids.append, channel_ids))
+    seconds = perf_counter() - start
+    if args.json:
+        print_json(dict(new_videos=new_video_ids, seconds=seconds))
+    else:
+        for video_id in new_video_ids:
+            print(video_id)
+    logger.info(f"Refreshed in {seconds:.2f}s")
+    return 0
+
+
+def list_videos(args: Namespace) -> int:
+    watched = None if args.all else args.watched
+    since = datetime.now() - timedelta(days=args.days)
+    videos = [
+        dict(
+            id=video.id,
+            publication_dt=video.publication_dt.isoformat(),
+            channel_id=video.channel_id,
+            channel_title=video.channel_title,
+            title=video.title,
+            watched=video.watched,
+            downloaded=video.downloaded,
+        )
+        for video in get_videos(watched, since)
+    ]
+    if args.json:
+        print_json(videos)
+        return 0
+    for video in videos:
+        print("\t".join(
+            str(video[key])
+            for key in ("id", "publication_dt", "channel_title", "title")
+        ))
+    return 0
+
+
+def run_downloads(
+    download_manager: DownloadManager,
+    video_ids: Sequence[str],
+    jobs: int,
+) -> list[str]:
+    """Download video_ids, then everything else that is queued
+
+    jobs threads take jobs from the queue until it is empty. Returns the
+    video ids that could not be downloaded, including the ones whose jobs
+    wait for another attempt.
+    """
+    download_manager.recover()
+    download_manager.enqueue_many(video_ids, PRIORITY_USER)
+
+    def work() -> None:
+        while download_manager.run_next():
+            pass
+
+    threads = [Thread(target=work) for _ in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    close_youtube_dls()
+    # Finished jobs are deleted, any job left failed for now
+    return list(download_manager.get_job_states(video_ids))
+
+
+def download(args: Namespace) -> int:
+    video_ids = read_video_ids(args) if args.video_ids or args.stdin else []
+    download_config = config.download_config.model_copy(
+        update=dict(workers=args.jobs)
+    )
+    failed_video_ids = run_downloads(
+        DownloadManager(download_config), video_ids, args.jobs
+    )
+    for video_id in failed_video_ids:
+        print(f"Could not download {video_id}", file=sys.stderr)
+    return 1 if failed_video_ids else 0
+
+
+def mark_watched(args: Namespace) -> int:
+    set_watched(read_video_ids(args), not args.unwatch)
+    return 0
+
+
+def delete(args: Namespace) -> int:
+    delete_videos(read_video_ids(args))
+    return 0
+
+
+def clean(args: Namespace) -> int:
+    del args
+    clean_assets()
+    return 0
+
+
+def resolve(args: Namespace) -> int:
+    """Print the channel ids of handles, channel URLs and exports"""
+    references = list(args.references)
+    for path in args.import_paths:
+        references.extend(read_subscriptions(path))
+    if not references:
+        references = [line.strip() for line in sys.stdin if line.strip()]
+    channel_ids = asyncio.run(resolve_channels(references))
+    if args.json:
+        print_json(channel_ids)
+    else:
+        for reference, channel_id in channel_ids.items():
+            print(f"{channel_id}\t{reference}")
+    unresolved_references = [
+        reference for reference in references if reference not in channel_ids
+    ]
+    for reference in unresolved_references:
+        print(f"Could not resolve {reference}", file=sys.stderr)
+    return 1 if unresolved_references else 0
+
+
+def get_stats() -> dict[str, Any]:
+    with db.Session() as session:
+        video_counts = {
+            watched: count
+            for watched, count in session.execute(
+                select(db.Video.watched, func.count())
+                .group_by(db.Video.watched)
+            )
+        }
+        job_counts = {
+            state: count
+            for state, count in session.execute(
+                select(db.DownloadJob.state, func.count())
+                .group_by(db.DownloadJob.state)
+            )
+        }
+        channel_count = session.scalar(
+            select(func.count()).select_from(db.Channel)
+        )
+        thumbnail_bytes = session.scalar(
+            select(func.coalesce(func.sum(db.ThumbnailBlob.size), 0))
+        )
+    video_files = [
+        path for path in config.video_dir.iterdir() if path.is_file()
+    ]
+    try:
+        database_bytes = config.database_file.stat().st_size
+    except FileNotFoundError:
+        database_bytes = 0
+    return dict(
+        channels=channel_count,
+        videos=sum(video_counts.values()),
+        unwatched_videos=video_counts.get(False, 0),
+        watched_videos=video_counts.get(True, 0),
+        download_jobs=job_counts,
+        video_files=len(video_files),
+        video_bytes=sum(path.stat().st_size for path in video_files),
+        thumbnail_bytes=thumbnail_bytes,
+        database_bytes=database_bytes,
+    )
+
+
+def stats(args: Namespace) -> int:
+    data = get_stats()
+    if args.json:
+        print_json(data)
+        return 0
+    for key, value in data.items():
+        print(f"{key}\t{value}")
+    return 0
+
+
+def add_video_ids_argument(parser: ArgumentParser) -> None:
+    parser.add_argument(
+        "video_ids",
+        nargs="*",
+        metavar="VIDEO_ID",
+        help="read from stdin, one per line, if none are given",
+    )
+
+
+def get_parser() -> ArgumentParser:
+    parser = ArgumentParser(prog="yrp", description="Headless yrp")
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+    subparsers = parser.add_subparsers(required=True)
+
+    refresh_parser = subparsers.add_parser(
+        "refresh",
+        help="fetch the feeds and print the ids of new videos",
+    )
+    refresh_parser.add_argument(
+        "--channel",
+        dest="channel_ids",
+        action="append",
+        metavar="CHANNEL_ID",
+        help="only fetch this channel, can be repeated",
+    )
+    refresh_parser.add_argument("--json", action="store_true")
+    refresh_parser.set_defaults(func=refresh)
+
+    list_parser = subparsers.add_parser("list", help="list videos")
+    list_parser.add_argument("--json", action="store_true")
+    list_parser.add_argument(
+        "--days",
+        type=float,
+        default=config.no_older_than.days,
+        help="only list videos published in the last DAYS days",
+    )
+    watched_group = list_parser.add_mutually_exclusive_group()
+    watched_group.add_argument("--watched", action="store_true")
+    watched_group.add_argument("--all", action="store_true")
+    list_parser.set_defaults(func=list_videos)
+
+    download_parser = subparsers.add_parser(
+        "download",
+        help="download videos and run the download queue until it is empty",
+    )
+    download_parser.add_argument(
+        "video_ids",
+        nargs="*",
+        metavar="VIDEO_ID",
+    )
+    download_parser.add_argument(
+        "--stdin",
+        action="store_true",
+        help="also read video ids from stdin, one per line",
+    )
+    download_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=config.download_config.workers,
+        help="number of parallel downloads",
+    )
+    download_parser.set_defaults(func=download)
+
+    watched_parser = subparsers.add_parser(
+        "watched",
+        help="mark videos as watched and delete their files",
+    )
+    add_video_ids_argument(watched_parser)
+    watched_parser.add_argument(
+        "--unwatch",
+        action="store_true",
+        help="mark the videos as not watched instead",
+    )
+    watched_parser.set_defaults(func=mark_watched)
+
+    delete_parser = subparsers.add_parser(
+        "delete",
+        help="delete videos from the database along with their files",
+    )
+    add_video_ids_argument(delete_parser)
+    delete_parser.set_defaults(func=delete)
+
+    clean_parser = subparsers.add_parser(
+        "clean",
+        help="delete the files of watched and old videos",
+    )
+    clean_parser.set_defaults(func=clean)
+
+    resolve_parser = subparsers.add_parser(
+        "resolve",
+        help="print the channel ids of handles and channel URLs",
+    )
+    resolve_parser.add_argument(
+        "references",
+        nargs="*",
+        metavar="REFERENCE",
+        help="@handle, channel URL or channel id, read from stdin if none"
+        " are given",
+    )
+    resolve_parser.add_argument(
+        "--import",
+        dest="import_paths",
+        action="append",
+        default=[],
+        type=Path,
+        metavar="FILE",
+        help="OPML or Takeout subscriptions.csv export, or a file with one"
+        " reference per line",
+    )
+    resolve_parser.add_argument("--json", action="store_true")
+    resolve_parser.set_defaults(func=resolve)
+
+    stats_parser = subparsers.add_parser("stats", help="print statistics")
+    stats_parser.add_argument("--json", action="store_true")
+    stats_parser.set_defaults(func=stats)
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    args = get_parser().parse_args(argv)
+    log_levels = (logging.WARNING, logging.INFO, logging.DEBUG)
+    logging.basicConfig(level=log_levels[min(args.verbose, 2)])
+    return args.func(args)
@@ -8,11 +8,21 @@ from xdg_base_dirs import (
 import tomllib
 import re
 import logging
-from pydantic import BaseModel, StringConstraints, Field, TypeAdapter
-from typing import Pattern, TypedDict, NotRequired
-from typing_extensions import Annotated
+from collections.abc import Iterable
+from pathlib import Path
+from pydantic import (
+    BaseModel,
+    BeforeValidator,
+    StringConstraints,
+    Field,
+    PrivateAttr,
+    TypeAdapter,
+)
+from typing import Any, Literal, Optional, Pattern, NotRequired
+from typing_extensions import Annotated, TypedDict
 
-from yrp.backend import VideoEntry
+from yrp.feed import VideoEntry
+from yrp.filters import TextMatcher
 
 
 logger = logging.getLogger(__name__)
@@ -29,9 +39,11 @@ cache_path.mkdir(parents=True, exist_ok=True)
 
 thumbnail_dir = cache_path / "thumbnails"
 video_dir = cache_path / "videos"
+info_dir = cache_path / "info"
 
 thumbnail_dir.mkdir(parents=True, exist_ok=True)
 video_dir.mkdir(parents=True, exist_ok=True)
+info_dir.mkdir(parents=True, exist_ok=True)
 
 config_file = config_path / f"{APP_NAME}.toml"
 database_file = data_path / "yrp.db"
@@ -43,58 +55,238 @@ logger.info(f'{config_file=}')
 channel_id_regex = re.compile(r"[\w-]{24}")
 
 
-class ChannelEntry(TypedDict):
-    id: str
+class TextFilterEntry(TypedDict):
     include: NotRequired[list[str] | str]
     exclude: NotRequired[list[str] | str]
     include_regex: NotRequired[list[str] | str]
     exclude_regex: NotRequired[list[str] | str]
 
 
-class ChannelFilter(BaseModel):
-    include: list[str] = Field(default_factory=list)
-    exclude: list[str] = Field(default_factory=list)
-    include_regex: list[Pattern] = Field(default_factory=list)
-    exclude_regex: list[Pattern] = Field(default_factory=list)
+class ChannelEntry(TextFilterEntry):
+    id: str
+    description: NotRequired[TextFilterEntry]
+
+
+def as_list(value: Any) -> Any:
+    return [value] if isinstance(value, str) else value
+
+
+Keywords = Annotated[list[str], BeforeValidator(as_list)]
+Patterns = Annotated[list[Pattern], BeforeValidator(as_list)]
+
+
+class TextFilter(BaseModel):
+    """Keeps texts with an include keyword unless they have an exclude one
+
+    Substrings match anywhere in the text and regexes at its start. Every
+    text is kept when there are no include keywords. Keywords are compiled
+    into a matcher for each list when the filter is created.
+    """
+
+    include: Keywords = Field(default_factory=list)
+    exclude: Keywords = Field(default_factory=list)
+    include_regex: Patterns = Field(default_factory=list)
+    exclude_regex: Patterns = Field(default_factory=list)
+    _include_matcher: TextMatcher = PrivateAttr()
+    _exclude_matcher: TextMatcher = PrivateAttr()
+
+    def model_post_init(self, context: Any, /) -> None:
+        self._include_matcher = TextMatcher(self.include, self.include_regex)
+        self._exclude_matcher = TextMatcher(self.exclude, self.exclude_regex)
+
+    def match(self, text: str) -> bool:
+        if self._exclude_matcher(text):
+            return False
+        return not self._include_matcher or self._include_matcher(text)
+
+
+class ChannelFilter(TextFilter):
+    """Filter on the titles of videos and optionally on their descriptions"""
+
+    description: Optional[TextFilter] = None
 
     def filter(self, video_entry: VideoEntry) -> bool:
-        title = video_entry["title"]
-        if self.exclude:
-            if any(s in title for s in self.include):
-                return False
-        if self.exclude_regex:
-            if any(pattern.match(title) for pattern in self.exclude_regex):
-                return False
-
-        if not self.include and not self.include_regex:
+        if not self.match(video_entry["title"]):
+            return False
+        if self.description is None:
             return True
-        if self.include:
-            if any(s in title for s in self.include):
-                return True
-        if self.include_regex:
-            if any(pattern.match(title) for pattern in self.include_regex):
-                return True
-        return False
+        return self.description.match(video_entry.get("description", ""))
+
+    def filter_entries(
+        self,
+        video_entries: Iterable[VideoEntry],
+    ) -> list[VideoEntry]:
+        return [
+            video_entry
+            for video_entry in video_entries
+            if self.filter(video_entry)
+        ]
+
+
+class SchedulerConfig(BaseModel):
+    max_concurrency: int = Field(default=32, gt=0)
+    max_concurrency_per_host: int = Field(default=8, gt=0)
+    requests_per_second: float = Field(default=20, gt=0)
+    burst: int = Field(default=10, gt=0)
+    max_retries: int = Field(default=4, ge=0)
+    backoff_base: float = Field(default=0.5, gt=0)
+    backoff_max: float = Field(default=30, gt=0)
+
+
+class ThumbnailCacheConfig(BaseModel):
+    max_size_mb: float = Field(default=200, gt=0)
+    max_age_days: float = Field(default=30, gt=0)
+
+
+class DaemonConfig(BaseModel):
+    min_poll_interval_minutes: float = Field(default=15, gt=0)
+    max_poll_interval_minutes: float = Field(default=12 * 60, gt=0)
+    # How many times a channel is polled per average gap between uploads
+    polls_per_upload: float = Field(default=4, gt=0)
+    history_days: float = Field(default=90, gt=0)
+
+
+class DownloadConfig(BaseModel):
+    workers: int = Field(default=2, gt=0)
+    max_attempts: int = Field(default=3, gt=0)
+    # Failed jobs wait this long before their next attempt, doubled after
+    # every failure
+    retry_delay_seconds: float = Field(default=60, ge=0)
+
+
+class DatabaseConfig(BaseModel):
+    # Interpolated into PRAGMA statements, so only valid values are accepted
+    journal_mode: Literal[
+        "WAL", "DELETE", "TRUNCATE", "PERSIST", "MEMORY", "OFF"
+    ] = "WAL"
+    synchronous: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    mmap_size_mb: int = Field(default=256, ge=0)
+    # How long a connection waits for another one to release its lock
+    busy_timeout_ms: int = Field(default=5000, ge=0)
+
+
+class ProgressConfig(BaseModel):
+    max_rate_hz: float = Field(default=10, gt=0)
+    # Smallest change of the downloaded fraction worth an update
+    min_change: float = Field(default=0.01, ge=0)
+    # Weight of the latest sample in the moving average of the speed
+    speed_smoothing: float = Field(default=0.3, gt=0, le=1)
+
+
+time_of_day_pattern = r"([01]\d|2[0-3]):[0-5]\d"
+TimeWindow = Annotated[
+    str,
+    StringConstraints(
+        pattern=rf"^{time_of_day_pattern}-{time_of_day_pattern}$"
+    ),
+]
+
+
+class PrefetchConfig(BaseModel):
+    # Videos downloaded ahead of time, 0 disables prefetching
+    max_videos: int = Field(default=3, ge=0)
+    max_disk_gb: float = Field(default=10, gt=0)
+    max_age_days: float = Field(default=7, gt=0)
+    recency_half_life_hours: float = Field(default=24, gt=0)
+    # Times of day as "HH:MM-HH:MM" when prefetching may start, any time if
+    # empty
+    idle_windows: list[TimeWindow] = Field(default_factory=list)
+
+
+class MetricsConfig(BaseModel):
+    # Serve the timings in the Prometheus text format on localhost, from
+    # whichever of the UI and the daemon starts first
+    prometheus_port: Optional[int] = Field(default=None, gt=0, lt=2**16)
+    # Write the timings to this JSON file after refreshes and downloads.
+    # The UI and the daemon insert their name before the suffix, such as
+    # metrics.daemon.json
+    json_file: Optional[Path] = None
+    # Also report spans to the tracer provider set up by OpenTelemetry
+    opentelemetry: bool = False
+
+
+def parse_channels(
+    channel_entries: list[str | dict[str, Any]],
+) -> tuple[set[str], dict[str, ChannelFilter]]:
+    channel_ids = set()
+    channel_filters = {}
+    for channel_entry in channel_entries:
+        if isinstance(channel_entry, str):
+            channel_id = channel_entry
+        else:
+            TypeAdapter(ChannelEntry).validate_python(channel_entry)
+            channel_entry = dict(channel_entry)
+            channel_id = channel_entry.pop("id")
+            if channel_entry:
+                channel_filter = ChannelFilter.model_validate(channel_entry)
+                channel_filters[channel_id] = channel_filter
+        if channel_id_regex.fullmatch(channel_id) is None:
+            raise ValueError(f"Channel ID '{channel_id}' is not valid")
+        channel_ids.add(channel_id)
+    return channel_ids, channel_filters
+
+
+def parse_config(config: dict[str, Any]) -> dict[str, Any]:
+    """Settings of this module defined by the content of a config file
+
+    Tables missing from config get their default settings.
+    """
+    channel_ids, channel_filters = parse_channels(config.get("channels", []))
+    global_filter = None
+    if "global_filter" in config:
+        global_filter = ChannelFilter.model_validate(config["global_filter"])
+    return dict(
+        channel_ids=channel_ids,
+        channel_filters=channel_filters,
+        global_filter=global_filter,
+        database_config=DatabaseConfig.model_validate(
+            config.get("database", {})
+        ),
+        scheduler_config=SchedulerConfig.model_validate(
+            config.get("scheduler", {})
+        ),
+        thumbnail_cache_config=ThumbnailCacheConfig.model_validate(
+            config.get("thumbnail_cache", {})
+        ),
+        daemon_config=DaemonConfig.model_validate(config.get("daemon", {})),
+        download_config=DownloadConfig.model_validate(
+            config.get("downloads", {})
+        ),
+        progress_config=ProgressConfig.model_validate(
+            config.get("progress", {})
+        ),
+        prefetch_config=PrefetchConfig.model_validate(
+            config.get("prefetch", {})
+        ),
+        metrics_config=MetricsConfig.model_validate(
+            config.get("metrics", {})
+        ),
+    )
+
+
+def read_config_file(path: Path = config_file) -> dict[str, Any]:
+    """Settings defined by the config file at path
 
+    A missing file raises FileNotFoundError rather than giving the default
+    settings, which would unsubscribe from every channel on a reload.
+    """
+    with path.open("rb") as file:
+        return parse_config(tomllib.load(file))
 
 
-channel_filters = {}
-channel_ids = set()
+channel_ids: set[str] = set()
+channel_filters: dict[str, ChannelFilter] = {}
+# Applied to the videos of every channel before their own filter
+global_filter: Optional[ChannelFilter] = None
+database_config = DatabaseConfig()
+scheduler_config = SchedulerConfig()
+thumbnail_cache_config = ThumbnailCacheConfig()
+daemon_config = DaemonConfig()
+download_config = DownloadConfig()
+progress_config = ProgressConfig()
+prefetch_config = PrefetchConfig()
+metrics_config = MetricsConfig()
 if config_file.is_file():
-    with config_file.open("rb") as file:
-        config = tomllib.load(file)
-        for channel_entry in config["channels"]:
-            if isinstance(channel_entry, str):
-                channel_id = channel_entry
-                continue
-            else:
-                TypeAdapter(ChannelEntry).validate_python(channel_entry)
-                channel_id = channel_entry.pop("id")
-                if channel_entry:
-                    channel_filter = ChannelFilter.model_validate(channel_entry)
-                    channel_filters[channel_id] = channel_filter
-            if channel_id_regex.fullmatch(channel_id) is None:
-                raise ValueError( f"Channel ID '{channel_id}' is not valid")
-            channel_ids.add(channel_id)
+    globals().update(read_config_file())
 
 no_older_than = timedelta(days=1)
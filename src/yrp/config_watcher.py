@@ -0,0 +1,207 @@
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Event, Thread
+from typing import Any, Optional
+import ctypes
+import logging
+import os
+import select
+import struct
+
+import yrp.config as config
+from yrp.config import ChannelFilter
+from yrp.observer import Observable
+
+
+logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# wd, mask, cookie and length of the name that follows in struct
+# inotify_event
+INOTIFY_EVENT = struct.Struct("iIII")
+# Editors can write a file in several steps, it is read once they are done
+SETTLE_TIME = 0.2
+# How often the file is checked when inotify is not available, and how long
+# stop can wait for the watching thread
+POLL_INTERVAL = 1.0
+
+
+class Inotify:
+    """Names of the files changed in a directory, through inotify"""
+
+    def __init__(self, directory: Path, mask: int) -> None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), str(directory))
+
+    def read(self, timeout: float) -> list[str]:
+        """Wait up to timeout seconds for changes, return the file names"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 2**16)
+        names = []
+        offset = 0
+        while offset < len(data):
+            *_, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            names.append(os.fsdecode(data[offset:offset+length].rstrip(b"\0")))
+            offset += length
+        return names
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+@dataclass(frozen=True)
+class ConfigDelta:
+    added_channel_ids: frozenset[str] = frozenset()
+    removed_channel_ids: frozenset[str] = frozenset()
+    # Channels still subscribed to whose videos are filtered differently
+    refiltered_channel_ids: frozenset[str] = frozenset()
+
+    def __bool__(self) -> bool:
+        return bool(
+            self.added_channel_ids
+            or self.removed_channel_ids
+            or self.refiltered_channel_ids
+        )
+
+
+def dump_filter(
+    channel_filter: Optional[ChannelFilter],
+) -> Optional[dict[str, Any]]:
+    return None if channel_filter is None else channel_filter.model_dump()
+
+
+def get_config_delta(
+    old_settings: dict[str, Any],
+    new_settings: dict[str, Any],
+) -> ConfigDelta:
+    """Channels affected by going from old_settings to new_settings
+
+    Settings are dicts as returned by config.parse_config.
+    """
+    old_channel_ids = old_settings["channel_ids"]
+    new_channel_ids = new_settings["channel_ids"]
+    kept_channel_ids = old_channel_ids & new_channel_ids
+    old_global_filter = dump_filter(old_settings["global_filter"])
+    if old_global_filter != dump_filter(new_settings["global_filter"]):
+        refiltered_channel_ids = kept_channel_ids
+    else:
+        old_filters = old_settings["channel_filters"]
+        new_filters = new_settings["channel_filters"]
+        refiltered_channel_ids = {
+            channel_id
+            for channel_id in kept_channel_ids
+            if dump_filter(old_filters.get(channel_id))
+            != dump_filter(new_filters.get(channel_id))
+        }
+    return ConfigDelta(
+        added_channel_ids=frozenset(new_channel_ids - old_channel_ids),
+        removed_channel_ids=frozenset(old_channel_ids - new_channel_ids),
+        refiltered_channel_ids=frozenset(refiltered_channel_ids),
+    )
+
+
+class ConfigWatcher(Observable):
+    """Reloads the config file whenever it changes
+
+    The settings of yrp.config are replaced, so code reading them when it
+    runs sees the new values, and observers are notified from the watching
+    thread with the ConfigDelta of reloads that affect channels. A file
+    that is missing or not valid is logged and ignored, the settings read
+    last are kept until a valid file is written.
+    """
+
+    def __init__(self, path: Path = config.config_file) -> None:
+        super().__init__()
+        self.path = path
+        self._stat = self._get_stat()
+        self._stop = Event()
+        self._thread: Optional[Thread] = None
+
+    def _get_stat(self) -> Optional[tuple[int, int, int]]:
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> Optional[ConfigDelta]:
+        try:
+            settings = config.read_config_file(self.path)
+        except (OSError, ValueError) as e:
+            logger.error(f"Not reloading {self.path}: {e}")
+            return None
+        old_settings = {name: getattr(config, name) for name in settings}
+        delta = get_config_delta(old_settings, settings)
+        vars(config).update(settings)
+        logger.info(f"Reloaded {self.path}")
+        if delta:
+            self.notify_observers(delta)
+        return delta
+
+    def check(self) -> Optional[ConfigDelta]:
+        """Reload the file if it changed since it was last read"""
+        stat = self._get_stat()
+        if stat == self._stat:
+            return None
+        self._stat = stat
+        return self.reload()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = Thread(
+            target=self._watch,
+            name="config-watcher",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self) -> None:
+        # The directory is watched since editors often replace the file
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+        inotify: Optional[Inotify]
+        try:
+            inotify = Inotify(self.path.parent, mask)
+        except (AttributeError, OSError) as e:
+            logger.info(f"Polling {self.path}, inotify is not available: {e}")
+            inotify = None
+        try:
+            while not self._stop.is_set():
+                if inotify is None:
+                    self._stop.wait(POLL_INTERVAL)
+                elif self.path.name in inotify.read(POLL_INTERVAL):
+                    self._stop.wait(SETTLE_TIME)
+                    inotify.read(0)
+                # An observer failing must not stop later reloads
+                try:
+                    self.check()
+                except Exception as e:
+                    logger.error(f"Applying {self.path} failed: {e!r}")
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+
+config_watcher = ConfigWatcher()
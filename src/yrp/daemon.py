@@ -0,0 +1,201 @@
+from collections.abc import Iterable
+from datetime import datetime, timedelta
+from typing import Optional
+import asyncio
+import logging
+
+from sqlalchemy import func, select
+
+import yrp.config as config
+from yrp import db as db
+from yrp.backend import (
+    apply_config_delta, create_notification, fetch_feeds, update_channels
+)
+from yrp.config_watcher import ConfigDelta, config_watcher
+from yrp.downloads import download_manager
+from yrp.metrics import metrics
+from yrp.observer import Observable, Observer
+from yrp.prefetch import prefetch
+
+
+logger = logging.getLogger(__name__)
+
+MAX_SLEEP = timedelta(minutes=5)
+# Least time waited after a failed iteration, so that a persistent error
+# such as a locked database is not retried in a busy loop
+ERROR_SLEEP = timedelta(minutes=1)
+
+
+def get_poll_interval(upload_count: int) -> timedelta:
+    """Poll interval of a channel given its uploads in the history window"""
+    daemon_config = config.daemon_config
+    min_interval = timedelta(minutes=daemon_config.min_poll_interval_minutes)
+    max_interval = timedelta(minutes=daemon_config.max_poll_interval_minutes)
+    if upload_count == 0:
+        return max_interval
+    mean_gap = timedelta(days=daemon_config.history_days) / upload_count
+    interval = mean_gap / daemon_config.polls_per_upload
+    return max(min_interval, min(max_interval, interval))
+
+
+def query_poll_intervals(
+    channel_ids: Optional[Iterable[str]] = None,
+) -> dict[str, timedelta]:
+    history_days = config.daemon_config.history_days
+    cutoff_dt = datetime.now() - timedelta(days=history_days)
+    query = (
+        select(db.Channel.id, func.count(db.Video.id))
+        .outerjoin(
+            db.Video,
+            (db.Video.channel_id == db.Channel.id)
+            & (db.Video.publication_dt > cutoff_dt),
+        )
+        .group_by(db.Channel.id)
+    )
+    if channel_ids is not None:
+        query = query.where(db.Channel.id.in_(channel_ids))
+    with db.Session() as session:
+        return {
+            channel_id: get_poll_interval(upload_count)
+            for channel_id, upload_count in session.execute(query)
+        }
+
+
+class RefreshSchedule:
+    """When each channel is due to be polled next
+
+    The first poll of every channel is based on db.Channel.last_polled so
+    that restarting the daemon does not fetch every channel again.
+    """
+
+    def __init__(self) -> None:
+        self.next_poll: dict[str, datetime] = {}
+
+    def load(self) -> None:
+        intervals = query_poll_intervals()
+        with db.Session() as session:
+            last_polled = {
+                channel_id: polled_dt
+                for channel_id, polled_dt in session.execute(
+                    select(db.Channel.id, db.Channel.last_polled)
+                )
+            }
+        now = datetime.now()
+        self.next_poll = {}
+        for channel_id, interval in intervals.items():
+            polled_dt = last_polled.get(channel_id)
+            # Channels that were never fetched are due straight away
+            if polled_dt is None:
+                self.next_poll[channel_id] = now
+            else:
+                self.next_poll[channel_id] = polled_dt + interval
+
+    def get_due(self, now: datetime) -> set[str]:
+        return {
+            channel_id
+            for channel_id, next_poll_dt in self.next_poll.items()
+            if next_poll_dt <= now
+        }
+
+    def reschedule(self, channel_ids: Iterable[str], now: datetime) -> None:
+        for channel_id, interval in query_poll_intervals(channel_ids).items():
+            self.next_poll[channel_id] = now + interval
+
+    def remove(self, channel_ids: Iterable[str]) -> None:
+        for channel_id in channel_ids:
+            self.next_poll.pop(channel_id, None)
+
+    def get_sleep_time(self, now: datetime) -> float:
+        next_poll_dt = min(self.next_poll.values(), default=now + MAX_SLEEP)
+        sleep_time = min(MAX_SLEEP, max(timedelta(), next_poll_dt - now))
+        return sleep_time.total_seconds()
+
+
+def notify_new_video(video_id: str) -> None:
+    create_notification(video_id).show()
+
+
+class ConfigDeltaObserver(Observer):
+    """Hands the deltas of config reloads over to the event loop"""
+
+    def __init__(
+        self,
+        observable: Observable,
+        queue: asyncio.Queue[ConfigDelta],
+    ) -> None:
+        super().__init__(observable)
+        self.loop = asyncio.get_running_loop()
+        self.queue = queue
+
+    def notify(self, observable: Observable, delta: ConfigDelta) -> None:
+        del observable
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+
+
+async def apply_config_changes(
+    schedule: RefreshSchedule,
+    delta: ConfigDelta,
+) -> None:
+    logger.info(
+        f"Config changed: {len(delta.added_channel_ids)} channels added,"
+        f" {len(delta.removed_channel_ids)} removed and"
+        f" {len(delta.refiltered_channel_ids)} filtered differently"
+    )
+    await apply_config_delta(delta, notify_new_video)
+    schedule.remove(delta.removed_channel_ids)
+    schedule.reschedule(
+        delta.added_channel_ids | delta.refiltered_channel_ids,
+        datetime.now(),
+    )
+
+
+async def refresh_due_channels(schedule: RefreshSchedule) -> None:
+    due_channel_ids = schedule.get_due(datetime.now())
+    if not due_channel_ids:
+        return
+    logger.info(f"Refreshing {len(due_channel_ids)} channels")
+    try:
+        await fetch_feeds(notify_new_video, due_channel_ids)
+    finally:
+        # Channels of a failed refresh are polled again at their usual
+        # interval rather than straight away
+        schedule.reschedule(due_channel_ids, datetime.now())
+
+
+async def run() -> None:
+    update_channels(config.channel_ids)
+    schedule = RefreshSchedule()
+    schedule.load()
+    metrics.start(process_name="daemon")
+    download_manager.start()
+    config_deltas: asyncio.Queue[ConfigDelta] = asyncio.Queue()
+    ConfigDeltaObserver(config_watcher, config_deltas)
+    config_watcher.start()
+    while True:
+        sleep_time = 0.0
+        try:
+            await refresh_due_channels(schedule)
+            await asyncio.to_thread(prefetch, download_manager)
+        except Exception as e:
+            logger.error(f"Refresh failed: {e!r}")
+            sleep_time = ERROR_SLEEP.total_seconds()
+        sleep_time = max(sleep_time, schedule.get_sleep_time(datetime.now()))
+        # Config changes are applied straight away rather than at the next
+        # poll
+        try:
+            delta = await asyncio.wait_for(config_deltas.get(), sleep_time)
+        except TimeoutError:
+            continue
+        try:
+            await apply_config_changes(schedule, delta)
+        except Exception as e:
+            logger.error(f"Could not apply config changes: {e!r}")
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
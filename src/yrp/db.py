@@ -1,12 +1,18 @@
 from datetime import datetime
 from sqlalchemy import ForeignKey, String
-from typing import List, Optional
-from sqlalchemy import ForeignKey, String, create_engine
+from typing import Any, List, Optional
+from sqlalchemy import Engine, ForeignKey, Index, String, create_engine, event
 from sqlalchemy.orm import (
     DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
 )
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
-from yrp.config import database_file
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.ext.asyncio import (
+    AsyncEngine, async_sessionmaker, create_async_engine
+)
+from sqlalchemy.ext.asyncio import AsyncSession as OrmAsyncSession
+from threading import Lock
+from yrp.config import DatabaseConfig, database_config, database_file
+from yrp.migrations import migrate
 
 
 class Base(DeclarativeBase):
@@ -18,11 +24,30 @@ class Channel(Base):
     id: Mapped[str] = mapped_column(String(24), primary_key=True)
     title: Mapped[Optional[str]] = mapped_column(String)
     last_updated: Mapped[Optional[datetime]]
+    # Last successful poll of the feed, including the unmodified ones
+    last_polled: Mapped[Optional[datetime]]
     videos: Mapped[List["Video"]] = relationship(
         back_populates="channel",
         cascade="all, delete-orphan",
         passive_deletes=True,
     )
+    feed_cache: Mapped[Optional["FeedCache"]] = relationship(
+        back_populates="channel",
+        cascade="all, delete-orphan",
+        passive_deletes=True,
+    )
+
+
+class FeedCache(Base):
+    __tablename__ = "feed_cache"
+    channel_id: Mapped[str] = mapped_column(
+        ForeignKey("channel.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    etag: Mapped[Optional[str]]
+    last_modified: Mapped[Optional[str]]
+    content_hash: Mapped[Optional[str]]
+    channel: Mapped["Channel"] = relationship(back_populates="feed_cache")
 
 
 class Video(Base):
@@ -38,15 +63,145 @@ class Video(Base):
     channel: Mapped["Channel"] = relationship(back_populates="videos")
 
 
-# Set up syncronous session
-sync_db_url = f'sqlite:///{database_file}'
-engine = create_engine(sync_db_url)
-Session = sessionmaker(bind=engine)
+# Unwatched videos, newest first
+Index(
+    "ix_video_watched_publication_dt",
+    Video.watched,
+    Video.publication_dt.desc(),
+)
+# Videos of a channel, and uploads of channels over a period
+Index(
+    "ix_video_channel_id_publication_dt",
+    Video.channel_id,
+    Video.publication_dt,
+)
+
+
+class DownloadJob(Base):
+    __tablename__ = "download_job"
+    __table_args__ = (
+        Index("ix_download_job_queue", "state", "priority", "created"),
+    )
+    # Foreign keys are not enforced, jobs are deleted with their videos by
+    # delete_videos and remove_channels
+    video_id: Mapped[str] = mapped_column(
+        ForeignKey("video.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True,
+    )
+    state: Mapped[str] = mapped_column(String(16), default="queued")
+    priority: Mapped[int] = mapped_column(default=0)
+    created: Mapped[datetime]
+    attempts: Mapped[int] = mapped_column(default=0)
+    # Process running the job, used to tell interrupted jobs apart
+    pid: Mapped[Optional[int]]
+    error: Mapped[Optional[str]]
+    # Failed jobs are not claimed again before this time
+    not_before: Mapped[Optional[datetime]]
+    # Stored with the job since a worker of another process may run it
+    with_notification: Mapped[bool] = mapped_column(default=False)
+    # Downloaded fraction, written by the worker for every process to read
+    progress: Mapped[Optional[float]]
+
+
+class ThumbnailBlob(Base):
+    __tablename__ = "thumbnail_blob"
+    digest: Mapped[str] = mapped_column(String(64), primary_key=True)
+    size: Mapped[int]
+    last_access: Mapped[datetime] = mapped_column(index=True)
+
+
+class Thumbnail(Base):
+    __tablename__ = "thumbnail"
+    video_id: Mapped[str] = mapped_column(String(11), primary_key=True)
+    digest: Mapped[str] = mapped_column(
+        ForeignKey("thumbnail_blob.digest", ondelete="CASCADE"),
+        index=True,
+    )
+
+
+class ChannelHandle(Base):
+    __tablename__ = "channel_handle"
+    # Path of the channel page, such as /@handle or /c/name
+    path: Mapped[str] = mapped_column(String, primary_key=True)
+    channel_id: Mapped[str] = mapped_column(String(24))
 
-# Set up asyncronous session
+
+def set_pragmas(engine: Engine, database_config: DatabaseConfig) -> None:
+    """Set the pragmas of database_config on every connection of engine
+
+    WAL lets the UI read while the refresher writes, and the busy timeout
+    makes writers wait for each other instead of failing.
+    """
+    pragmas = dict(
+        journal_mode=database_config.journal_mode,
+        synchronous=database_config.synchronous,
+        mmap_size=database_config.mmap_size_mb * 2**20,
+        busy_timeout=database_config.busy_timeout_ms,
+    )
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection: Any, _connection_record: Any) -> None:
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+sync_db_url = f'sqlite:///{database_file}'
 async_db_url = f'sqlite+aiosqlite:///{database_file}'
-async_engine = create_async_engine(async_db_url)
-AsyncSession = async_sessionmaker(bind=async_engine)
 
-# Create tables if missing
-Base.metadata.create_all(engine)
+_engines: dict[str, Any] = {}
+_engines_lock = Lock()
+
+
+def get_engine() -> Engine:
+    """Engine of the database file, migrated when first created"""
+    with _engines_lock:
+        if "sync" not in _engines:
+            engine = create_engine(sync_db_url)
+            set_pragmas(engine, database_config)
+            migrate(engine, Base.metadata)
+            _engines["sync"] = engine
+        return _engines["sync"]
+
+
+def get_async_engine() -> AsyncEngine:
+    # The schema is only ever migrated by the sync engine
+    get_engine()
+    with _engines_lock:
+        if "async" not in _engines:
+            async_engine = create_async_engine(async_db_url)
+            set_pragmas(async_engine.sync_engine, database_config)
+            _engines["async"] = async_engine
+        return _engines["async"]
+
+
+def __getattr__(name: str) -> Any:
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazySessionmaker(sessionmaker[OrmSession]):
+    """sessionmaker that binds to the database file on first use
+
+    Sessions configured with another bind, as in tests, never touch it.
+    """
+
+    def __call__(self, **local_kw: Any) -> OrmSession:
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_engine())
+        return super().__call__(**local_kw)
+
+
+class LazyAsyncSessionmaker(async_sessionmaker[OrmAsyncSession]):
+    def __call__(self, **local_kw: Any) -> OrmAsyncSession:
+        if self.kw.get("bind") is None:
+            self.configure(bind=get_async_engine())
+        return super().__call__(**local_kw)
+
+
+Session = LazySessionmaker()
+AsyncSession = LazyAsyncSessionmaker()
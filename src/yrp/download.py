@@ -1,16 +1,28 @@
 from pathlib import Path
-from yt_dlp import YoutubeDL
 from urllib.request import urlretrieve
-from pprint import pp
-from collections.abc import Callable
-from typing import Any, Optional
-import requests
-from bs4 import BeautifulSoup
+from collections.abc import Callable, Sequence
+from datetime import datetime, timedelta
+from threading import Lock, get_ident, local
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Optional
+import asyncio
+import json
+import logging
+import os
 import re
 
-import gi
-gi.require_version("Notify", "0.7")
-from gi.repository import GLib, Notify
+import yrp.config as config
+from yrp.metrics import metrics
+from yrp.observer import Observable, Observer
+from yrp.progress import Progress, ProgressAggregator
+
+# yt-dlp and gi take longer to import than the rest of yrp together, so
+# they are only imported when a download starts
+if TYPE_CHECKING:
+    from gi.repository import Notify
+    from yt_dlp import YoutubeDL
+
+logger = logging.getLogger(__name__)
 
 get_thumbnail_url = "http://img.youtube.com/vi/{video_id}/mqdefault.jpg".format
 get_video_url = "http://www.youtube.com/watch?v={video_id}".format
@@ -30,6 +42,196 @@ default_options = {
     "noprogress": True,
 }
 
+# Stream URLs carry their expiry time as a query or path parameter
+stream_expiry_regex = re.compile(r"[?&/]expire[=/](\d+)")
+# Margin left to start downloading before the stream URLs expire
+STREAM_EXPIRY_MARGIN = timedelta(minutes=10)
+# How long info without any stream expiry is used
+DEFAULT_INFO_TTL = timedelta(hours=1)
+
+ProgressHook = Callable[[dict[str, Any]], None]
+
+
+def get_stream_expiry(info: dict[str, Any]) -> Optional[datetime]:
+    timestamps = [
+        int(match.group(1))
+        for format_ in info.get("formats") or [info]
+        if (match := stream_expiry_regex.search(format_.get("url", "")))
+    ]
+    if not timestamps:
+        return None
+    return datetime.fromtimestamp(min(timestamps))
+
+
+def get_selected_formats(info: dict[str, Any]) -> dict[str, Any]:
+    """Drop the formats of info that were not selected by yt-dlp
+
+    Selecting from the remaining formats again picks the same ones, without
+    considering formats that cannot be picked anyway.
+    """
+    selected_format_ids = {
+        format_["format_id"]
+        for format_ in info.get("requested_formats") or [info]
+        if "format_id" in format_
+    }
+    if not selected_format_ids:
+        return info
+    formats = [
+        format_
+        for format_ in info.get("formats", [])
+        if format_.get("format_id") in selected_format_ids
+    ]
+    return info | dict(formats=formats) if formats else info
+
+
+class InfoCache:
+    """Extracted yt-dlp info of videos, kept until their streams expire
+
+    Downloading from cached info skips fetching and parsing the video page,
+    which is most of the time spent before a download starts.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    def get_path(self, video_id: str) -> Path:
+        return self.directory / f"{video_id}.info.json"
+
+    def get(
+        self,
+        video_id: str,
+        now: Optional[datetime] = None,
+    ) -> Optional[dict[str, Any]]:
+        if now is None:
+            now = datetime.now()
+        path = self.get_path(video_id)
+        try:
+            info = json.loads(path.read_bytes())
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.warning(f"Discarding corrupt info file {path}")
+            path.unlink(missing_ok=True)
+            return None
+        expiry_dt = get_stream_expiry(info)
+        if expiry_dt is None:
+            cached_dt = datetime.fromtimestamp(info.get("epoch", 0))
+            expiry_dt = cached_dt + DEFAULT_INFO_TTL
+        else:
+            expiry_dt -= STREAM_EXPIRY_MARGIN
+        if now >= expiry_dt:
+            path.unlink(missing_ok=True)
+            return None
+        return info
+
+    def put(self, video_id: str, info: dict[str, Any]) -> None:
+        path = self.get_path(video_id)
+        # Threads of a process can put the same video at the same time
+        tmp_path = path.with_name(
+            f".{path.name}.{os.getpid()}.{get_ident()}.part"
+        )
+        tmp_path.write_text(json.dumps(info))
+        tmp_path.replace(path)
+
+    def discard(self, video_id: str) -> None:
+        self.get_path(video_id).unlink(missing_ok=True)
+
+    def evict(self, now: Optional[datetime] = None) -> None:
+        """Remove the info of every video whose streams have expired"""
+        for path in self.directory.glob("*.info.json"):
+            self.get(path.name.removesuffix(".info.json"), now)
+
+
+info_cache = InfoCache(config.info_dir)
+
+
+class ThreadState(local):
+    def __init__(self) -> None:
+        self.ydl: Optional["YoutubeDL"] = None
+        self.options_key: Optional[str] = None
+        self.progress_hooks: Sequence[ProgressHook] = ()
+        self.postprocessor_hooks: Sequence[ProgressHook] = ()
+
+
+thread_state = ThreadState()
+# Instances of every thread, so that they can be closed at shutdown
+youtube_dls: set["YoutubeDL"] = set()
+youtube_dls_lock = Lock()
+
+
+def forward_progress(download: dict[str, Any]) -> None:
+    for progress_hook in thread_state.progress_hooks:
+        progress_hook(download)
+
+
+def forward_postprocessor(postprocessor: dict[str, Any]) -> None:
+    for postprocessor_hook in thread_state.postprocessor_hooks:
+        postprocessor_hook(postprocessor)
+
+
+def get_youtube_dl(ytdlp_kwargs: dict[str, Any]) -> "YoutubeDL":
+    """YoutubeDL instance of the current thread for these options
+
+    The instance is reused as long as the options do not change, so its
+    format selector, extractors and connections are set up only once per
+    thread. Progress and postprocessor hooks are forwarded from
+    thread_state. The previous instance of the thread is closed when the
+    options change.
+    """
+    from yt_dlp import YoutubeDL
+
+    options_key = repr(sorted(ytdlp_kwargs.items()))
+    ydl = thread_state.ydl
+    with youtube_dls_lock:
+        # close_youtube_dls closes the instances of every thread
+        if ydl is not None and ydl not in youtube_dls:
+            ydl = None
+    if ydl is not None and thread_state.options_key == options_key:
+        return ydl
+    if ydl is not None:
+        with youtube_dls_lock:
+            youtube_dls.discard(ydl)
+        ydl.close()
+    ydl = YoutubeDL(ytdlp_kwargs | dict(
+        progress_hooks=[forward_progress],
+        postprocessor_hooks=[forward_postprocessor],
+    ))
+    with youtube_dls_lock:
+        youtube_dls.add(ydl)
+    thread_state.ydl = ydl
+    thread_state.options_key = options_key
+    return ydl
+
+
+def close_youtube_dls() -> None:
+    """Close the YoutubeDL instances of every thread
+
+    Called once downloads are over, threads that download again get new
+    instances.
+    """
+    with youtube_dls_lock:
+        ydls = list(youtube_dls)
+        youtube_dls.clear()
+    for ydl in ydls:
+        ydl.close()
+
+
+def extract_info(ydl: "YoutubeDL", video_id: str) -> dict[str, Any]:
+    url = get_video_url(video_id=video_id)
+    with metrics.span("ytdlp_extract", video_id=video_id):
+        info = ydl.extract_info(url, download=False)
+    info = ydl.sanitize_info(get_selected_formats(info), True)
+    info_cache.put(video_id, info)
+    return info
+
+
+def get_outtmpl(video_id: str, path: Path) -> str:
+    if path.stem == video_id:
+        # The same template, hence the same instance, serves every video
+        return str(path.with_name(f"%(id)s{path.suffix}"))
+    return str(path).replace("%", "%%")
+
+
 def download_thumbnail(video_id: str, path: str) -> None:
     p = Path(path)
     if not p.parent.is_dir():
@@ -40,86 +242,149 @@ def download_thumbnail(video_id: str, path: str) -> None:
     urlretrieve(url, path)
 
 
-def parse_progress(download: dict[str, float]) -> float | None:
-    # print(progress["status"])
-    if "info_dict" in download:
-        del download["info_dict"]
-    # if progress["status"] == "
-    if "fragment_count" in download and "fragment_index" in download:
-        if download["fragment_index"] > download["fragment_count"]+1:
-            pp(download)
-            raise KeyError(f"No keys to calculate errors. Keys available {download.keys()}")
-        else:
-            progress = download["fragment_index"] / (download["fragment_count"]+1)
-    elif all(k in download for k in ("downloaded_bytes", "total_bytes")):
-        progress = download["downloaded_bytes"] / download["total_bytes"]
-    elif all(k in download for k in ("downloaded_bytes", "total_bytes_estimate")):
-        progress = download["downloaded_bytes"] / download["total_bytesestimate"]
-    elif "fragment_count" in download and "fragment_index" in download:
-        if download["fragment_index"] > download["fragment_count"]:
-            pp(download)
-            raise KeyError(f"No keys to calculate errors. Keys available {download.keys()}")
-        else:
-            progress = download["fragment_index"] / (download["fragment_count"]+1)
-    else:
-        return None
-    # progress = download["downloaded_bytes"] / download["total_bytes"]
-    # eta = download["eta"]
-    # speed = download["speed"]
-    # elapsed = download["elapsed"]
-    return progress
+class DownloadTimer:
+    """Records the stages of a yt-dlp download from its hooks
+
+    The transfer of every format is timed by yt-dlp itself, merging them
+    and the other postprocessors are timed between their started and
+    finished statuses.
+    """
+
+    def __init__(self, video_id: str) -> None:
+        self.video_id = video_id
+        self.postprocessor_starts: dict[str, float] = {}
+
+    def progress_hook(self, download: dict[str, Any]) -> None:
+        if download.get("status") != "finished":
+            return
+        if download.get("elapsed") is not None:
+            metrics.observe(
+                "ytdlp_transfer",
+                download["elapsed"],
+                video_id=self.video_id,
+            )
+        byte_count = (
+            download.get("total_bytes") or download.get("downloaded_bytes")
+        )
+        if byte_count:
+            metrics.add_bytes("video", byte_count)
+
+    def postprocessor_hook(self, postprocessor: dict[str, Any]) -> None:
+        name = postprocessor.get("postprocessor", "")
+        status = postprocessor.get("status")
+        if status == "started":
+            self.postprocessor_starts[name] = perf_counter()
+        elif status == "finished" and name in self.postprocessor_starts:
+            start = self.postprocessor_starts.pop(name)
+            stage = "ytdlp_merge" if name == "Merger" else "ytdlp_postprocess"
+            metrics.observe(
+                stage,
+                perf_counter() - start,
+                video_id=self.video_id,
+                postprocessor=name,
+            )
+
 
+class NotificationObserver(Observer):
+    """Shows the progress of a download on its notification"""
 
-def get_notification_hook(notification: Notify.Notification) -> Callable[[dict[str, Any]], None]:
-    def notification_hook(d: dict[str, Any]) -> None:
-        progress_frac = parse_progress(d)
-        if isinstance(progress_frac, float):
-            value = GLib.Variant.new_uint32(int(progress_frac*100))
-            notification.set_hint("value", value)
-            # fgcolor = GLib.Variant.new_string("#ff4444")
-            # notification.set_hint("fgcolor", fgcolor)
-            notification.show()
-    return notification_hook
+    def __init__(
+        self,
+        observable: ProgressAggregator,
+        notification: "Notify.Notification",
+    ) -> None:
+        super().__init__(observable)
+        self.notification = notification
+        self.percent: Optional[int] = None
+
+    def notify(self, observable: Observable, progress: Progress) -> None:
+        from gi.repository import GLib
+
+        del observable
+        if progress.fraction is None:
+            return
+        percent = int(progress.fraction * 100)
+        # Every show() is a D-Bus round trip
+        if percent == self.percent:
+            return
+        self.percent = percent
+        self.notification.set_hint("value", GLib.Variant.new_uint32(percent))
+        self.notification.show()
 
 
 def download_video(
     url: str,
     path: str,
-    notification: Optional[Notify.Notification] = None,
+    notification: Optional["Notify.Notification"] = None,
+    progress: Optional[ProgressAggregator] = None,
     **ytdlp_kwargs: Any,
 ) -> None:
+    """Download the video with id url to path
+
+    The extracted info of the video is cached so that retrying or resuming
+    a download does not extract it again, and the YoutubeDL instance is
+    reused by later downloads of the same thread. Progress is reported to
+    the observers of progress and on notification, the time spent in each
+    stage to metrics.
+    """
+    from yt_dlp.utils import DownloadError
+
     p = Path(path)
     if p.is_file():
         raise FileExistsError
     p.parent.mkdir(parents=True, exist_ok=True)
-    ytdlp_kwargs["outtmpl"] = dict(default=path)
+    ytdlp_kwargs = default_options | ytdlp_kwargs
+    ytdlp_kwargs["outtmpl"] = dict(default=get_outtmpl(url, p))
+    if progress is None:
+        progress = ProgressAggregator(url)
+    progress_hooks = ytdlp_kwargs.pop("progress_hooks", [])
+    download_timer = DownloadTimer(url)
+    progress_hooks = progress_hooks + [
+        progress.hook,
+        download_timer.progress_hook,
+    ]
 
+    notification_observer = None
     if notification is not None:
         notification.show()
-        notification_hook = get_notification_hook(notification)
-        ytdlp_kwargs["progress_hooks"] = ytdlp_kwargs["progress_hooks"] + [notification_hook]
+        notification_observer = NotificationObserver(progress, notification)
 
-    with YoutubeDL(ytdlp_kwargs) as ydl:
-        error_code = ydl.download(url)
+    ydl = get_youtube_dl(ytdlp_kwargs)
+    thread_state.progress_hooks = progress_hooks
+    thread_state.postprocessor_hooks = [download_timer.postprocessor_hook]
+    start = perf_counter()
+    try:
+        info = info_cache.get(url)
+        if info is not None:
+            try:
+                ydl.process_ie_result(info, download=True)
+            except DownloadError as e:
+                # The cached stream URLs may have been revoked early
+                logger.info(f"Extracting {url} again after {e!r}")
+                info = None
+        if info is None:
+            info = extract_info(ydl, url)
+            ydl.process_ie_result(info, download=True)
+    except DownloadError as e:
+        raise ConnectionError(f"Download of video with id {url} failed") from e
+    finally:
+        thread_state.progress_hooks = ()
+        thread_state.postprocessor_hooks = ()
+        metrics.observe("download", perf_counter() - start, video_id=url)
+        if notification_observer is not None:
+            progress.unsubscribe(notification_observer)
+            notification_observer.notification.close()
+    info_cache.discard(url)
 
-    if notification is not None:
-        notification.close()
-
-    if error_code != 0:
-        raise ConnectionError(f"Download of video with id {id} failed")
     if not p.is_file():
         raise FileNotFoundError("Video was downloaded but file is not there")
 
 
 def get_yt_channel_id(modern_url: str) -> str:
-    content = requests.get(modern_url).content
-    soup = BeautifulSoup(content, "html.parser")
-    channel_id_regex = re.compile(r'"channelId":"([\w-]{24})"')
-    for script in soup.find_all("script"):
-        if script.string is None:
-            continue
-        match = channel_id_regex.search(script.string)
-        if match is not None:
-            return match.group(1)
-    raise ValueError(f"Could not find a channelId in URL {modern_url}")
+    from yrp.channels import resolve_channels
+
+    channel_ids = asyncio.run(resolve_channels([modern_url]))
+    if modern_url not in channel_ids:
+        raise ValueError(f"Could not find a channelId in URL {modern_url}")
+    return channel_ids[modern_url]
 
@@ -0,0 +1,413 @@
+from collections.abc import Callable, Sequence
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Optional
+import logging
+import os
+
+from sqlalchemy import delete, exists, func, or_, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import SQLAlchemyError
+
+import yrp.config as config
+from yrp import db as db
+from yrp.backend import (
+    BULK_CHUNK_SIZE, download_video_with_notification, get_video_path,
+    video_map
+)
+from yrp.download import close_youtube_dls
+from yrp.metrics import metrics
+from yrp.observer import Observable, Observer
+from yrp.progress import Progress, ProgressAggregator
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_USER = 100
+PRIORITY_PREFETCH = 0
+# Workers also look for jobs queued by other processes this often
+POLL_INTERVAL = 30
+# Seconds between writes of the progress of a running job
+PROGRESS_WRITE_INTERVAL = 1.0
+
+DownloadFunction = Callable[..., None]
+
+
+def is_process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobProgressObserver(Observer):
+    """Writes the downloaded fraction of a job to its row
+
+    Writes are limited to one every PROGRESS_WRITE_INTERVAL seconds, the
+    processes reading them poll about as often.
+    """
+
+    def __init__(self, observable: Observable, video_id: str) -> None:
+        super().__init__(observable)
+        self.video_id = video_id
+        self._last_write = -PROGRESS_WRITE_INTERVAL
+
+    def notify(self, observable: Observable, progress: Progress) -> None:
+        del observable
+        now = monotonic()
+        if (
+            progress.fraction is None
+            or now - self._last_write < PROGRESS_WRITE_INTERVAL
+        ):
+            return
+        self._last_write = now
+        # Progress is only shown, it is not worth failing the download for
+        try:
+            with db.Session.begin() as session:
+                session.execute(
+                    update(db.DownloadJob)
+                    .filter_by(video_id=self.video_id)
+                    .values(progress=progress.fraction)
+                )
+        except SQLAlchemyError as e:
+            logger.warning(
+                f"Could not write progress of {self.video_id}: {e!r}"
+            )
+
+
+class DownloadManager:
+    """Persistent priority queue of video downloads run by a worker pool
+
+    Jobs are stored in the database so that downloads interrupted by a crash
+    are queued again on the next start, where yt-dlp resumes the partial
+    files. Higher priorities are downloaded first, then older jobs. Jobs are
+    retried until they have failed download_config.max_attempts times, after
+    a delay that doubles with every failure. The UI and the daemon run
+    workers on the same queue, so whatever a job needs is stored in its
+    row, including the progress of its download.
+    """
+
+    def __init__(
+        self,
+        download_config: config.DownloadConfig,
+        download: DownloadFunction = download_video_with_notification,
+    ) -> None:
+        self.workers = download_config.workers
+        self.max_attempts = download_config.max_attempts
+        self.retry_delay = timedelta(
+            seconds=download_config.retry_delay_seconds
+        )
+        self.download = download
+        self._progress: dict[str, ProgressAggregator] = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._threads: list[Thread] = []
+
+    def enqueue(
+        self,
+        video_id: str,
+        priority: int = PRIORITY_USER,
+        with_notification: bool = False,
+    ) -> ProgressAggregator:
+        """Queue a download of video_id
+
+        Queuing a video again raises the priority of its job and gives a
+        failed job another round of attempts. Progress of the download is
+        reported to the observers of the returned aggregator when a worker
+        of this process runs it, and to get_job_progress in any case.
+        """
+        with self._lock:
+            progress = self.get_progress(video_id)
+        self.enqueue_many([video_id], priority, with_notification)
+        return progress
+
+    def enqueue_many(
+        self,
+        video_ids: Sequence[str],
+        priority: int = PRIORITY_USER,
+        with_notification: bool = False,
+    ) -> None:
+        """Queue downloads of video_ids in one transaction"""
+        if not video_ids:
+            return
+        now = datetime.now()
+        query = insert(db.DownloadJob)
+        job = query.excluded
+        with db.Session.begin() as session:
+            session.execute(
+                query.on_conflict_do_update(
+                    index_elements=[db.DownloadJob.video_id],
+                    set_=dict(
+                        priority=func.max(
+                            db.DownloadJob.priority,
+                            job.priority,
+                        ),
+                        with_notification=func.max(
+                            db.DownloadJob.with_notification,
+                            job.with_notification,
+                        ),
+                    ),
+                ),
+                [
+                    dict(
+                        video_id=video_id,
+                        priority=priority,
+                        created=now,
+                        with_notification=with_notification,
+                    )
+                    for video_id in video_ids
+                ],
+            )
+            for i in range(0, len(video_ids), BULK_CHUNK_SIZE):
+                session.execute(
+                    update(db.DownloadJob)
+                    .where(
+                        db.DownloadJob.video_id.in_(
+                            video_ids[i:i+BULK_CHUNK_SIZE]
+                        ),
+                        db.DownloadJob.state == "failed",
+                    )
+                    .values(
+                        state="queued",
+                        attempts=0,
+                        error=None,
+                        not_before=None,
+                    )
+                )
+        self._wakeup.set()
+
+    def get_job_states(self, video_ids: Sequence[str]) -> dict[str, str]:
+        """State of the jobs of video_ids, finished jobs are left out"""
+        job_states = {}
+        with db.Session() as session:
+            for i in range(0, len(video_ids), BULK_CHUNK_SIZE):
+                jobs = session.execute(
+                    select(db.DownloadJob.video_id, db.DownloadJob.state)
+                    .where(
+                        db.DownloadJob.video_id.in_(
+                            video_ids[i:i+BULK_CHUNK_SIZE]
+                        )
+                    )
+                )
+                for video_id, state in jobs:
+                    job_states[video_id] = state
+        return job_states
+
+    def get_job_progress(
+        self,
+        video_ids: Sequence[str],
+    ) -> dict[str, tuple[str, Optional[float]]]:
+        """State and downloaded fraction of the jobs of video_ids
+
+        Finished jobs are left out. The fraction is None until the worker
+        running the job, in this process or another, reports one.
+        """
+        job_progress = {}
+        with db.Session() as session:
+            for i in range(0, len(video_ids), BULK_CHUNK_SIZE):
+                jobs = session.execute(
+                    select(
+                        db.DownloadJob.video_id,
+                        db.DownloadJob.state,
+                        db.DownloadJob.progress,
+                    )
+                    .where(
+                        db.DownloadJob.video_id.in_(
+                            video_ids[i:i+BULK_CHUNK_SIZE]
+                        )
+                    )
+                )
+                for video_id, state, progress in jobs:
+                    job_progress[video_id] = (state, progress)
+        return job_progress
+
+    def get_progress(self, video_id: str) -> ProgressAggregator:
+        progress = self._progress.get(video_id)
+        if progress is None:
+            progress = ProgressAggregator(video_id)
+            self._progress[video_id] = progress
+        return progress
+
+    def claim(self) -> Optional[str]:
+        """Mark the next queued job as running and return its video id
+
+        Jobs of videos that are being downloaded, by a stream for instance,
+        wait until the download is over.
+        """
+        while True:
+            now = datetime.now()
+            with db.Session.begin() as session:
+                video_id = session.scalar(
+                    select(db.DownloadJob.video_id)
+                    .filter_by(state="queued")
+                    .where(
+                        or_(
+                            db.DownloadJob.not_before.is_(None),
+                            db.DownloadJob.not_before <= now,
+                        ),
+                        # Streamed videos are downloaded by the stream, the
+                        # job finds the file once it is done
+                        ~exists()
+                        .where(db.Video.id == db.DownloadJob.video_id)
+                        .where(db.Video.downloading),
+                    )
+                    .order_by(
+                        db.DownloadJob.priority.desc(),
+                        db.DownloadJob.created,
+                    )
+                    .limit(1)
+                )
+                if video_id is None:
+                    return None
+                # Another worker may have claimed the job in the meantime
+                claimed = session.execute(
+                    update(db.DownloadJob)
+                    .filter_by(video_id=video_id, state="queued")
+                    .values(
+                        state="running",
+                        pid=os.getpid(),
+                        attempts=db.DownloadJob.attempts + 1,
+                        progress=None,
+                    )
+                ).rowcount
+                if claimed:
+                    return video_id
+
+    def run_next(self) -> bool:
+        """Run the next queued job, return whether there was one"""
+        video_id = self.claim()
+        if video_id is None:
+            return False
+        with db.Session() as session:
+            with_notification = session.scalar(
+                select(db.DownloadJob.with_notification)
+                .filter_by(video_id=video_id)
+            )
+        with self._lock:
+            progress = self.get_progress(video_id)
+        error = None
+        if get_video_path(video_id).is_file():
+            logger.info(f"{video_id} is already downloaded")
+        else:
+            logger.info(f"Downloading {video_id}")
+            job_progress_observer = JobProgressObserver(progress, video_id)
+            try:
+                self.download(
+                    video_id,
+                    progress=progress,
+                    with_notification=bool(with_notification),
+                )
+            except Exception as e:
+                logger.warning(f"Could not download {video_id}: {e!r}")
+                error = repr(e)
+                progress.hook(dict(status="error"))
+            finally:
+                progress.unsubscribe(job_progress_observer)
+        self.finish(video_id, error)
+        metrics.export()
+        return True
+
+    def finish(self, video_id: str, error: Optional[str]) -> None:
+        with db.Session.begin() as session:
+            if error is None:
+                session.execute(
+                    delete(db.DownloadJob).filter_by(video_id=video_id)
+                )
+                with self._lock:
+                    self._progress.pop(video_id, None)
+                return
+            job = session.get(db.DownloadJob, video_id)
+            if job is None:
+                return
+            failed = job.attempts >= self.max_attempts
+            job.pid = None
+            job.error = error
+            job.progress = None
+            job.state = "failed" if failed else "queued"
+            delay = self.retry_delay * 2 ** (job.attempts - 1)
+            job.not_before = datetime.now() + delay
+        if failed:
+            with self._lock:
+                self._progress.pop(video_id, None)
+
+    def recover(self) -> None:
+        """Queue again the jobs of processes that died while running them
+
+        The downloading flag of videos without a running job is reset as
+        well, since it is left set when a download is interrupted.
+        """
+        with db.Session.begin() as session:
+            running_jobs = session.execute(
+                select(db.DownloadJob.video_id, db.DownloadJob.pid)
+                .filter_by(state="running")
+            ).all()
+            interrupted_video_ids = [
+                video_id
+                for video_id, pid in running_jobs
+                if pid is None
+                or pid == os.getpid()
+                or not is_process_alive(pid)
+            ]
+            if interrupted_video_ids:
+                logger.info(
+                    f"Requeuing {len(interrupted_video_ids)} interrupted"
+                    " downloads"
+                )
+                session.execute(
+                    update(db.DownloadJob)
+                    .where(db.DownloadJob.video_id.in_(interrupted_video_ids))
+                    .values(state="queued", pid=None)
+                )
+            reset_video_ids = session.scalars(
+                update(db.Video)
+                .where(
+                    db.Video.downloading,
+                    ~exists()
+                    .where(db.DownloadJob.video_id == db.Video.id)
+                    .where(db.DownloadJob.state == "running"),
+                )
+                .values(downloading=False)
+                .returning(db.Video.id)
+            ).all()
+        # Bulk writes bypass update_fields, so snapshots are updated here
+        for video_id in reset_video_ids:
+            video_map.apply(video_id, dict(downloading=False))
+
+    def start(self) -> None:
+        self.recover()
+        self._stopped.clear()
+        for i in range(self.workers):
+            thread = Thread(
+                target=self._work,
+                name=f"download-{i}",
+                daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self) -> None:
+        """Stop the workers once their current download is done"""
+        self._stopped.set()
+        self._wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        close_youtube_dls()
+
+    def _work(self) -> None:
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                if self.run_next():
+                    continue
+            except Exception as e:
+                logger.error(f"Download worker error: {e!r}")
+            self._wakeup.wait(POLL_INTERVAL)
+
+
+download_manager = DownloadManager(config.download_config)
@@ -0,0 +1,94 @@
+from collections.abc import Iterator
+from datetime import datetime
+from time import struct_time
+from typing import NotRequired, TypedDict
+from xml.etree.ElementTree import Element, XMLPullParser
+
+
+ATOM_NS = "{http://www.w3.org/2005/Atom}"
+YT_NS = "{http://www.youtube.com/xml/schemas/2015}"
+MEDIA_NS = "{http://search.yahoo.com/mrss/}"
+
+FEED_TAG = f"{ATOM_NS}feed"
+ENTRY_TAG = f"{ATOM_NS}entry"
+TITLE_TAG = f"{ATOM_NS}title"
+PUBLISHED_TAG = f"{ATOM_NS}published"
+VIDEO_ID_TAG = f"{YT_NS}videoId"
+DESCRIPTION_PATH = f"{MEDIA_NS}group/{MEDIA_NS}description"
+
+
+class Feed(TypedDict):
+    title: str
+
+
+class VideoEntry(TypedDict):
+    yt_videoid: str
+    title: str
+    published_parsed: struct_time
+    description: NotRequired[str]
+
+
+class ParsedFeed(TypedDict):
+    feed: Feed
+    entries: list[VideoEntry]
+
+
+class FeedValidators(TypedDict):
+    etag: str | None
+    last_modified: str | None
+    # SHA-256 of the body, for feeds served again without validators
+    content_hash: str | None
+
+
+def get_text(element: Element, tag: str) -> str:
+    child = element.find(tag)
+    if child is None or child.text is None:
+        raise ValueError(f"Feed entry is missing the {tag} element")
+    return child.text
+
+
+def make_video_entry(element: Element) -> VideoEntry:
+    published = datetime.fromisoformat(get_text(element, PUBLISHED_TAG))
+    return VideoEntry(
+        yt_videoid=get_text(element, VIDEO_ID_TAG),
+        title=get_text(element, TITLE_TAG),
+        published_parsed=published.utctimetuple(),
+        description=element.findtext(DESCRIPTION_PATH) or "",
+    )
+
+
+class FeedParser:
+    """Incremental parser for Youtube's Atom feeds
+
+    Bytes are fed as they arrive from the network and every entry is
+    returned as soon as its closing tag has been read, so the caller can stop
+    reading the response once it has seen everything it needs.
+    """
+
+    def __init__(self) -> None:
+        self._parser = XMLPullParser(events=("start", "end"))
+        self._root: Element | None = None
+        self._in_entry = False
+        self.title: str | None = None
+
+    def feed(self, data: bytes) -> Iterator[VideoEntry]:
+        self._parser.feed(data)
+        for event, element in self._parser.read_events():
+            assert isinstance(element, Element)
+            if event == "start":
+                if element.tag == FEED_TAG:
+                    self._root = element
+                elif element.tag == ENTRY_TAG:
+                    self._in_entry = True
+                continue
+            if element.tag == TITLE_TAG and not self._in_entry:
+                self.title = element.text
+            elif element.tag == ENTRY_TAG:
+                self._in_entry = False
+                yield make_video_entry(element)
+                # Entries are not needed once parsed
+                if self._root is not None:
+                    self._root.remove(element)
+
+    def close(self) -> None:
+        self._parser.close()
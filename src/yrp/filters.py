@@ -0,0 +1,66 @@
+from collections.abc import Sequence
+from typing import Optional, Pattern
+import re
+
+
+# Flags that can be scoped to a part of a regex with (?flags:...)
+SCOPED_FLAGS = {
+    re.IGNORECASE: "i",
+    re.MULTILINE: "m",
+    re.DOTALL: "s",
+}
+COMBINABLE_FLAGS = re.UNICODE | re.IGNORECASE | re.MULTILINE | re.DOTALL
+
+
+def get_anchored_source(pattern: Pattern[str]) -> Optional[str]:
+    """Source of a regex that matches where pattern.match does
+
+    The flags of pattern are scoped to it so it can be combined with other
+    patterns. Returns None for patterns whose groups would be renumbered or
+    whose flags cannot be scoped.
+    """
+    if pattern.groups or pattern.flags & ~COMBINABLE_FLAGS:
+        return None
+    flags = "".join(
+        letter for flag, letter in SCOPED_FLAGS.items() if pattern.flags & flag
+    )
+    source = f"(?{flags}:{pattern.pattern})" if flags else pattern.pattern
+    source = rf"\A(?:{source})"
+    try:
+        re.compile(source)
+    except re.error:
+        # Such as global inline flags in the middle of the pattern
+        return None
+    return source
+
+
+class TextMatcher:
+    """Whether a text contains any substring or starts with any pattern
+
+    Substrings and patterns are compiled into a single regex, so a text is
+    scanned once whatever the number of keywords. The few patterns that
+    cannot be combined are matched separately.
+    """
+
+    def __init__(
+        self,
+        substrings: Sequence[str] = (),
+        patterns: Sequence[Pattern[str]] = (),
+    ) -> None:
+        sources = [re.escape(substring) for substring in substrings]
+        self.patterns: list[Pattern[str]] = []
+        for pattern in patterns:
+            source = get_anchored_source(pattern)
+            if source is None:
+                self.patterns.append(pattern)
+            else:
+                sources.append(source)
+        self.regex = re.compile("|".join(sources)) if sources else None
+
+    def __bool__(self) -> bool:
+        return self.regex is not None or bool(self.patterns)
+
+    def __call__(self, text: str) -> bool:
+        if self.regex is not None and self.regex.search(text) is not None:
+            return True
+        return any(pattern.match(text) for pattern in self.patterns)
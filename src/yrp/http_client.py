@@ -0,0 +1,85 @@
+from collections.abc import Awaitable, Callable
+from dataclasses import asdict, dataclass
+from types import SimpleNamespace
+from typing import Any, Optional
+
+import aiohttp
+
+import yrp.config as config
+
+
+KEEPALIVE_TIMEOUT = 30
+DNS_CACHE_TTL = 300
+
+
+@dataclass
+class PoolStats:
+    requests: int = 0
+    connections_created: int = 0
+    connections_reused: int = 0
+    connections_queued: int = 0
+    dns_cache_hits: int = 0
+    dns_cache_misses: int = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return asdict(self)
+
+
+# Cumulative stats of every session created by create_http_session
+pool_stats = PoolStats()
+
+
+TraceCallback = Callable[
+    [aiohttp.ClientSession, SimpleNamespace, Any],
+    Awaitable[None],
+]
+
+
+def get_counter(attribute: str, stats: PoolStats) -> TraceCallback:
+    async def increment(
+        _session: aiohttp.ClientSession,
+        _ctx: SimpleNamespace,
+        _params: Any,
+    ) -> None:
+        setattr(stats, attribute, getattr(stats, attribute) + 1)
+    return increment
+
+
+def get_trace_config(stats: PoolStats) -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(get_counter("requests", stats))
+    trace_config.on_connection_create_end.append(
+        get_counter("connections_created", stats)
+    )
+    trace_config.on_connection_reuseconn.append(
+        get_counter("connections_reused", stats)
+    )
+    trace_config.on_connection_queued_start.append(
+        get_counter("connections_queued", stats)
+    )
+    trace_config.on_dns_cache_hit.append(get_counter("dns_cache_hits", stats))
+    trace_config.on_dns_cache_miss.append(
+        get_counter("dns_cache_misses", stats)
+    )
+    return trace_config
+
+
+def create_http_session(
+    stats: Optional[PoolStats] = None,
+) -> aiohttp.ClientSession:
+    """Create a session whose connections are kept alive and reused
+
+    The connector limits mirror the scheduler limits so that a request that
+    got a slot from the scheduler never waits for a connection.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=config.scheduler_config.max_concurrency,
+        limit_per_host=config.scheduler_config.max_concurrency_per_host,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DNS_CACHE_TTL,
+        use_dns_cache=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        trace_configs=[get_trace_config(stats or pool_stats)],
+    )
@@ -0,0 +1,178 @@
+import asyncio
+from collections.abc import Callable
+from dataclasses import dataclass, field
+from datetime import datetime
+from time import mktime
+from typing import Any, Optional
+import logging
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert
+
+import yrp.config as config
+from yrp import db as db
+from yrp.feed import FeedValidators, VideoEntry
+from yrp.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = 256
+
+
+@dataclass
+class FeedUpdate:
+    # An update with only a channel_id records a poll that found nothing
+    # new
+    channel_id: str
+    title: Optional[str] = None
+    entries: list[VideoEntry] = field(default_factory=list)
+    validators: Optional[FeedValidators] = None
+
+
+FeedUpdateQueue = asyncio.Queue[Optional[FeedUpdate]]
+# Receives the id and publication date of every video that was inserted
+IngestCallback = Callable[[dict[str, datetime]], None]
+
+
+def make_video_values(entry: VideoEntry, channel_id: str) -> dict[str, Any]:
+    timestamp = mktime(entry["published_parsed"])
+    return dict(
+        id=entry["yt_videoid"],
+        channel_id=channel_id,
+        title=entry["title"],
+        publication_dt=datetime.fromtimestamp(timestamp),
+    )
+
+
+def filter_entries(
+    channel_id: str,
+    entries: list[VideoEntry],
+) -> list[VideoEntry]:
+    channel_filters = (
+        config.global_filter,
+        config.channel_filters.get(channel_id),
+    )
+    for channel_filter in channel_filters:
+        if channel_filter is not None:
+            entries = channel_filter.filter_entries(entries)
+    return entries
+
+
+async def write_feed_updates(
+    feed_updates: list[FeedUpdate],
+) -> dict[str, datetime]:
+    """Write the data of several feeds in a single transaction
+
+    Returns the publication date of the videos that were not in the database
+    yet, keyed by video id. Updates of channels that are not in the database
+    anymore are dropped.
+    """
+    now = datetime.now()
+    new_videos = {}
+    with metrics.span("db_write", feeds=len(feed_updates)):
+        async with db.AsyncSession.begin() as sa_session:
+            # Channels removed by a config reload during the refresh are
+            # skipped rather than failing the writes of the whole batch
+            channel_ids = {
+                feed_update.channel_id for feed_update in feed_updates
+            }
+            existing_channel_ids = set(await sa_session.scalars(
+                select(db.Channel.id).where(db.Channel.id.in_(channel_ids))
+            ))
+            feed_updates = [
+                feed_update
+                for feed_update in feed_updates
+                if feed_update.channel_id in existing_channel_ids
+            ]
+            if not feed_updates:
+                return {}
+            video_values = []
+            for feed_update in feed_updates:
+                channel_id = feed_update.channel_id
+                for entry in filter_entries(channel_id, feed_update.entries):
+                    video_values.append(make_video_values(entry, channel_id))
+            channel_values = [
+                dict(
+                    id=feed_update.channel_id,
+                    title=feed_update.title,
+                    last_updated=now,
+                )
+                for feed_update in feed_updates
+                if feed_update.title is not None
+            ]
+            feed_cache_values = [
+                dict(
+                    channel_id=feed_update.channel_id,
+                    **feed_update.validators,
+                )
+                for feed_update in feed_updates
+                if feed_update.validators is not None
+            ]
+            if video_values:
+                inserted_ids = await sa_session.scalars(
+                    insert(db.Video)
+                    .on_conflict_do_nothing()
+                    .returning(db.Video.id),
+                    video_values,
+                )
+                publication_dts = {
+                    values["id"]: values["publication_dt"]
+                    for values in video_values
+                }
+                new_videos = {
+                    video_id: publication_dts[video_id]
+                    for video_id in inserted_ids
+                }
+            if channel_values:
+                # Bulk UPDATE by primary key, run as a single executemany
+                await sa_session.execute(update(db.Channel), channel_values)
+            # Every update is a successful poll, even without new entries
+            await sa_session.execute(
+                update(db.Channel)
+                .where(db.Channel.id.in_(existing_channel_ids))
+                .values(last_polled=now)
+            )
+            if feed_cache_values:
+                stmt = insert(db.FeedCache)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=[db.FeedCache.channel_id],
+                    set_=dict(
+                        etag=stmt.excluded.etag,
+                        last_modified=stmt.excluded.last_modified,
+                        content_hash=stmt.excluded.content_hash,
+                    ),
+                )
+                await sa_session.execute(stmt, feed_cache_values)
+    logger.debug(
+        f"Ingested {len(new_videos)} videos from {len(feed_updates)} feeds"
+    )
+    return new_videos
+
+
+async def ingest_feed_updates(
+    queue: FeedUpdateQueue,
+    on_ingested: Optional[IngestCallback] = None,
+    batch_size: int = INGEST_BATCH_SIZE,
+) -> None:
+    """Consume feed updates from the queue until None is received
+
+    Every update that is already waiting in the queue is written together
+    with the first one so concurrent fetches share a single writer
+    transaction instead of competing for the database lock.
+    """
+    finished = False
+    while not finished:
+        batch = [await queue.get()]
+        while len(batch) < batch_size and not queue.empty():
+            batch.append(queue.get_nowait())
+        feed_updates = [
+            feed_update
+            for feed_update in batch
+            if feed_update is not None
+        ]
+        finished = len(feed_updates) < len(batch)
+        if feed_updates:
+            new_videos = await write_feed_updates(feed_updates)
+            if new_videos and on_ingested is not None:
+                on_ingested(new_videos)
@@ -0,0 +1,276 @@
+from bisect import bisect_left
+from collections.abc import Iterator, Sequence
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from threading import Lock, Thread, get_ident
+from time import perf_counter
+from typing import TYPE_CHECKING, Any, Optional
+import heapq
+import json
+import logging
+import os
+
+import yrp.config as config
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+    from opentelemetry.trace import Tracer
+
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a thumbnail on a fast connection to the
+# download of a long video
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900
+)
+# Slowest observations kept for every stage with their attributes, which
+# is how the channels or videos behind a slow stage are found
+SLOWEST_COUNT = 10
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+Attribute = str | int | float
+
+
+@dataclass
+class Histogram:
+    buckets: Sequence[float]
+    # One count per bucket and one for the values above the last bucket
+    counts: list[int] = field(default_factory=list)
+    count: int = 0
+    total: float = 0
+    slowest: list[tuple[float, int, dict[str, Attribute]]] = field(
+        default_factory=list
+    )
+
+    def __post_init__(self) -> None:
+        if not self.counts:
+            self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value: float, attributes: dict[str, Attribute]) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        # The count breaks ties so that attributes are never compared
+        item = (value, self.count, attributes)
+        if len(self.slowest) < SLOWEST_COUNT:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def get_cumulative_counts(self) -> list[int]:
+        cumulative_counts = []
+        count = 0
+        for bucket_count in self.counts:
+            count += bucket_count
+            cumulative_counts.append(count)
+        return cumulative_counts
+
+
+def format_float(value: float) -> str:
+    return repr(float(value))
+
+
+class Metrics:
+    """Time and bytes spent in each stage of refreshes and downloads
+
+    Stages are timed with span and aggregated into histograms, without the
+    attributes such as channel or video ids as labels since every one
+    would be a new series. The attributes of the slowest observations of
+    each stage are kept instead. Spans are also reported to OpenTelemetry
+    once enable_opentelemetry succeeded.
+    """
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.histograms: dict[str, Histogram] = {}
+        self.bytes: dict[str, int] = {}
+        self.tracer: Optional["Tracer"] = None
+        # Name of the process in the JSON file name, set by start
+        self.process_name: Optional[str] = None
+        self._lock = Lock()
+        self._server: Optional["ThreadingHTTPServer"] = None
+
+    def observe(
+        self,
+        stage: str,
+        seconds: float,
+        **attributes: Attribute,
+    ) -> None:
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self.histograms[stage] = histogram
+            histogram.observe(seconds, attributes)
+
+    def add_bytes(self, stage: str, count: int) -> None:
+        with self._lock:
+            self.bytes[stage] = self.bytes.get(stage, 0) + count
+
+    @contextmanager
+    def span(self, stage: str, **attributes: Attribute) -> Iterator[None]:
+        with ExitStack() as stack:
+            if self.tracer is not None:
+                stack.enter_context(self.tracer.start_as_current_span(
+                    f"yrp.{stage}",
+                    attributes=attributes,
+                ))
+            start = perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(stage, perf_counter() - start, **attributes)
+
+    def to_prometheus(self) -> str:
+        lines = [
+            "# HELP yrp_stage_seconds Time spent in each stage",
+            "# TYPE yrp_stage_seconds histogram",
+        ]
+        with self._lock:
+            for stage, histogram in sorted(self.histograms.items()):
+                upper_bounds = [*map(format_float, self.buckets), "+Inf"]
+                cumulative_counts = histogram.get_cumulative_counts()
+                for upper_bound, count in zip(upper_bounds, cumulative_counts):
+                    lines.append(
+                        f'yrp_stage_seconds_bucket{{stage="{stage}",'
+                        f'le="{upper_bound}"}} {count}'
+                    )
+                lines.append(
+                    f'yrp_stage_seconds_sum{{stage="{stage}"}}'
+                    f" {format_float(histogram.total)}"
+                )
+                lines.append(
+                    f'yrp_stage_seconds_count{{stage="{stage}"}}'
+                    f" {histogram.count}"
+                )
+            lines.append("# HELP yrp_bytes_total Bytes read by each stage")
+            lines.append("# TYPE yrp_bytes_total counter")
+            for stage, count in sorted(self.bytes.items()):
+                lines.append(f'yrp_bytes_total{{stage="{stage}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def to_json(self) -> dict[str, Any]:
+        with self._lock:
+            stages = {
+                stage: dict(
+                    count=histogram.count,
+                    total_seconds=histogram.total,
+                    buckets=dict(zip(
+                        [*map(str, self.buckets), "+Inf"],
+                        histogram.get_cumulative_counts(),
+                    )),
+                    slowest=[
+                        dict(seconds=seconds, **attributes)
+                        for seconds, _, attributes
+                        in sorted(histogram.slowest, reverse=True)
+                    ],
+                )
+                for stage, histogram in sorted(self.histograms.items())
+            }
+            return dict(stages=stages, bytes=dict(sorted(self.bytes.items())))
+
+    def write_json(self, path: Path) -> None:
+        tmp_path = path.with_name(
+            f".{path.name}.{os.getpid()}.{get_ident()}.part"
+        )
+        tmp_path.write_text(json.dumps(self.to_json(), indent=2))
+        tmp_path.replace(path)
+
+    def get_json_path(self, json_file: Path) -> Path:
+        """Path of the JSON file of this process
+
+        The UI and the daemon each time their own work, so each writes its
+        own file instead of overwriting the other's.
+        """
+        if self.process_name is None:
+            return json_file
+        return json_file.with_name(
+            f"{json_file.stem}.{self.process_name}{json_file.suffix}"
+        )
+
+    def export(self) -> None:
+        """Write the metrics to the JSON file of the config, if any"""
+        json_file = config.metrics_config.json_file
+        if json_file is None:
+            return
+        json_file = self.get_json_path(json_file)
+        try:
+            self.write_json(json_file)
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {json_file}: {e!r}")
+
+    def serve(self, port: int) -> int:
+        """Serve the metrics in the Prometheus format on localhost
+
+        Returns the port the server listens on, any free one for port 0.
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        if self._server is not None:
+            return self._server.server_address[1]
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        Thread(
+            target=self._server.serve_forever,
+            name="metrics",
+            daemon=True,
+        ).start()
+        port = self._server.server_address[1]
+        logger.info(f"Serving metrics on http://127.0.0.1:{port}/metrics")
+        return port
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def enable_opentelemetry(self) -> bool:
+        """Report spans to the tracer provider set up by the application"""
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            logger.warning("OpenTelemetry is not installed, spans are local")
+            return False
+        self.tracer = trace.get_tracer("yrp")
+        return True
+
+    def start(
+        self,
+        metrics_config: Optional[config.MetricsConfig] = None,
+        process_name: Optional[str] = None,
+    ) -> None:
+        """Export the metrics as configured
+
+        Only the first process to start serves the Prometheus port, the
+        others log that it is taken and keep running.
+        """
+        if metrics_config is None:
+            metrics_config = config.metrics_config
+        self.process_name = process_name
+        port = metrics_config.prometheus_port
+        if port is not None:
+            try:
+                self.serve(port)
+            except OSError as e:
+                logger.error(f"Could not serve metrics on port {port}: {e!r}")
+        if metrics_config.opentelemetry:
+            self.enable_opentelemetry()
+
+
+metrics = Metrics()
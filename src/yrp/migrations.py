@@ -0,0 +1,201 @@
+from collections.abc import Callable
+from typing import Optional
+import logging
+
+from sqlalchemy import Connection, Engine, MetaData, Table, inspect, select
+from sqlalchemy import literal_column
+from sqlalchemy.schema import CreateTable
+
+
+logger = logging.getLogger(__name__)
+
+Migration = Callable[[Connection, MetaData], None]
+
+
+def get_user_version(connection: Connection) -> int:
+    return connection.exec_driver_sql("PRAGMA user_version").scalar_one()
+
+
+def set_user_version(connection: Connection, version: int) -> None:
+    connection.exec_driver_sql(f"PRAGMA user_version={int(version)}")
+
+
+def rebuild_table(
+    connection: Connection,
+    table: Table,
+    column_expressions: Optional[dict[str, str]] = None,
+) -> None:
+    """Alter a table to its definition in the metadata
+
+    SQLite can only add and rename columns in place, so the table is
+    created again under a temporary name, filled from the old one, then
+    swapped in and given its indexes. Columns missing from the old table
+    get their default unless column_expressions maps their name to an SQL
+    expression over the old columns.
+    """
+    if column_expressions is None:
+        column_expressions = {}
+    old_columns = inspect(connection).get_columns(table.name)
+    old_column_names = {column["name"] for column in old_columns}
+    tmp_table = table.to_metadata(MetaData(), name=f"_new_{table.name}")
+    tmp_table.indexes.clear()
+    connection.execute(CreateTable(tmp_table))
+    column_names = [
+        column.name
+        for column in table.columns
+        if column.name in column_expressions or column.name in old_column_names
+    ]
+    connection.execute(
+        tmp_table.insert().from_select(
+            column_names,
+            select(*(
+                literal_column(column_expressions.get(name, f'"{name}"'))
+                for name in column_names
+            )).select_from(Table(table.name, MetaData())),
+        )
+    )
+    connection.exec_driver_sql(f'DROP TABLE "{table.name}"')
+    connection.exec_driver_sql(
+        f'ALTER TABLE "{tmp_table.name}" RENAME TO "{table.name}"'
+    )
+    for index in table.indexes:
+        index.create(connection)
+
+
+def create_missing(connection: Connection, metadata: MetaData) -> None:
+    """Bring databases from before schema versions up to date
+
+    They were only ever created with create_all, so their tables are
+    current but later tables and indexes may be missing.
+    """
+    metadata.create_all(connection)
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+
+def create_channel_handle(connection: Connection, metadata: MetaData) -> None:
+    metadata.tables["channel_handle"].create(connection, checkfirst=True)
+
+
+def add_channel_last_polled(
+    connection: Connection,
+    metadata: MetaData,
+) -> None:
+    """Channels were polled at least when they were last updated"""
+    del metadata
+    column_names = {
+        column["name"] for column in inspect(connection).get_columns("channel")
+    }
+    if "last_polled" not in column_names:
+        connection.exec_driver_sql(
+            "ALTER TABLE channel ADD COLUMN last_polled DATETIME"
+        )
+    connection.exec_driver_sql(
+        "UPDATE channel SET last_polled = last_updated"
+        " WHERE last_polled IS NULL"
+    )
+
+
+def add_feed_cache_content_hash(
+    connection: Connection,
+    metadata: MetaData,
+) -> None:
+    if not inspect(connection).has_table("feed_cache"):
+        metadata.tables["feed_cache"].create(connection)
+        return
+    column_names = {
+        column["name"]
+        for column in inspect(connection).get_columns("feed_cache")
+    }
+    # Databases created before the hash was dropped still have it
+    if "content_hash" not in column_names:
+        connection.exec_driver_sql(
+            "ALTER TABLE feed_cache ADD COLUMN content_hash VARCHAR"
+        )
+
+
+def add_download_job_not_before(
+    connection: Connection,
+    metadata: MetaData,
+) -> None:
+    if not inspect(connection).has_table("download_job"):
+        metadata.tables["download_job"].create(connection)
+        return
+    column_names = {
+        column["name"]
+        for column in inspect(connection).get_columns("download_job")
+    }
+    # create_missing already made the table of unversioned databases
+    if "not_before" not in column_names:
+        connection.exec_driver_sql(
+            "ALTER TABLE download_job ADD COLUMN not_before DATETIME"
+        )
+
+
+def add_download_job_progress(
+    connection: Connection,
+    metadata: MetaData,
+) -> None:
+    column_names = {
+        column["name"]
+        for column in inspect(connection).get_columns("download_job")
+    }
+    if "with_notification" not in column_names:
+        connection.exec_driver_sql(
+            "ALTER TABLE download_job ADD COLUMN with_notification BOOLEAN"
+            " NOT NULL DEFAULT 0"
+        )
+    if "progress" not in column_names:
+        connection.exec_driver_sql(
+            "ALTER TABLE download_job ADD COLUMN progress FLOAT"
+        )
+
+
+# Append only: the schema version of a database is the number of
+# migrations applied to it
+MIGRATIONS: list[Migration] = [
+    create_missing,
+    create_channel_handle,
+    add_channel_last_polled,
+    add_feed_cache_content_hash,
+    add_download_job_not_before,
+    add_download_job_progress,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(engine: Engine, metadata: MetaData) -> None:
+    """Create or upgrade the schema of the database of engine
+
+    Migrations run in one immediate transaction, so processes starting at
+    the same time wait for each other and a failed migration leaves the
+    database untouched.
+    """
+    autocommit_engine = engine.execution_options(isolation_level="AUTOCOMMIT")
+    with autocommit_engine.connect() as connection:
+        if get_user_version(connection) == SCHEMA_VERSION:
+            return
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            version = get_user_version(connection)
+            if version > SCHEMA_VERSION:
+                raise RuntimeError(
+                    f"Database schema version {version} is newer than"
+                    f" {SCHEMA_VERSION}"
+                )
+            if version == 0 and not inspect(connection).get_table_names():
+                metadata.create_all(connection)
+                version = SCHEMA_VERSION
+            for i in range(version, SCHEMA_VERSION):
+                migration = MIGRATIONS[i]
+                logger.info(
+                    f"Migrating database to version {i + 1}:"
+                    f" {migration.__name__}"
+                )
+                migration(connection, metadata)
+            set_user_version(connection, SCHEMA_VERSION)
+        except BaseException:
+            connection.exec_driver_sql("ROLLBACK")
+            raise
+        connection.exec_driver_sql("COMMIT")
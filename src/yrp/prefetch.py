@@ -0,0 +1,161 @@
+from collections.abc import Sequence
+from datetime import datetime, time, timedelta
+from pathlib import Path
+from typing import Optional
+import logging
+
+from sqlalchemy import exists, func, select
+
+import yrp.config as config
+from yrp import db as db
+from yrp.backend import get_video_path
+from yrp.downloads import PRIORITY_PREFETCH, DownloadManager
+
+
+logger = logging.getLogger(__name__)
+
+
+def parse_time_window(time_window: str) -> tuple[time, time]:
+    start, end = time_window.split("-")
+    return time.fromisoformat(start), time.fromisoformat(end)
+
+
+def is_idle_time(now: datetime, time_windows: Sequence[str]) -> bool:
+    if not time_windows:
+        return True
+    now_time = now.time()
+    for time_window in time_windows:
+        start, end = parse_time_window(time_window)
+        # Windows such as 23:00-06:00 wrap around midnight
+        if start <= end:
+            if start <= now_time < end:
+                return True
+        elif now_time >= start or now_time < end:
+            return True
+    return False
+
+
+def get_directory_size(directory: Path) -> int:
+    return sum(
+        path.stat().st_size for path in directory.iterdir() if path.is_file()
+    )
+
+
+def query_watch_ratios() -> dict[str, float]:
+    """Share of the videos of each channel that were watched
+
+    The ratio is smoothed so that channels with little history rank in
+    the middle rather than at either end.
+    """
+    query = (
+        select(
+            db.Video.channel_id,
+            func.count(),
+            func.count().filter(db.Video.watched),
+        )
+        .group_by(db.Video.channel_id)
+    )
+    with db.Session() as session:
+        return {
+            channel_id: (watched_count + 1) / (video_count + 2)
+            for channel_id, video_count, watched_count
+            in session.execute(query)
+        }
+
+
+def get_cutoff(
+    now: datetime,
+    prefetch_config: config.PrefetchConfig,
+) -> datetime:
+    """Oldest publication date of the videos that are prefetched
+
+    Videos older than config.no_older_than are not listed and their files
+    are deleted by clean_assets, so prefetching them is never useful.
+    """
+    max_age = timedelta(days=prefetch_config.max_age_days)
+    return now - min(max_age, config.no_older_than)
+
+
+def get_candidates(
+    now: datetime,
+    prefetch_config: config.PrefetchConfig,
+) -> list[str]:
+    """Unwatched videos worth downloading ahead, most likely watched first
+
+    Videos are ranked by the watch ratio of their channel, decayed by their
+    age. Videos that are downloaded or already have a download job are left
+    out.
+    """
+    cutoff_dt = get_cutoff(now, prefetch_config)
+    half_life = timedelta(hours=prefetch_config.recency_half_life_hours)
+    watch_ratios = query_watch_ratios()
+    with db.Session() as session:
+        videos = session.execute(
+            select(db.Video.id, db.Video.channel_id, db.Video.publication_dt)
+            .where(
+                ~db.Video.watched,
+                db.Video.publication_dt > cutoff_dt,
+                ~exists().where(db.DownloadJob.video_id == db.Video.id),
+            )
+        ).all()
+    scores = {
+        video_id: (
+            watch_ratios.get(channel_id, 0.5)
+            * 0.5 ** ((now - publication_dt) / half_life)
+        )
+        for video_id, channel_id, publication_dt in videos
+        if not get_video_path(video_id).is_file()
+    }
+    return sorted(scores, key=scores.__getitem__, reverse=True)
+
+
+def count_ready_videos(cutoff_dt: datetime) -> int:
+    """Unwatched videos that are downloaded or waiting to be
+
+    Only the files of videos published after cutoff_dt are looked for.
+    """
+    with db.Session() as session:
+        video_ids = session.scalars(
+            select(db.Video.id)
+            .where(~db.Video.watched, db.Video.publication_dt > cutoff_dt)
+        ).all()
+        job_count = session.scalar(
+            select(func.count())
+            .select_from(db.DownloadJob)
+            .where(db.DownloadJob.state != "failed")
+        ) or 0
+    return job_count + sum(
+        get_video_path(video_id).is_file() for video_id in video_ids
+    )
+
+
+def prefetch(
+    download_manager: DownloadManager,
+    now: Optional[datetime] = None,
+    prefetch_config: Optional[config.PrefetchConfig] = None,
+) -> list[str]:
+    """Queue downloads of the videos most likely to be watched next
+
+    Nothing is queued outside of the idle windows or when the video
+    directory is over its quota. Returns the queued video ids.
+    """
+    if now is None:
+        now = datetime.now()
+    if prefetch_config is None:
+        prefetch_config = config.prefetch_config
+    if not is_idle_time(now, prefetch_config.idle_windows):
+        return []
+    max_bytes = prefetch_config.max_disk_gb * 2**30
+    if get_directory_size(config.video_dir) >= max_bytes:
+        logger.info("Not prefetching, the video directory is full")
+        return []
+    cutoff_dt = get_cutoff(now, prefetch_config)
+    slots = prefetch_config.max_videos - count_ready_videos(cutoff_dt)
+    if slots <= 0:
+        return []
+    video_ids = get_candidates(now, prefetch_config)[:slots]
+    for video_id in video_ids:
+        download_manager.enqueue(video_id, PRIORITY_PREFETCH)
+    if video_ids:
+        logger.info(f"Prefetching {len(video_ids)} videos")
+    return video_ids
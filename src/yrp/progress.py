@@ -0,0 +1,128 @@
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Optional
+
+import yrp.config as config
+from yrp.observer import Observable
+
+
+# Updates are sent at least this often while a download is running, so that
+# speed and ETA keep moving even when the progress barely does
+HEARTBEAT_INTERVAL = 1.0
+
+
+def parse_progress(download: dict[str, Any]) -> float | None:
+    """Downloaded fraction of the file in a yt-dlp progress hook dict"""
+    if download.get("status") == "finished":
+        return 1.0
+    if "fragment_count" in download and "fragment_index" in download:
+        fragment_count = download["fragment_count"] + 1
+        return min(1.0, download["fragment_index"] / fragment_count)
+    downloaded_bytes = download.get("downloaded_bytes")
+    total_bytes = (
+        download.get("total_bytes") or download.get("total_bytes_estimate")
+    )
+    if downloaded_bytes is None or not total_bytes:
+        return None
+    return min(1.0, downloaded_bytes / total_bytes)
+
+
+@dataclass(frozen=True)
+class Progress:
+    video_id: str
+    status: str
+    fraction: Optional[float] = None
+    # Bytes per second, averaged over the last updates
+    speed: Optional[float] = None
+    # Seconds left
+    eta: Optional[float] = None
+
+
+class ProgressAggregator(Observable):
+    """Coalesces the progress hooks of yt-dlp into Progress updates
+
+    hook is passed as a yt-dlp progress hook. Observers are notified with a
+    Progress at most progress_config.max_rate_hz times per second and only
+    when the fraction changed by progress_config.min_change, except for
+    status changes and a heartbeat every HEARTBEAT_INTERVAL seconds.
+    """
+
+    def __init__(
+        self,
+        video_id: str,
+        progress_config: Optional[config.ProgressConfig] = None,
+    ) -> None:
+        super().__init__()
+        if progress_config is None:
+            progress_config = config.progress_config
+        self.video_id = video_id
+        self.min_interval = 1 / progress_config.max_rate_hz
+        self.min_change = progress_config.min_change
+        self.smoothing = progress_config.speed_smoothing
+        self.last: Optional[Progress] = None
+        self._last_sent = -HEARTBEAT_INTERVAL
+        self._last_bytes: Optional[tuple[float, int]] = None
+        self._speed: Optional[float] = None
+
+    def hook(self, download: dict[str, Any]) -> None:
+        self.update(download, monotonic())
+
+    def update(self, download: dict[str, Any], now: float) -> None:
+        status = download.get("status", "downloading")
+        fraction = parse_progress(download)
+        self._update_speed(download.get("downloaded_bytes"), now)
+        progress = Progress(
+            video_id=self.video_id,
+            status=status,
+            fraction=fraction,
+            speed=self._speed,
+            eta=self._get_eta(download),
+        )
+        if self._should_send(progress, now):
+            self.last = progress
+            self._last_sent = now
+            self.notify_observers(progress)
+
+    def _should_send(self, progress: Progress, now: float) -> bool:
+        last = self.last
+        if last is None or progress.status != last.status:
+            return True
+        elapsed = now - self._last_sent
+        if elapsed >= HEARTBEAT_INTERVAL:
+            return True
+        if elapsed < self.min_interval or progress.fraction is None:
+            return False
+        if last.fraction is None:
+            return True
+        return abs(progress.fraction - last.fraction) >= self.min_change
+
+    def _update_speed(
+        self,
+        downloaded_bytes: Optional[int],
+        now: float,
+    ) -> None:
+        if downloaded_bytes is None:
+            return
+        last_bytes = self._last_bytes
+        self._last_bytes = (now, downloaded_bytes)
+        # The counter restarts for every file of a merged download
+        if last_bytes is None or downloaded_bytes < last_bytes[1]:
+            return
+        elapsed = now - last_bytes[0]
+        if elapsed <= 0:
+            return
+        speed = (downloaded_bytes - last_bytes[1]) / elapsed
+        if self._speed is None:
+            self._speed = speed
+        else:
+            self._speed += self.smoothing * (speed - self._speed)
+
+    def _get_eta(self, download: dict[str, Any]) -> Optional[float]:
+        downloaded_bytes = download.get("downloaded_bytes")
+        total_bytes = (
+            download.get("total_bytes")
+            or download.get("total_bytes_estimate")
+        )
+        if downloaded_bytes is None or not total_bytes or not self._speed:
+            return download.get("eta")
+        return max(0, total_bytes - downloaded_bytes) / self._speed
@@ -0,0 +1,172 @@
+import asyncio
+from collections.abc import AsyncIterator, Awaitable
+from contextlib import asynccontextmanager
+from time import perf_counter
+from typing import Any, Optional, TypeVar
+import logging
+import random
+
+import aiohttp
+from yarl import URL
+
+from yrp.config import SchedulerConfig
+from yrp.metrics import Attribute, metrics
+
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill: Optional[float] = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        if self._last_refill is not None:
+            elapsed = now - self._last_refill
+            self._tokens = min(
+                self.capacity,
+                self._tokens + elapsed * self.rate,
+            )
+        self._last_refill = now
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        # Waiters queue on the lock so that tokens are handed out in order
+        async with self._lock:
+            self._refill(loop.time())
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill(loop.time())
+            self._tokens -= 1
+
+
+def get_retry_after(resp: aiohttp.ClientResponse) -> Optional[float]:
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after is None:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        return None
+
+
+class Scheduler:
+    """Limit, rate limit and retry the HTTP requests of a refresh
+
+    Requests share a global concurrency limit and a concurrency limit and
+    token bucket per host. Responses with a status in RETRY_STATUSES and
+    connection errors are retried with jittered exponential backoff.
+    """
+
+    def __init__(self, scheduler_config: SchedulerConfig) -> None:
+        self.config = scheduler_config
+        self._semaphore = asyncio.Semaphore(scheduler_config.max_concurrency)
+        self._host_semaphores: dict[str, asyncio.Semaphore] = {}
+        self._host_buckets: dict[str, TokenBucket] = {}
+        self.failures: list[tuple[str, BaseException]] = []
+
+    def _get_host_semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._host_semaphores:
+            limit = self.config.max_concurrency_per_host
+            self._host_semaphores[host] = asyncio.Semaphore(limit)
+        return self._host_semaphores[host]
+
+    def _get_host_bucket(self, host: str) -> TokenBucket:
+        if host not in self._host_buckets:
+            self._host_buckets[host] = TokenBucket(
+                self.config.requests_per_second,
+                self.config.burst,
+            )
+        return self._host_buckets[host]
+
+    def get_backoff(self, attempt: int) -> float:
+        ceiling = self.config.backoff_base * 2 ** attempt
+        return random.uniform(0, min(self.config.backoff_max, ceiling))
+
+    @asynccontextmanager
+    async def request(
+        self,
+        http_session: aiohttp.ClientSession,
+        method: str,
+        url: str,
+        stage: Optional[str] = None,
+        attributes: Optional[dict[str, Attribute]] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Send a request once there are slots and a token for its host
+
+        The time spent waiting for them is recorded as the scheduler_wait
+        stage. When stage is given, the time from then until the response
+        headers arrive is recorded as stage with attributes.
+        """
+        if attributes is None:
+            attributes = {}
+        host = URL(url).host or ""
+        host_semaphore = self._get_host_semaphore(host)
+        host_bucket = self._get_host_bucket(host)
+        attempt = 0
+        while True:
+            backoff = self.get_backoff(attempt)
+            start = perf_counter()
+            # A request waiting for its host does not hold a global slot
+            # that requests to other hosts could use
+            async with host_semaphore, self._semaphore:
+                await host_bucket.acquire()
+                metrics.observe(
+                    "scheduler_wait",
+                    perf_counter() - start,
+                    host=host,
+                )
+                start = perf_counter()
+                try:
+                    resp = await http_session.request(method, url, **kwargs)
+                except (aiohttp.ClientConnectionError, TimeoutError) as e:
+                    if attempt >= self.config.max_retries:
+                        raise
+                    logger.debug(f"Retrying {url} after {e!r}")
+                else:
+                    if stage is not None:
+                        metrics.observe(
+                            stage,
+                            perf_counter() - start,
+                            **attributes,
+                        )
+                    if (
+                        resp.status not in RETRY_STATUSES
+                        or attempt >= self.config.max_retries
+                    ):
+                        # The slots are held while the body is being read
+                        try:
+                            yield resp
+                        finally:
+                            resp.release()
+                        return
+                    logger.debug(f"Retrying {url} after status {resp.status}")
+                    retry_after = get_retry_after(resp)
+                    # A long Retry-After would stall the whole refresh
+                    if retry_after is not None:
+                        backoff = min(retry_after, self.config.backoff_max)
+                    resp.release()
+            attempt += 1
+            await asyncio.sleep(backoff)
+
+    async def isolate(self, name: str, aw: Awaitable[T]) -> Optional[T]:
+        """Await aw logging its exception instead of propagating it
+
+        Used to wrap the tasks of a TaskGroup so that a single failure does
+        not cancel the tasks that are still running.
+        """
+        try:
+            return await aw
+        except Exception as e:
+            logger.warning(f"{name} failed: {e!r}")
+            self.failures.append((name, e))
+            return None
@@ -0,0 +1,174 @@
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from subprocess import DEVNULL, PIPE, Popen
+from threading import Thread
+from typing import IO, Optional
+import logging
+import os
+import sys
+
+from yrp.backend import (
+    VIDEO_FORMAT, get_video_path, start_downloading, update_fields
+)
+from yrp.download import default_options, get_video_url, info_cache
+from yrp.downloads import download_manager
+
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 2**16
+PLAYER_COMMAND = (
+    "mpv",
+    "--keepaspect-window",
+    "--geometry=70%",
+    "--no-terminal",
+    "--cursor-autohide=no",
+)
+
+
+def get_player_command(source: str) -> tuple[str, ...]:
+    return (*PLAYER_COMMAND, source)
+
+
+def get_download_command(video_id: str) -> tuple[str, ...]:
+    """yt-dlp command writing the merged video of video_id to stdout"""
+    info_path = info_cache.get_path(video_id)
+    if info_cache.get(video_id) is not None:
+        source = ("--load-info-json", str(info_path))
+    else:
+        source = (get_video_url(video_id=video_id),)
+    return (
+        sys.executable,
+        "-m",
+        "yt_dlp",
+        "--quiet",
+        "--no-progress",
+        "--format",
+        str(default_options["format"]),
+        "--merge-output-format",
+        VIDEO_FORMAT,
+        "--output",
+        "-",
+        *source,
+    )
+
+
+def close_pipe(pipe: IO[bytes]) -> None:
+    try:
+        pipe.close()
+    except BrokenPipeError:
+        pass
+
+
+class VideoStream:
+    """Plays a video while it is downloaded
+
+    yt-dlp writes the video to a pipe that is copied both to the stdin of
+    the player and to a partial file. The partial file replaces path once
+    the download succeeds, even if the player was closed before the end.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        download_command: Sequence[str],
+        player_command: Sequence[str],
+    ) -> None:
+        self.path = path
+        self.tmp_path = path.with_name(f"{path.name}.{os.getpid()}.part")
+        self.download_command = download_command
+        self.player_command = player_command
+
+    def run(self) -> bool:
+        """Stream the video, return whether it was downloaded entirely"""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        downloader: Optional[Popen[bytes]] = None
+        player: Optional[Popen[bytes]] = None
+        return_code = None
+        try:
+            downloader = Popen(self.download_command, stdout=PIPE)
+            player = Popen(self.player_command, stdin=PIPE, stdout=DEVNULL)
+            if downloader.stdout is None or player.stdin is None:
+                raise TypeError
+            with self.tmp_path.open("wb") as file:
+                self._copy(downloader.stdout, file, player.stdin)
+        except BaseException:
+            for process in (downloader, player):
+                if process is not None:
+                    process.kill()
+            self.tmp_path.unlink(missing_ok=True)
+            raise
+        finally:
+            if player is not None:
+                if player.stdin is not None:
+                    close_pipe(player.stdin)
+                # The player keeps playing what it was sent, it is reaped in
+                # the background instead of lingering as a zombie
+                Thread(
+                    target=player.wait,
+                    name=f"player-{self.path.name}",
+                    daemon=True,
+                ).start()
+            if downloader is not None:
+                return_code = downloader.wait()
+        if return_code != 0:
+            logger.warning(f"Streaming {self.path.name} failed")
+            self.tmp_path.unlink(missing_ok=True)
+            return False
+        self.tmp_path.replace(self.path)
+        return True
+
+    def _copy(
+        self,
+        source: IO[bytes],
+        file: IO[bytes],
+        player_stdin: IO[bytes],
+    ) -> None:
+        while chunk := source.read(CHUNK_SIZE):
+            file.write(chunk)
+            if player_stdin.closed:
+                continue
+            try:
+                player_stdin.write(chunk)
+                player_stdin.flush()
+            except BrokenPipeError:
+                # The player was closed, keep downloading for later replays
+                close_pipe(player_stdin)
+
+
+def stream_video(
+    video_id: str,
+    on_finished: Optional[Callable[[bool], None]] = None,
+) -> Optional[Thread]:
+    """Start playing video_id while downloading it into the video directory
+
+    on_finished is called from the streaming thread with whether the video
+    was downloaded entirely. Nothing is started when the video is already
+    being downloaded or streamed, by this process or another, or when the
+    download manager has a job for it, since both would download it.
+    """
+    job_state = download_manager.get_job_states([video_id]).get(video_id)
+    if job_state in ("queued", "running"):
+        logger.info(f"Not streaming {video_id}, its download is {job_state}")
+        return None
+    # Set before the thread starts so that a second request is refused
+    if not start_downloading(video_id):
+        logger.info(f"Not streaming {video_id}, it is being downloaded")
+        return None
+    stream = VideoStream(
+        get_video_path(video_id),
+        get_download_command(video_id),
+        get_player_command("-"),
+    )
+
+    def run() -> None:
+        try:
+            downloaded = stream.run()
+        finally:
+            update_fields(video_id, downloading=False)
+        if on_finished is not None:
+            on_finished(downloaded)
+
+    thread = Thread(target=run, name=f"stream-{video_id}", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,240 @@
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Optional
+import logging
+import struct
+
+from yrp.observer import Observable, Observer
+from yrp.thumbnails import thumbnail_cache
+
+import gi
+gi.require_version('Gdk', '4.0')
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import Gdk, GdkPixbuf, GLib
+
+
+logger = logging.getLogger(__name__)
+
+TEXTURE_WIDTH = 320
+TEXTURE_HEIGHT = 180
+MAX_TEXTURES = 512
+DECODE_WORKERS = 2
+
+# Scaled thumbnails are stored next to the original as raw pixels so that
+# loading them in a later session does not need to decode anything
+RAW_HEADER = struct.Struct("<4sIII?")
+RAW_MAGIC = b"YRPT"
+
+TextureCallback = Callable[[Gdk.Texture], None]
+
+
+def get_variant_name(width: int, height: int) -> str:
+    return f"{width}x{height}.raw"
+
+
+def write_raw_texture(path: Path, pixbuf: GdkPixbuf.Pixbuf) -> None:
+    header = RAW_HEADER.pack(
+        RAW_MAGIC,
+        pixbuf.get_width(),
+        pixbuf.get_height(),
+        pixbuf.get_rowstride(),
+        pixbuf.get_has_alpha(),
+    )
+    tmp_path = path.with_name(f".{path.name}.part")
+    with tmp_path.open("wb") as f:
+        f.write(header)
+        f.write(pixbuf.read_pixel_bytes().get_data())
+    tmp_path.replace(path)
+
+
+def read_raw_texture(path: Path) -> Gdk.Texture:
+    data = path.read_bytes()
+    magic, width, height, rowstride, has_alpha = RAW_HEADER.unpack_from(data)
+    if magic != RAW_MAGIC:
+        raise ValueError(f"{path} is not a raw texture")
+    memory_format = (
+        Gdk.MemoryFormat.R8G8B8A8 if has_alpha else Gdk.MemoryFormat.R8G8B8
+    )
+    pixels = GLib.Bytes.new(data[RAW_HEADER.size:])
+    return Gdk.MemoryTexture.new(
+        width,
+        height,
+        memory_format,
+        pixels,
+        rowstride,
+    )
+
+
+class TextureCache:
+    """Thumbnails decoded and scaled off the GTK main loop
+
+    Textures are kept in memory in LRU order and their pixels are persisted
+    next to the thumbnail so that they are not decoded again in later
+    sessions. Callbacks are always run on the main loop. The callbacks of
+    a video without a thumbnail are kept until invalidate is called, which
+    ThumbnailObserver does once the thumbnail is downloaded.
+    """
+
+    def __init__(
+        self,
+        width: int = TEXTURE_WIDTH,
+        height: int = TEXTURE_HEIGHT,
+        max_textures: int = MAX_TEXTURES,
+    ) -> None:
+        self.width = width
+        self.height = height
+        self.max_textures = max_textures
+        self._textures: OrderedDict[str, Gdk.Texture] = OrderedDict()
+        # Waiting callbacks are keyed by their owner, so that an owner only
+        # ever waits for one texture
+        self._pending: dict[str, dict[Hashable, TextureCallback]] = {}
+        # Callbacks of the videos that could not be loaded
+        self._missing: dict[str, dict[Hashable, TextureCallback]] = {}
+        self._owner_video_ids: dict[Hashable, str] = {}
+        # Videos invalidated while they were being loaded
+        self._stale: set[str] = set()
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=DECODE_WORKERS,
+            thread_name_prefix="texture-decode",
+        )
+
+    def request(
+        self,
+        video_id: str,
+        callback: TextureCallback,
+        owner: Optional[Hashable] = None,
+    ) -> None:
+        """Call callback with the texture of video_id once it is loaded
+
+        A request replaces any callback its owner, such as a recycled
+        widget, is still waiting with, whatever the video of that callback.
+        Requests without an owner are all kept.
+        """
+        key = object() if owner is None else owner
+        with self._lock:
+            self._forget(key)
+            texture = self._textures.get(video_id)
+            if texture is not None:
+                self._textures.move_to_end(video_id)
+            else:
+                self._owner_video_ids[key] = video_id
+                if video_id in self._pending:
+                    self._pending[video_id][key] = callback
+                    return
+                if video_id in self._missing:
+                    self._missing[video_id][key] = callback
+                    return
+                self._pending[video_id] = {key: callback}
+        if texture is not None:
+            callback(texture)
+            return
+        self._submit(video_id)
+
+    def _forget(self, key: Hashable) -> None:
+        video_id = self._owner_video_ids.pop(key, None)
+        if video_id is None:
+            return
+        self._pending.get(video_id, {}).pop(key, None)
+        missing = self._missing.get(video_id)
+        if missing is not None:
+            missing.pop(key, None)
+            if not missing:
+                del self._missing[video_id]
+
+    def _submit(self, video_id: str) -> None:
+        future = self._executor.submit(self._load, video_id)
+        future.add_done_callback(
+            lambda future: self._on_loaded(video_id, future)
+        )
+
+    def _load(self, video_id: str) -> Optional[Gdk.Texture]:
+        thumbnail_path = thumbnail_cache.get(video_id)
+        if thumbnail_path is None:
+            return None
+        variant_path = thumbnail_cache.get_variant_path(
+            thumbnail_path.stem,
+            get_variant_name(self.width, self.height),
+        )
+        if variant_path.is_file():
+            try:
+                return read_raw_texture(variant_path)
+            except (ValueError, struct.error, GLib.Error):
+                logger.warning(f"Discarding corrupt texture {variant_path}")
+                variant_path.unlink(missing_ok=True)
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+            str(thumbnail_path),
+            self.width,
+            self.height,
+            True,
+        )
+        write_raw_texture(variant_path, pixbuf)
+        return Gdk.Texture.new_for_pixbuf(pixbuf)
+
+    def _on_loaded(
+        self,
+        video_id: str,
+        future: Future[Optional[Gdk.Texture]],
+    ) -> None:
+        try:
+            texture = future.result()
+        except Exception as e:
+            logger.warning(f"Could not load thumbnail of {video_id}: {e!r}")
+            texture = None
+        with self._lock:
+            # The load may have read the thumbnail before it changed
+            reload = video_id in self._stale
+            self._stale.discard(video_id)
+            callbacks = {} if reload else self._pending.pop(video_id, {})
+            if texture is None:
+                if callbacks:
+                    self._missing.setdefault(video_id, {}).update(callbacks)
+            elif not reload:
+                for key in callbacks:
+                    self._owner_video_ids.pop(key, None)
+                self._textures[video_id] = texture
+                while len(self._textures) > self.max_textures:
+                    self._textures.popitem(last=False)
+        if reload:
+            self._submit(video_id)
+            return
+        if texture is None:
+            return
+        for callback in callbacks.values():
+            GLib.idle_add(callback, texture)
+
+    def invalidate(self, video_id: str) -> None:
+        """Drop the texture of video_id and reload it for waiting callers"""
+        with self._lock:
+            self._textures.pop(video_id, None)
+            if video_id in self._pending:
+                self._stale.add(video_id)
+                return
+            callbacks = self._missing.pop(video_id, None)
+            if not callbacks:
+                return
+            self._pending[video_id] = callbacks
+        self._submit(video_id)
+
+
+class ThumbnailObserver(Observer):
+    """Invalidates the textures of the thumbnails that changed"""
+
+    def __init__(
+        self,
+        observable: Observable,
+        texture_cache: TextureCache,
+    ) -> None:
+        super().__init__(observable)
+        self.texture_cache = texture_cache
+
+    def notify(self, observable: Observable, video_id: str) -> None:
+        del observable
+        self.texture_cache.invalidate(video_id)
+
+
+texture_cache = TextureCache()
+ThumbnailObserver(thumbnail_cache, texture_cache)
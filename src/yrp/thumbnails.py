@@ -0,0 +1,242 @@
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional
+import hashlib
+import logging
+import os
+
+from sqlalchemy import Select, delete, exists, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+import yrp.config as config
+from yrp import db as db
+from yrp.observer import Observable
+
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_FORMAT = "jpg"
+# Access times are only written when older than this to avoid turning every
+# lookup into a write
+TOUCH_INTERVAL = timedelta(hours=1)
+STALE_PART_AGE = timedelta(hours=1)
+DELETE_CHUNK_SIZE = 500
+
+
+def get_file_digest(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+class ThumbnailCache(Observable):
+    """Content-addressed thumbnail store with a size and age budget
+
+    Files are named after the SHA-256 of their content so identical images
+    are only stored once. The index in the database maps video ids to
+    digests and keeps the size and last access time of every file, which is
+    what eviction works from instead of walking the directory. Observers
+    are notified with the id of every video whose thumbnail was added or
+    discarded.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        cache_config: config.ThumbnailCacheConfig,
+    ) -> None:
+        super().__init__()
+        self.directory = directory
+        self.max_bytes = int(cache_config.max_size_mb * 2**20)
+        self.max_age = timedelta(days=cache_config.max_age_days)
+
+    def get_blob_path(self, digest: str) -> Path:
+        return self.directory / digest[:2] / f"{digest}.{THUMBNAIL_FORMAT}"
+
+    def get_variant_path(self, digest: str, variant: str) -> Path:
+        """Path for data derived from a thumbnail, evicted along with it"""
+        return self.directory / digest[:2] / f"{digest}.{variant}"
+
+    def get_tmp_path(self, video_id: str) -> Path:
+        return self.directory / f".{video_id}.{os.getpid()}.part"
+
+    def get(self, video_id: str) -> Optional[Path]:
+        now = datetime.now()
+        # Lookups run for every card, only the rare writes take the lock
+        with db.Session() as session:
+            row = session.execute(
+                select(db.ThumbnailBlob.digest, db.ThumbnailBlob.last_access)
+                .join(db.Thumbnail)
+                .where(db.Thumbnail.video_id == video_id)
+            ).one_or_none()
+        if row is None:
+            return None
+        digest, last_access = row
+        path = self.get_blob_path(digest)
+        if not path.is_file():
+            with db.Session.begin() as session:
+                self._remove_blobs(session, [digest])
+            return None
+        if now - last_access > TOUCH_INTERVAL:
+            with db.Session.begin() as session:
+                session.execute(
+                    update(db.ThumbnailBlob)
+                    .where(db.ThumbnailBlob.digest == digest)
+                    .values(last_access=now)
+                )
+        return path.absolute()
+
+    def __contains__(self, video_id: str) -> bool:
+        return self.get(video_id) is not None
+
+    def add(
+        self,
+        video_id: str,
+        path: Path,
+        digest: Optional[str] = None,
+    ) -> Path:
+        """Move the file at path into the cache as the thumbnail of video_id"""
+        if digest is None:
+            digest = get_file_digest(path)
+        blob_path = self.get_blob_path(digest)
+        now = datetime.now()
+        # Decided from the file alone, without reading the database first,
+        # so that threads adding the same image never upgrade a read
+        # transaction or insert the same row twice
+        if blob_path.is_file():
+            path.unlink()
+        else:
+            blob_path.parent.mkdir(exist_ok=True)
+            os.replace(path, blob_path)
+        blob_query = insert(db.ThumbnailBlob).values(
+            digest=digest,
+            size=blob_path.stat().st_size,
+            last_access=now,
+        )
+        thumbnail_query = insert(db.Thumbnail).values(
+            video_id=video_id,
+            digest=digest,
+        )
+        with db.Session.begin() as session:
+            session.execute(blob_query.on_conflict_do_update(
+                index_elements=[db.ThumbnailBlob.digest],
+                set_=dict(last_access=now),
+            ))
+            session.execute(thumbnail_query.on_conflict_do_update(
+                index_elements=[db.Thumbnail.video_id],
+                set_=dict(digest=digest),
+            ))
+        self.notify_observers(video_id)
+        return blob_path.absolute()
+
+    def discard(self, video_id: str) -> None:
+        self.discard_many([video_id])
+
+    def discard_many(self, video_ids: Sequence[str]) -> None:
+        """Drop the thumbnails of video_ids, and the files nothing else uses"""
+        with db.Session.begin() as session:
+            for i in range(0, len(video_ids), DELETE_CHUNK_SIZE):
+                chunk = video_ids[i:i+DELETE_CHUNK_SIZE]
+                digests = session.scalars(
+                    delete(db.Thumbnail)
+                    .where(db.Thumbnail.video_id.in_(chunk))
+                    .returning(db.Thumbnail.digest)
+                ).all()
+                orphan_digests = session.scalars(
+                    select(db.ThumbnailBlob.digest)
+                    .where(db.ThumbnailBlob.digest.in_(set(digests)))
+                    .where(
+                        ~exists()
+                        .where(db.Thumbnail.digest == db.ThumbnailBlob.digest)
+                    )
+                ).all()
+                self._remove_blobs(session, orphan_digests)
+        for video_id in video_ids:
+            self.notify_observers(video_id)
+
+    def retain(self, video_ids: Select[tuple[str]]) -> None:
+        """Drop the thumbnails of every video not selected by video_ids"""
+        with db.Session.begin() as session:
+            session.execute(
+                delete(db.Thumbnail)
+                .where(db.Thumbnail.video_id.not_in(video_ids))
+            )
+            orphan_digests = session.scalars(
+                select(db.ThumbnailBlob.digest)
+                .where(
+                    ~exists()
+                    .where(db.Thumbnail.digest == db.ThumbnailBlob.digest)
+                )
+            ).all()
+            self._remove_blobs(session, orphan_digests)
+
+    def evict(self) -> None:
+        """Drop expired thumbnails, then the least recently used ones
+
+        Least recently used thumbnails are dropped until the cache fits in
+        its size budget.
+        """
+        cutoff_dt = datetime.now() - self.max_age
+        with db.Session.begin() as session:
+            expired_digests = session.scalars(
+                select(db.ThumbnailBlob.digest)
+                .where(db.ThumbnailBlob.last_access < cutoff_dt)
+            ).all()
+            self._remove_blobs(session, expired_digests)
+            total_bytes = session.scalar(
+                select(func.coalesce(func.sum(db.ThumbnailBlob.size), 0))
+            )
+            if total_bytes is None or total_bytes <= self.max_bytes:
+                return
+            lru_blobs = session.execute(
+                select(db.ThumbnailBlob.digest, db.ThumbnailBlob.size)
+                .order_by(db.ThumbnailBlob.last_access)
+            )
+            evicted_digests = []
+            for digest, size in lru_blobs:
+                if total_bytes <= self.max_bytes:
+                    break
+                evicted_digests.append(digest)
+                total_bytes -= size
+            logger.info(f"Evicting {len(evicted_digests)} thumbnails")
+            self._remove_blobs(session, evicted_digests)
+
+    def adopt_loose_files(self) -> None:
+        """Index thumbnails stored as {video_id}.jpg by older versions
+
+        Stale partial downloads and unknown files are removed as well.
+        """
+        stale_dt = datetime.now() - STALE_PART_AGE
+        for path in self.directory.iterdir():
+            if not path.is_file():
+                continue
+            if path.name.startswith("."):
+                mtime = datetime.fromtimestamp(path.stat().st_mtime)
+                if path.suffix == ".part" and mtime < stale_dt:
+                    path.unlink()
+            elif path.suffix == f".{THUMBNAIL_FORMAT}":
+                self.add(path.stem, path)
+            else:
+                path.unlink()
+
+    def _remove_blobs(self, session: Session, digests: Sequence[str]) -> None:
+        for i in range(0, len(digests), DELETE_CHUNK_SIZE):
+            chunk = digests[i:i+DELETE_CHUNK_SIZE]
+            session.execute(
+                delete(db.Thumbnail).where(db.Thumbnail.digest.in_(chunk))
+            )
+            session.execute(
+                delete(db.ThumbnailBlob)
+                .where(db.ThumbnailBlob.digest.in_(chunk))
+            )
+        for digest in digests:
+            blob_path = self.get_blob_path(digest)
+            for path in blob_path.parent.glob(f"{digest}.*"):
+                path.unlink(missing_ok=True)
+
+
+thumbnail_cache = ThumbnailCache(
+    config.thumbnail_dir,
+    config.thumbnail_cache_config,
+)
@@ -1,24 +1,34 @@
 from datetime import datetime
+from functools import partial
 from subprocess import Popen
-from threading import Thread
+from threading import Lock, Thread
 from time import sleep
 from dateutil.relativedelta import relativedelta
-from typing import Any
+from typing import Any, Optional
 import asyncio
+import logging
 
 from yrp.observer import Observer, Observable
-from yrp.download import parse_progress
 from yrp.backend import (
-        Video, get_videos, create_video, update_channels, fetch_feeds
+        NewVideoEvent, Video, apply_config_delta, get_videos, create_video
 )
-import yrp.config as config
+from yrp.config_watcher import ConfigDelta, config_watcher
+from yrp.downloads import download_manager
+from yrp.metrics import metrics
+from yrp.stream import get_player_command, stream_video
+from yrp.textures import texture_cache
 import gi
 gi.require_version('Gtk', '4.0')
 gi.require_version('Adw', '1')
 gi.require_version("Notify", "0.7")
-from gi.repository import Gtk, Gdk, Adw, GLib
+from gi.repository import Gtk, Gdk, Adw, Gio, GLib, GObject
 
 
+logger = logging.getLogger(__name__)
+
+# Seconds between reads of the progress of the downloads shown
+PROGRESS_POLL_INTERVAL = 1.0
+
 css_provider = Gtk.CssProvider()
 css_provider.load_from_path('style.css')
 display = Gdk.Display.get_default()
@@ -43,77 +53,278 @@ def get_time_ago(date_time: datetime) -> str:
     return "1 min ago"
 
 
-class VideoCard(Gtk.ListBoxRow):
-    def __init__(self, video: Video, *args: Any, **kwargs: Any):
-        super().__init__(*args, **kwargs)
+class VideoItem(GObject.Object):
+    """Item of the video list model
+
+    Only holds data: the widgets showing it are recycled by the list view.
+    """
+
+    progress = GObject.Property(type=float, default=0)
+
+    def __init__(self, video: Video) -> None:
+        super().__init__()
         self.video = video
+        self.progress = 1 if video.downloaded else 0
 
-        self.revealer = Gtk.Revealer()
-        self.revealer.set_transition_type(Gtk.RevealerTransitionType.CROSSFADE)
-        self.revealer.set_transition_duration(2000)
-        self.set_child(self.revealer)
 
-        grid = Gtk.Grid()
-        grid.props.width_request = 300
-        self.revealer.set_child(grid)
+class VideoCard(Gtk.Grid):
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.video_id: Optional[str] = None
+        self.progress_binding: Optional[GObject.Binding] = None
+        self.props.width_request = 300
 
-        img = Gtk.Picture.new_for_filename(str(video.thumbnail_path))
-        img.props.halign = Gtk.Align.START
-        img.props.can_shrink = False
-        grid.attach(child=img, column=1, row=1, width=1, height=4)
-        title = (
-            video.title
-            .replace("&", "&amp;")
-            .replace("<", "&lt;")
-            .replace(">", "&gt;")
-         )
-        title_label = Gtk.Label(
-            label=rf'<span weight="bold" size="x-large">{title}</span>',
+        self.img = Gtk.Picture()
+        self.img.set_size_request(texture_cache.width, texture_cache.height)
+        self.img.props.halign = Gtk.Align.START
+        self.img.props.can_shrink = False
+        self.attach(child=self.img, column=1, row=1, width=1, height=4)
+        self.title_label = Gtk.Label(
             use_markup=True,
             halign=Gtk.Align.START,
             vexpand=True,
             margin_start=10,
         )
-        grid.attach(child=title_label, column=2, row=1, width=1, height=1) 
-        channel_label = Gtk.Label(
-            label=video.channel_title,
+        self.attach(child=self.title_label, column=2, row=1, width=1, height=1)
+        self.channel_label = Gtk.Label(
             halign=Gtk.Align.START,
             vexpand=True,
             margin_start=10,
         )
-        grid.attach(child=channel_label, column=2, row=2, width=1, height=1) 
-        time_ago = get_time_ago(video.publication_dt)
-        publication_label = Gtk.Label(
-            label=time_ago,
+        self.attach(
+            child=self.channel_label,
+            column=2,
+            row=2,
+            width=1,
+            height=1,
+        )
+        self.publication_label = Gtk.Label(
             halign=Gtk.Align.START,
             vexpand=True,
             margin_start=10,
         )
-        grid.attach(child=publication_label, column=2, row=3, width=1, height=1)
+        self.attach(
+            child=self.publication_label,
+            column=2,
+            row=3,
+            width=1,
+            height=1,
+        )
         self.progress_bar = Gtk.ProgressBar(
             hexpand=True,
             show_text=True,
-            fraction=1 if video.downloaded else 0,
-            # margin_start=10,
-            # margin_end=30,
         )
         self.progress_bar_label = self.progress_bar.get_first_child()
-        if self.progress_bar_label is None:
-            return
-        self.progress_bar_label.props.halign = Gtk.Align.START
-        self.progress_bar_label.props.margin_start = 10
-        grid.attach(child=self.progress_bar, column=2, row=4, width=1, height=1)
+        if self.progress_bar_label is not None:
+            self.progress_bar_label.props.halign = Gtk.Align.START
+            self.progress_bar_label.props.margin_start = 10
+        self.attach(
+            child=self.progress_bar,
+            column=2,
+            row=4,
+            width=1,
+            height=1,
+        )
+
+    def bind(self, item: VideoItem) -> None:
+        video = item.video
+        self.video_id = video.id
+        title = (
+            video.title
+            .replace("&", "&amp;")
+            .replace("<", "&lt;")
+            .replace(">", "&gt;")
+         )
+        self.title_label.set_label(
+            rf'<span weight="bold" size="x-large">{title}</span>'
+        )
+        self.channel_label.set_label(video.channel_title)
+        self.publication_label.set_label(get_time_ago(video.publication_dt))
+        self.progress_binding = item.bind_property(
+            "progress",
+            self.progress_bar,
+            "fraction",
+            GObject.BindingFlags.SYNC_CREATE,
+        )
+        self.img.set_paintable(None)
+        texture_cache.request(
+            video.id,
+            partial(self.set_texture, video.id),
+            owner=self,
+        )
+
+    def unbind(self) -> None:
+        self.video_id = None
+        if self.progress_binding is not None:
+            self.progress_binding.unbind()
+            self.progress_binding = None
+
+    def set_texture(self, video_id: str, texture: Gdk.Texture) -> None:
+        # The card may have been recycled for another video in the meantime
+        if video_id == self.video_id:
+            self.img.set_paintable(texture)
+
+
+def setup_video_card(
+    _factory: Gtk.SignalListItemFactory,
+    list_item: Gtk.ListItem,
+) -> None:
+    list_item.set_child(VideoCard())
+
+
+def bind_video_card(
+    _factory: Gtk.SignalListItemFactory,
+    list_item: Gtk.ListItem,
+) -> None:
+    video_card = list_item.get_child()
+    item = list_item.get_item()
+    if isinstance(video_card, VideoCard) and isinstance(item, VideoItem):
+        video_card.bind(item)
 
 
-def init_backend(list_box: Gtk.ListBox) -> None:
-    update_channels(config.channel_ids)
-    asyncio.run(fetch_feeds())
-    video_cards = [VideoCard(video) for video in get_videos()]
-    for video_card in video_cards:
-        GLib.idle_add(list_box.append, video_card)
-    for video_card in video_cards:
-        GLib.idle_add(video_card.revealer.set_reveal_child, True)
-        sleep(0.2)
+def unbind_video_card(
+    _factory: Gtk.SignalListItemFactory,
+    list_item: Gtk.ListItem,
+) -> None:
+    video_card = list_item.get_child()
+    if isinstance(video_card, VideoCard):
+        video_card.unbind()
+
+
+def compare_video_items(a: VideoItem, b: VideoItem) -> int:
+    # Newest videos first
+    if a.video.publication_dt > b.video.publication_dt:
+        return -1
+    if a.video.publication_dt < b.video.publication_dt:
+        return 1
+    return 0
+
+
+class NewVideoObserver(Observer):
+    def __init__(self, observable: Observable, store: Gio.ListStore):
+        super().__init__(observable)
+        self.store = store
+
+    def notify(self, observable: Observable, video_id: str) -> None:
+        del observable
+        video_item = VideoItem(create_video(video_id))
+        GLib.idle_add(self.insert, video_item)
+
+    def insert(self, video_item: VideoItem) -> None:
+        self.store.insert_sorted(video_item, compare_video_items)
+
+
+class ProgressPoller:
+    """Shows the progress of the downloads requested from the UI
+
+    The job may be run by a worker of the daemon rather than of the UI, so
+    its progress is read from the job table, polled from a thread while
+    some downloads are tracked.
+    """
+
+    def __init__(self) -> None:
+        self._items: dict[str, VideoItem] = {}
+        self._lock = Lock()
+        self._thread: Optional[Thread] = None
+
+    def track(self, item: VideoItem) -> None:
+        with self._lock:
+            self._items[item.video.id] = item
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._poll,
+                    name="progress",
+                    daemon=True,
+                )
+                self._thread.start()
+
+    def _poll(self) -> None:
+        while True:
+            sleep(PROGRESS_POLL_INTERVAL)
+            with self._lock:
+                items = dict(self._items)
+            try:
+                job_progress = download_manager.get_job_progress(list(items))
+            except Exception as e:
+                logger.error(f"Could not read download progress: {e!r}")
+                continue
+            for video_id, item in items.items():
+                state, fraction = job_progress.get(video_id, (None, None))
+                if state is None:
+                    fraction = 1 if item.video.downloaded else 0
+                if fraction is not None:
+                    GLib.idle_add(item.set_property, "progress", fraction)
+            with self._lock:
+                # Finished and failed jobs are not tracked anymore
+                for video_id in items:
+                    state, _ = job_progress.get(video_id, (None, None))
+                    if state in (None, "failed"):
+                        self._items.pop(video_id, None)
+                if not self._items:
+                    self._thread = None
+                    return
+
+
+progress_poller = ProgressPoller()
+
+
+class ConfigObserver(Observer):
+    """Applies config reloads to the database and the list of videos"""
+
+    def __init__(
+        self,
+        observable: Observable,
+        store: Gio.ListStore,
+        new_video_event: NewVideoEvent,
+    ):
+        super().__init__(observable)
+        self.store = store
+        self.new_video_event = new_video_event
+        # Deltas are applied one at a time, in the order of the reloads
+        self.lock = Lock()
+
+    def notify(self, observable: Observable, delta: ConfigDelta) -> None:
+        del observable
+        # Fetching feeds would hold up the watcher thread and its next
+        # reloads
+        Thread(target=self.apply, args=(delta,), daemon=True).start()
+
+    def apply(self, delta: ConfigDelta) -> None:
+        with self.lock:
+            try:
+                deleted_video_ids = asyncio.run(apply_config_delta(
+                    delta,
+                    self.new_video_event.notify_observers,
+                ))
+            except Exception as e:
+                logger.error(f"Could not apply config changes: {e!r}")
+                return
+        GLib.idle_add(
+            self.remove,
+            delta.removed_channel_ids,
+            frozenset(deleted_video_ids),
+        )
+
+    def remove(
+        self,
+        channel_ids: frozenset[str],
+        video_ids: frozenset[str],
+    ) -> None:
+        for position in reversed(range(self.store.get_n_items())):
+            video = self.store.get_item(position).video
+            if video.channel_id in channel_ids or video.id in video_ids:
+                self.store.remove(position)
+
+
+def init_backend(store: Gio.ListStore) -> None:
+    # Show what is already in the database before going to the network
+    video_items = [VideoItem(video) for video in get_videos()]
+    GLib.idle_add(store.splice, 0, 0, video_items)
+    new_video_event = NewVideoEvent()
+    NewVideoObserver(new_video_event, store)
+    new_video_event.run()
+    ConfigObserver(config_watcher, store, new_video_event)
+    config_watcher.start()
 
 
 class MainWindow(Gtk.ApplicationWindow):
@@ -123,8 +334,14 @@ class MainWindow(Gtk.ApplicationWindow):
         self.scrolled_window = Gtk.ScrolledWindow()
         self.set_child(self.scrolled_window)
 
-        self.list_box = Gtk.ListBox()
-        self.scrolled_window.set_child(self.list_box)
+        self.store = Gio.ListStore(item_type=VideoItem)
+        self.selection = Gtk.SingleSelection(model=self.store)
+        factory = Gtk.SignalListItemFactory()
+        factory.connect("setup", setup_video_card)
+        factory.connect("bind", bind_video_card)
+        factory.connect("unbind", unbind_video_card)
+        self.list_view = Gtk.ListView(model=self.selection, factory=factory)
+        self.scrolled_window.set_child(self.list_view)
 
         evk = Gtk.EventControllerKey.new()
         evk.connect("key-pressed", self.key_press)
@@ -132,10 +349,19 @@ class MainWindow(Gtk.ApplicationWindow):
 
         thread = Thread(
             target=init_backend,
-            kwargs=dict(list_box=self.list_box),
+            kwargs=dict(store=self.store),
         )
         thread.start()
 
+    def select(self, position: int) -> None:
+        if not 0 <= position < self.store.get_n_items():
+            return
+        flags = Gtk.ListScrollFlags.SELECT | Gtk.ListScrollFlags.FOCUS
+        self.list_view.scroll_to(position, flags, None)
+
+    def get_selected_item(self) -> Optional[VideoItem]:
+        item = self.selection.get_selected_item()
+        return item if isinstance(item, VideoItem) else None
 
     def key_press(
         self,
@@ -145,53 +371,44 @@ class MainWindow(Gtk.ApplicationWindow):
         _state: Gdk.ModifierType,
     ) -> None:
         del _event, _keycode, _state
+        position = self.selection.get_selected()
+        if position == Gtk.INVALID_LIST_POSITION:
+            position = -1
         match keyval:
             case Gdk.KEY_j:
-                self.list_box.child_focus(Gtk.DirectionType.TAB_FORWARD)
+                self.select(position + 1)
             case Gdk.KEY_k:
-                self.list_box.child_focus(Gtk.DirectionType.TAB_BACKWARD)
+                self.select(position - 1)
             case Gdk.KEY_d:
-                video_card = self.list_box.get_focus_child()
-                if video_card is None or not isinstance(video_card, VideoCard):
+                item = self.get_selected_item()
+                if item is None or item.video.downloaded:
                     return
-                if video_card.video.downloaded:
-                    return
-                f = video_card.progress_bar.set_fraction
-
-                def progress_hook(download: dict[str, Any]) -> None:
-                    progress = parse_progress(download)
-                    GLib.idle_add(f, progress)
-
-                thread = Thread(
-                    target=video_card.video.download,
-                    kwargs=dict(
-                        with_notification=True,
-                        progress_hooks=[progress_hook]
-                    ),
+                download_manager.enqueue(
+                    item.video.id,
+                    with_notification=True,
                 )
-                thread.start()
+                progress_poller.track(item)
             case Gdk.KEY_p:
-                video_card = self.list_box.get_focus_child()
-                if video_card is None or not isinstance(video_card, VideoCard):
+                item = self.get_selected_item()
+                if item is None:
                     return
-                if not video_card.video.downloaded:
+                if item.video.downloaded:
+                    Popen(get_player_command(str(item.video.path)))
                     return
-                cmd = (
-                    "mpv",
-                    "--keepaspect-window",
-                    "--geometry=70%",
-                    "--no-terminal",
-                    "--cursor-autohide=no",
-                    video_card.video.path,
-                )
-                Popen(cmd)
+
+                def on_finished(downloaded: bool) -> None:
+                    if downloaded:
+                        GLib.idle_add(item.set_property, "progress", 1.0)
+
+                # Playback starts while the video is being downloaded
+                stream_video(item.video.id, on_finished)
             case Gdk.KEY_w:
-                video_card = self.list_box.get_focus_child()
-                if video_card is None or not isinstance(video_card, VideoCard):
+                item = self.get_selected_item()
+                if item is None:
                     return
-                self.list_box.child_focus(Gtk.DirectionType.TAB_FORWARD)
-                video_card.video.watched = True
-                video_card.set_visible(False)
+                item.video.watched = True
+                # The selection moves on to the next video
+                self.store.remove(position)
             case Gdk.KEY_q:
                 self.close()
 
@@ -203,6 +420,9 @@ class MyApp(Adw.Application):
         self.connect('activate', self.on_activate)
 
     def on_activate(self, app: Adw.Application) -> None:
+        metrics.start(process_name="ui")
+        # Interrupted downloads are resumed once the window is up
+        download_manager.start()
         self.win = MainWindow(application=app)
         self.win.present()
 
@@ -0,0 +1,44 @@
+from pathlib import Path
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import yrp.backend as backend
+import yrp.config as config
+from yrp.config import DatabaseConfig, ThumbnailCacheConfig
+from yrp.db import AsyncSession, Base, Session, set_pragmas
+from yrp.download import InfoCache
+from yrp.thumbnails import ThumbnailCache
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path: Path) -> None:
+    """Database file with the pragmas of the app, unlike the unit tests"""
+    path = tmp_path / "yrp.db"
+    engine = create_engine(f"sqlite:///{path}")
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    set_pragmas(engine, DatabaseConfig())
+    set_pragmas(async_engine.sync_engine, DatabaseConfig())
+    Base.metadata.create_all(engine)
+    Session.configure(bind=engine)
+    AsyncSession.configure(bind=async_engine)
+
+
+@pytest.fixture(autouse=True)
+def asset_dirs(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Keep the files written by benchmarks out of the user cache"""
+    video_dir = tmp_path / "videos"
+    video_dir.mkdir()
+    monkeypatch.setattr(config, "video_dir", video_dir)
+    thumbnail_dir = tmp_path / "thumbnails"
+    thumbnail_dir.mkdir()
+    monkeypatch.setattr(
+        backend,
+        "thumbnail_cache",
+        ThumbnailCache(thumbnail_dir, ThumbnailCacheConfig()),
+    )
+    info_dir = tmp_path / "info"
+    info_dir.mkdir()
+    monkeypatch.setattr(backend, "info_cache", InfoCache(info_dir))
+    return video_dir
@@ -0,0 +1,379 @@
+"""End to end benchmarks of the refresh path
+
+Run them alone with `pytest tests/benchmarks`. They use 10 channels by
+default, set YRP_BENCHMARK_CHANNELS to a comma separated list of channel
+counts such as 10,100,1000,5000 to measure more.
+"""
+from collections.abc import Iterator
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from random import Random
+from threading import Event, Thread
+from typing import Optional
+import asyncio
+import os
+
+from aiohttp import web
+import pytest
+from pytest_benchmark.fixture import BenchmarkFixture
+from sqlalchemy import func, select
+
+import yrp.backend as backend
+import yrp.config as config
+from yrp.backend import (
+    clean_assets, fetch_feeds, update_channels, upload_feed_data
+)
+from yrp.config import SchedulerConfig
+from yrp.db import Base, Channel, Session, Video
+from yrp.feed import Feed, FeedParser, ParsedFeed
+
+
+CHANNEL_COUNTS = [
+    int(count)
+    for count in os.environ.get("YRP_BENCHMARK_CHANNELS", "10").split(",")
+]
+ROUNDS = 3
+
+ENTRY = """ <entry>
+  <id>yt:video:{video_id}</id>
+  <yt:videoId>{video_id}</yt:videoId>
+  <title>Video {video_id}</title>
+  <published>{published}</published>
+  <media:group>
+   <media:title>Video {video_id}</media:title>
+   <media:description>Description of video {video_id}</media:description>
+  </media:group>
+ </entry>
+"""
+FEED_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015"
+      xmlns:media="http://search.yahoo.com/mrss/"
+      xmlns="http://www.w3.org/2005/Atom">
+ <title>Channel {channel_id}</title>
+"""
+# About the size of a real mqdefault.jpg, yrp never decodes thumbnails
+THUMBNAIL_SIZE = 2**14
+
+
+def get_channel_id(index: int) -> str:
+    return f"UC{index:022}"
+
+
+def get_video_id(channel_id: str, index: int) -> str:
+    return f"{int(channel_id[2:]):06}{index:05}"
+
+
+class FakeYoutube:
+    """Local stand-in for the feed and thumbnail servers of Youtube
+
+    Every channel has entries_per_feed videos published in the last hours.
+    Responses are delayed by latency seconds and a share error_rate of them
+    fail with a 503, drawn from a seeded generator so that runs compare.
+    Feeds have an ETag and are answered with a 304 when it is sent back.
+    The server runs in its own thread and event loop, like a remote server
+    would not share the event loop of yrp.
+    """
+
+    def __init__(
+        self,
+        entries_per_feed: int = 15,
+        latency: float = 0,
+        error_rate: float = 0,
+        seed: int = 0,
+    ) -> None:
+        self.entries_per_feed = entries_per_feed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = Random(seed)
+        self.published = datetime.now(timezone.utc)
+        self.requests = 0
+        self.not_modified = 0
+        self.url = ""
+        self._feeds: dict[str, bytes] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stopped: Optional[asyncio.Event] = None
+        self._thread: Optional[Thread] = None
+
+    def get_channel_ids(self, count: int) -> list[str]:
+        return [get_channel_id(i) for i in range(count)]
+
+    def get_feed(self, channel_id: str) -> bytes:
+        feed = self._feeds.get(channel_id)
+        if feed is None:
+            entries = [
+                ENTRY.format(
+                    video_id=get_video_id(channel_id, i),
+                    published=(
+                        self.published - timedelta(hours=i)
+                    ).isoformat(),
+                )
+                for i in range(self.entries_per_feed)
+            ]
+            feed = "".join((
+                FEED_HEADER.format(channel_id=channel_id),
+                *entries,
+                "</feed>\n",
+            )).encode()
+            self._feeds[channel_id] = feed
+        return feed
+
+    async def _respond(self) -> Optional[web.Response]:
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.error_rate and self.random.random() < self.error_rate:
+            return web.Response(status=503)
+        return None
+
+    async def handle_feed(self, request: web.Request) -> web.Response:
+        error = await self._respond()
+        if error is not None:
+            return error
+        channel_id = request.query["channel_id"]
+        etag = f'"{channel_id}"'
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304)
+        return web.Response(
+            body=self.get_feed(channel_id),
+            content_type="application/atom+xml",
+            headers={"ETag": etag},
+        )
+
+    async def handle_thumbnail(self, request: web.Request) -> web.Response:
+        error = await self._respond()
+        if error is not None:
+            return error
+        # Thumbnails differ, as identical ones are stored once
+        video_id = request.match_info["video_id"].encode()
+        body = video_id.ljust(THUMBNAIL_SIZE, b"\0")
+        return web.Response(body=body, content_type="image/jpeg")
+
+    def start(self) -> None:
+        started = Event()
+        self._thread = Thread(
+            target=asyncio.run,
+            args=(self._serve(started),),
+            daemon=True,
+        )
+        self._thread.start()
+        started.wait()
+
+    def stop(self) -> None:
+        if self._loop is None or self._stopped is None:
+            return
+        self._loop.call_soon_threadsafe(self._stopped.set)
+        if self._thread is not None:
+            self._thread.join()
+
+    async def _serve(self, started: Event) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        app = web.Application()
+        app.router.add_get("/feeds/videos.xml", self.handle_feed)
+        app.router.add_get(
+            "/vi/{video_id}/mqdefault.jpg",
+            self.handle_thumbnail,
+        )
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}"
+        started.set()
+        await self._stopped.wait()
+        await runner.cleanup()
+
+
+@pytest.fixture
+def fake_youtube(monkeypatch: pytest.MonkeyPatch) -> Iterator[FakeYoutube]:
+    server = FakeYoutube()
+    server.start()
+    monkeypatch.setattr(
+        backend,
+        "FEED_PREFIX",
+        f"{server.url}/feeds/videos.xml?channel_id=",
+    )
+    monkeypatch.setattr(
+        backend,
+        "get_thumbnail_url",
+        f"{server.url}/vi/{{video_id}}/mqdefault.jpg".format,
+    )
+    # Measure yrp rather than the rate limit meant for Youtube
+    monkeypatch.setattr(
+        config,
+        "scheduler_config",
+        SchedulerConfig(
+            requests_per_second=10**6,
+            burst=10**6,
+            backoff_base=0.01,
+            backoff_max=0.1,
+        ),
+    )
+    yield server
+    server.stop()
+
+
+def reset_database(channel_ids: list[str]) -> None:
+    with Session.begin() as session:
+        for table in reversed(Base.metadata.sorted_tables):
+            session.execute(table.delete())
+        session.add_all([Channel(id=channel_id) for channel_id in channel_ids])
+
+
+def count_videos() -> int:
+    with Session() as session:
+        return session.scalar(select(func.count()).select_from(Video)) or 0
+
+
+def parse_feed(feed: bytes) -> ParsedFeed:
+    parser = FeedParser()
+    entries = list(parser.feed(feed))
+    parser.close()
+    assert parser.title is not None
+    return ParsedFeed(feed=Feed(title=parser.title), entries=entries)
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+def test_fetch_feeds(
+    benchmark: BenchmarkFixture,
+    fake_youtube: FakeYoutube,
+    channel_count: int,
+) -> None:
+    """First refresh: every feed and thumbnail is downloaded"""
+    channel_ids = fake_youtube.get_channel_ids(channel_count)
+    benchmark.pedantic(
+        lambda: asyncio.run(fetch_feeds()),
+        setup=lambda: reset_database(channel_ids),
+        rounds=ROUNDS,
+    )
+    assert count_videos() == channel_count * fake_youtube.entries_per_feed
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+def test_fetch_feeds_not_modified(
+    benchmark: BenchmarkFixture,
+    fake_youtube: FakeYoutube,
+    channel_count: int,
+) -> None:
+    """Refresh where every feed is answered with a 304"""
+    reset_database(fake_youtube.get_channel_ids(channel_count))
+    asyncio.run(fetch_feeds())
+    requests = fake_youtube.requests
+    not_modified = fake_youtube.not_modified
+    benchmark.pedantic(lambda: asyncio.run(fetch_feeds()), rounds=ROUNDS)
+    assert fake_youtube.not_modified > not_modified
+    assert (
+        fake_youtube.requests - requests
+        == fake_youtube.not_modified - not_modified
+    )
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+def test_fetch_feeds_slow_and_flaky(
+    benchmark: BenchmarkFixture,
+    fake_youtube: FakeYoutube,
+    channel_count: int,
+) -> None:
+    """First refresh against a server with latency and transient errors"""
+    fake_youtube.latency = 0.05
+    fake_youtube.error_rate = 0.05
+    channel_ids = fake_youtube.get_channel_ids(channel_count)
+    benchmark.pedantic(
+        lambda: asyncio.run(fetch_feeds()),
+        setup=lambda: reset_database(channel_ids),
+        rounds=ROUNDS,
+    )
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+def test_upload_feed_data(
+    benchmark: BenchmarkFixture,
+    fake_youtube: FakeYoutube,
+    channel_count: int,
+) -> None:
+    """Writing parsed feeds, one transaction per channel"""
+    channel_ids = fake_youtube.get_channel_ids(channel_count)
+    parsed_feeds = {
+        channel_id: parse_feed(fake_youtube.get_feed(channel_id))
+        for channel_id in channel_ids
+    }
+
+    async def upload() -> None:
+        for channel_id, parsed_feed in parsed_feeds.items():
+            await upload_feed_data(channel_id, parsed_feed)
+
+    benchmark.pedantic(
+        lambda: asyncio.run(upload()),
+        setup=lambda: reset_database(channel_ids),
+        rounds=ROUNDS,
+    )
+    assert count_videos() == channel_count * fake_youtube.entries_per_feed
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+def test_update_channels(
+    benchmark: BenchmarkFixture,
+    channel_count: int,
+) -> None:
+    """Half of the subscriptions replaced by new ones"""
+    old_channel_ids = [get_channel_id(i) for i in range(channel_count)]
+    new_channel_ids = {
+        get_channel_id(i)
+        for i in range(channel_count // 2, channel_count + channel_count // 2)
+    }
+
+    def setup() -> None:
+        reset_database(old_channel_ids)
+        add_videos(old_channel_ids)
+
+    benchmark.pedantic(
+        update_channels,
+        args=(new_channel_ids,),
+        setup=setup,
+        rounds=ROUNDS,
+    )
+    with Session() as session:
+        assert set(session.scalars(select(Channel.id))) == new_channel_ids
+
+
+def add_videos(channel_ids: list[str], entries_per_channel: int = 15) -> None:
+    now = datetime.now()
+    with Session.begin() as session:
+        session.add_all([
+            Video(
+                id=get_video_id(channel_id, i),
+                title=f"Video {i}",
+                publication_dt=now - timedelta(hours=i),
+                channel_id=channel_id,
+                watched=i % 2 == 0,
+            )
+            for channel_id in channel_ids
+            for i in range(entries_per_channel)
+        ])
+
+
+@pytest.mark.parametrize("channel_count", CHANNEL_COUNTS)
+def test_clean_assets(
+    benchmark: BenchmarkFixture,
+    asset_dirs: Path,
+    channel_count: int,
+) -> None:
+    """Cleaning a video directory where half of the videos were watched"""
+    channel_ids = [get_channel_id(i) for i in range(channel_count)]
+    reset_database(channel_ids)
+    add_videos(channel_ids)
+    with Session() as session:
+        video_ids = list(session.scalars(select(Video.id)))
+
+    def setup() -> None:
+        for video_id in video_ids:
+            (asset_dirs / f"{video_id}.mkv").touch()
+
+    benchmark.pedantic(clean_assets, setup=setup, rounds=ROUNDS)
+    with Session() as session:
+        unwatched_count = session.scalar(
+            select(func.count()).select_from(Video).filter_by(watched=False)
+        )
+    assert len(list(asset_dirs.iterdir())) == unwatched_count
@@ -4,7 +4,6 @@ import os
 import pytest
 from sqlalchemy import create_engine
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
-from yrp.backend import Backend
 from yrp.db import Base, Session, AsyncSession
 
 
@@ -43,8 +42,3 @@ def thumbnail_dir(tmp_cache_dir: Path) -> Path:
 def video_dir(tmp_cache_dir: Path) -> Path:
     video_dir_path = tmp_cache_dir / "video"
     return video_dir_path
-
-
-@pytest.fixture
-def backend() -> Backend:
-    return Backend()
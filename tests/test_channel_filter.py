@@ -0,0 +1,86 @@
+from time import gmtime
+import re
+
+import pytest
+
+import yrp.config as config
+from yrp.config import ChannelFilter
+from yrp.feed import VideoEntry
+from yrp.filters import TextMatcher
+from yrp.ingest import filter_entries
+
+
+def make_entry(title: str, description: str = "") -> VideoEntry:
+    return VideoEntry(
+        yt_videoid=title,
+        title=title,
+        published_parsed=gmtime(0),
+        description=description,
+    )
+
+
+def filter_titles(channel_filter: ChannelFilter, *titles: str) -> list[str]:
+    entries = channel_filter.filter_entries(map(make_entry, titles))
+    return [entry["title"] for entry in entries]
+
+
+def test_exclude() -> None:
+    channel_filter = ChannelFilter(exclude=["#shorts", "live"])
+    titles = filter_titles(channel_filter, "A #shorts", "B", "C live")
+    assert titles == ["B"]
+
+
+def test_include_and_exclude() -> None:
+    channel_filter = ChannelFilter.model_validate(dict(
+        include="Part",
+        include_regex=[r"Episode \d+"],
+        exclude_regex="(?i)trailer",
+    ))
+    titles = filter_titles(
+        channel_filter,
+        "Part 1",
+        "Episode 2",
+        "The Episode 3",
+        "Trailer Part 4",
+        "Other",
+    )
+    assert titles == ["Part 1", "Episode 2"]
+
+
+def test_patterns_are_combined() -> None:
+    matcher = TextMatcher(
+        ["a.b"],
+        [
+            re.compile("x"),
+            re.compile("y", re.IGNORECASE),
+            re.compile(r"(z)\1"),
+            re.compile("w # comment", re.VERBOSE),
+        ],
+    )
+    assert [pattern.pattern for pattern in matcher.patterns] == [
+        r"(z)\1",
+        "w # comment",
+    ]
+    assert matcher("ya.b") and matcher("Y") and matcher("zz")
+    assert matcher("w") and matcher("xyz")
+    assert not matcher("axb") and not matcher("az") and not matcher("ax")
+    assert not TextMatcher()
+
+
+def test_description_filter() -> None:
+    channel_filter = ChannelFilter.model_validate(dict(
+        description=dict(exclude=["sponsored"]),
+    ))
+    assert channel_filter.filter(make_entry("A", "Not sponsored")) is False
+    assert channel_filter.filter(make_entry("A", "Plain"))
+    assert channel_filter.filter(make_entry("A"))
+
+
+def test_global_filter(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(config, "global_filter", ChannelFilter(exclude=["X"]))
+    monkeypatch.setattr(
+        config, "channel_filters", dict(C=ChannelFilter(include=["A"]))
+    )
+    entries = [make_entry(title) for title in ("A", "AX", "B")]
+    assert filter_entries("C", entries) == entries[:1]
+    assert filter_entries("D", entries) == entries[::2]
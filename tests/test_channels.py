@@ -0,0 +1,99 @@
+from collections.abc import AsyncIterator
+from pathlib import Path
+
+from aiohttp import web
+import pytest
+import pytest_asyncio
+
+from yrp.channels import (
+    get_channel_path,
+    get_direct_channel_id,
+    read_subscriptions,
+    resolve_channels,
+)
+
+
+CHANNEL_ID = "UCXuqSBlHAE6Xw-yeJA0Tunw"
+
+
+@pytest_asyncio.fixture
+async def channel_server() -> AsyncIterator[tuple[str, list[str]]]:
+    hits: list[str] = []
+
+    async def handler(request: web.Request) -> web.StreamResponse:
+        hits.append(request.path)
+        if request.path != "/@channel":
+            return web.Response(status=404)
+        resp = web.StreamResponse()
+        await resp.prepare(request)
+        await resp.write(b"<html><script>" + b" " * 50_000)
+        # Split the match between two writes
+        await resp.write(b'var data = {"chann')
+        await resp.write(f'elId":"{CHANNEL_ID}"}};</script>'.encode())
+        return resp
+
+    app = web.Application()
+    app.router.add_get("/{path:.*}", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield f"http://127.0.0.1:{port}", hits
+    await runner.cleanup()
+
+
+def test_channel_path() -> None:
+    assert get_channel_path("@Channel") == "/@channel"
+    assert get_channel_path("youtube.com/@Channel/videos") == "/@channel"
+    assert get_channel_path("https://m.youtube.com/c/Name") == "/c/Name"
+    with pytest.raises(ValueError):
+        get_channel_path("https://example.com/@channel")
+    with pytest.raises(ValueError):
+        get_channel_path("https://www.youtube.com/watch?v=A")
+    url = f"https://www.youtube.com/channel/{CHANNEL_ID}"
+    assert get_direct_channel_id(url) == CHANNEL_ID
+    assert get_direct_channel_id(CHANNEL_ID) == CHANNEL_ID
+    assert get_direct_channel_id("@channel") is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_channels(
+    channel_server: tuple[str, list[str]],
+) -> None:
+    url, hits = channel_server
+    references = ["@Channel", "youtube.com/@channel", "@missing", CHANNEL_ID]
+    channel_ids = await resolve_channels(references, url)
+    assert channel_ids == {
+        "@Channel": CHANNEL_ID,
+        "youtube.com/@channel": CHANNEL_ID,
+        CHANNEL_ID: CHANNEL_ID,
+    }
+    assert sorted(hits) == ["/@channel", "/@missing"]
+    # Resolved handles are remembered
+    channel_ids = await resolve_channels(["@CHANNEL"], url)
+    assert channel_ids == {"@CHANNEL": CHANNEL_ID}
+    assert len(hits) == 2
+
+
+def test_read_subscriptions(tmp_path: Path) -> None:
+    feed_url = (
+        f"https://www.youtube.com/feeds/videos.xml?channel_id={CHANNEL_ID}"
+    )
+    opml_path = tmp_path / "subscriptions.opml"
+    opml_path.write_text(f"""<opml version="1.1"><body>
+<outline text="YouTube Subscriptions">
+ <outline text="A" xmlUrl="{feed_url}"/>
+ <outline text="B" htmlUrl="https://www.youtube.com/@b"/>
+</outline>
+</body></opml>""")
+    assert read_subscriptions(opml_path) == [
+        CHANNEL_ID,
+        "https://www.youtube.com/@b",
+    ]
+    csv_path = tmp_path / "subscriptions.csv"
+    csv_path.write_text(
+        "\ufeffChannel Id,Channel Url,Channel Title\n"
+        f"{CHANNEL_ID},http://www.youtube.com/channel/{CHANNEL_ID},A\n"
+    )
+    assert read_subscriptions(csv_path) == [CHANNEL_ID]
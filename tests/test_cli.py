@@ -0,0 +1,115 @@
+from datetime import datetime
+from io import StringIO
+from pathlib import Path
+from typing import Any
+import json
+
+import pytest
+from sqlalchemy import create_engine, select
+
+import yrp.config as config
+from yrp.cli import main, run_downloads
+from yrp.config import DownloadConfig
+from yrp.db import Base, Channel, DownloadJob, Session, Video
+from yrp.downloads import DownloadManager
+
+
+@pytest.fixture(autouse=True)
+def tmp_config(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Keep the user's config, cache and database out of the tests"""
+    for name, value in config.parse_config({}).items():
+        monkeypatch.setattr(config, name, value)
+    monkeypatch.setattr(config, "config_file", tmp_path / "yrp.toml")
+    monkeypatch.setattr(config, "database_file", tmp_path / "yrp.db")
+    video_dir = tmp_path / "videos"
+    video_dir.mkdir()
+    monkeypatch.setattr(config, "video_dir", video_dir)
+
+
+def add_videos(count: int, watched: bool = False) -> list[str]:
+    video_ids = [f"{i:011}" for i in range(count)]
+    with Session.begin() as session:
+        channel = Channel(id="C" * 24, title="Channel")
+        session.add(channel)
+        session.add_all([
+            Video(
+                id=video_id,
+                title=f"Video {video_id}",
+                publication_dt=datetime.now(),
+                channel=channel,
+                watched=watched,
+            )
+            for video_id in video_ids
+        ])
+    return video_ids
+
+
+def run_json(capsys: pytest.CaptureFixture[str], *argv: str) -> Any:
+    assert main(argv) == 0
+    return json.loads(capsys.readouterr().out)
+
+
+def test_list_json(capsys: pytest.CaptureFixture[str]) -> None:
+    video_ids = add_videos(3)
+    videos = run_json(capsys, "list", "--json")
+    assert sorted(video["id"] for video in videos) == video_ids
+    assert {video["channel_title"] for video in videos} == {"Channel"}
+    assert run_json(capsys, "list", "--json", "--watched") == []
+
+
+def test_watched_is_bulk(capsys: pytest.CaptureFixture[str]) -> None:
+    video_ids = add_videos(1200)
+    assert main(["watched", *video_ids[:1000]]) == 0
+    with Session() as session:
+        unwatched_ids = session.scalars(
+            select(Video.id).filter_by(watched=False)
+        ).all()
+    assert sorted(unwatched_ids) == video_ids[1000:]
+    stats = run_json(capsys, "stats", "--json")
+    assert stats["videos"] == 1200
+    assert stats["unwatched_videos"] == 200
+    assert stats["channels"] == 1
+    assert stats["database_bytes"] == 0
+
+
+def test_delete_reads_stdin(monkeypatch: pytest.MonkeyPatch) -> None:
+    video_ids = add_videos(3)
+    monkeypatch.setattr("sys.stdin", StringIO(f"{video_ids[0]}\n\n"))
+    assert main(["delete"]) == 0
+    with Session() as session:
+        assert sorted(session.scalars(select(Video.id))) == video_ids[1:]
+
+
+def test_run_downloads_reports_failures(tmp_path: Path) -> None:
+    # The download threads need to share the database
+    Session.configure(bind=create_engine(f"sqlite:///{tmp_path}/yrp.db"))
+    Base.metadata.create_all(Session().get_bind())
+    video_ids = add_videos(4)
+    downloaded: list[str] = []
+
+    def download(video_id: str, **kwargs: Any) -> None:
+        if video_id == video_ids[0]:
+            raise ConnectionError(video_id)
+        downloaded.append(video_id)
+
+    download_config = DownloadConfig(max_attempts=2, retry_delay_seconds=0)
+    manager = DownloadManager(download_config, download)
+    assert run_downloads(manager, video_ids, 3) == video_ids[:1]
+    assert sorted(downloaded) == video_ids[1:]
+    with Session() as session:
+        assert session.scalars(select(DownloadJob.state)).all() == ["failed"]
+
+
+def test_run_downloads_reports_jobs_waiting_to_retry(tmp_path: Path) -> None:
+    Session.configure(bind=create_engine(f"sqlite:///{tmp_path}/yrp.db"))
+    Base.metadata.create_all(Session().get_bind())
+    video_ids = add_videos(2)
+
+    def download(video_id: str, **kwargs: Any) -> None:
+        if video_id == video_ids[0]:
+            raise ConnectionError(video_id)
+
+    manager = DownloadManager(DownloadConfig(max_attempts=2), download)
+    assert run_downloads(manager, video_ids, 1) == video_ids[:1]
+    with Session() as session:
+        assert session.scalars(select(DownloadJob.state)).all() == ["queued"]
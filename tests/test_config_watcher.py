@@ -0,0 +1,161 @@
+from datetime import datetime
+from pathlib import Path
+from threading import Event
+from typing import Any
+
+import pytest
+from sqlalchemy import select
+
+import yrp.config as config
+from yrp.backend import refilter_videos
+from yrp.config import ChannelFilter
+from yrp.config_watcher import ConfigDelta, ConfigWatcher, get_config_delta
+from yrp.db import Session, Video
+from yrp.observer import Observable, Observer
+
+
+CHANNEL_A = "A" * 24
+CHANNEL_B = "B" * 24
+CHANNEL_C = "C" * 24
+
+
+@pytest.fixture(autouse=True)
+def restore_config(monkeypatch: pytest.MonkeyPatch) -> None:
+    for name in config.parse_config({}):
+        monkeypatch.setattr(config, name, getattr(config, name))
+
+
+def make_settings(
+    channels: list[Any],
+    **config_tables: Any,
+) -> dict[str, Any]:
+    return config.parse_config(dict(channels=channels, **config_tables))
+
+
+class DeltaObserver(Observer):
+    def __init__(self, observable: Observable) -> None:
+        super().__init__(observable)
+        self.deltas: list[ConfigDelta] = []
+        self.event = Event()
+
+    def notify(self, observable: Observable, delta: ConfigDelta) -> None:
+        del observable
+        self.deltas.append(delta)
+        self.event.set()
+
+
+def test_config_delta() -> None:
+    old_settings = make_settings([
+        CHANNEL_A,
+        dict(id=CHANNEL_B, exclude="live"),
+    ])
+    new_settings = make_settings([
+        dict(id=CHANNEL_B, exclude=["live", "#shorts"]),
+        CHANNEL_C,
+    ])
+    assert get_config_delta(old_settings, new_settings) == ConfigDelta(
+        added_channel_ids=frozenset({CHANNEL_C}),
+        removed_channel_ids=frozenset({CHANNEL_A}),
+        refiltered_channel_ids=frozenset({CHANNEL_B}),
+    )
+    assert not get_config_delta(new_settings, new_settings)
+    global_settings = make_settings(
+        [dict(id=CHANNEL_B, exclude=["live", "#shorts"]), CHANNEL_C],
+        global_filter=dict(exclude_regex=["(?i)trailer"]),
+    )
+    delta = get_config_delta(new_settings, global_settings)
+    assert delta.refiltered_channel_ids == {CHANNEL_B, CHANNEL_C}
+
+
+def test_reload_keeps_settings_of_invalid_file(tmp_path: Path) -> None:
+    path = tmp_path / "yrp.toml"
+    path.write_text(f'channels = ["{CHANNEL_A}"]\n')
+    watcher = ConfigWatcher(path)
+    observer = DeltaObserver(watcher)
+    delta = watcher.reload()
+    assert delta is not None and CHANNEL_A in delta.added_channel_ids
+    assert config.channel_ids == {CHANNEL_A}
+    path.write_text('channels = ["not a channel id"]\n')
+    assert watcher.reload() is None
+    assert config.channel_ids == {CHANNEL_A}
+    assert watcher.check() is None
+    assert len(observer.deltas) == 1
+
+
+def test_reload_keeps_settings_of_missing_file(tmp_path: Path) -> None:
+    path = tmp_path / "yrp.toml"
+    path.write_text(f'channels = ["{CHANNEL_A}"]\n')
+    watcher = ConfigWatcher(path)
+    watcher.reload()
+    path.unlink()
+    assert watcher.check() is None
+    assert config.channel_ids == {CHANNEL_A}
+    path.write_text(f'channels = ["{CHANNEL_A}", "{CHANNEL_B}"]\n')
+    delta = watcher.check()
+    assert delta == ConfigDelta(added_channel_ids=frozenset({CHANNEL_B}))
+
+
+def test_watcher_picks_up_replaced_file(tmp_path: Path) -> None:
+    path = tmp_path / "yrp.toml"
+    path.write_text(f'channels = ["{CHANNEL_A}"]\n')
+    watcher = ConfigWatcher(path)
+    observer = DeltaObserver(watcher)
+    watcher.start()
+    try:
+        tmp_file = tmp_path / "yrp.toml.tmp"
+        tmp_file.write_text(f'channels = ["{CHANNEL_A}", "{CHANNEL_B}"]\n')
+        tmp_file.replace(path)
+        assert observer.event.wait(timeout=5)
+    finally:
+        watcher.stop()
+    assert config.channel_ids == {CHANNEL_A, CHANNEL_B}
+    assert CHANNEL_B in observer.deltas[-1].added_channel_ids
+
+
+class FailingObserver(Observer):
+    def notify(self, observable: Observable, arg: Any) -> None:
+        raise RuntimeError
+
+
+def test_watcher_survives_failing_observer(tmp_path: Path) -> None:
+    path = tmp_path / "yrp.toml"
+    path.write_text(f'channels = ["{CHANNEL_A}"]\n')
+    watcher = ConfigWatcher(path)
+    observer = DeltaObserver(watcher)
+    FailingObserver(watcher)
+    watcher.start()
+    try:
+        path.write_text(f'channels = ["{CHANNEL_A}", "{CHANNEL_B}"]\n')
+        assert observer.event.wait(timeout=5)
+        observer.event.clear()
+        path.write_text(f'channels = ["{CHANNEL_B}"]\n')
+        assert observer.event.wait(timeout=5)
+    finally:
+        watcher.stop()
+    assert config.channel_ids == {CHANNEL_B}
+
+
+def test_refilter_videos(monkeypatch: pytest.MonkeyPatch) -> None:
+    with Session.begin() as session:
+        session.add_all([
+            Video(
+                id=title,
+                title=title,
+                publication_dt=datetime.now(),
+                channel_id=channel_id,
+            )
+            for title, channel_id in (
+                ("A live", CHANNEL_A),
+                ("A1", CHANNEL_A),
+                ("B live", CHANNEL_B),
+            )
+        ])
+    monkeypatch.setattr(
+        config,
+        "channel_filters",
+        {CHANNEL_A: ChannelFilter(exclude=["live"])},
+    )
+    assert refilter_videos([CHANNEL_A]) == ["A live"]
+    with Session() as session:
+        video_ids = set(session.scalars(select(Video.id)))
+    assert video_ids == {"A1", "B live"}
@@ -0,0 +1,61 @@
+from collections.abc import Collection
+from datetime import datetime, timedelta
+from typing import Any
+import asyncio
+
+import pytest
+
+import yrp.daemon as daemon
+from yrp.daemon import RefreshSchedule, get_poll_interval
+from yrp.db import Session, Channel, Video
+
+
+def test_poll_interval_follows_upload_rate() -> None:
+    assert get_poll_interval(0) == timedelta(hours=12)
+    # One upload a day over 90 days, polled 4 times a day
+    assert get_poll_interval(90) == timedelta(hours=6)
+    assert get_poll_interval(100_000) == timedelta(minutes=15)
+
+
+def test_refresh_schedule() -> None:
+    now = datetime.now()
+    with Session.begin() as session:
+        session.add(Channel(id="A", last_polled=now))
+        session.add(Channel(id="B"))
+        session.add_all([
+            Video(
+                id=f"A{i}",
+                title=f"A{i}",
+                publication_dt=now - timedelta(days=i),
+                channel_id="A",
+            )
+            for i in range(90)
+        ])
+    schedule = RefreshSchedule()
+    schedule.load()
+    assert schedule.get_due(datetime.now()) == {"B"}
+    assert schedule.get_sleep_time(datetime.now()) == 0
+    assert schedule.next_poll["A"] == now + timedelta(hours=6)
+    schedule.reschedule({"B"}, now)
+    assert schedule.next_poll["B"] == now + timedelta(hours=12)
+    assert schedule.get_due(now + timedelta(hours=6)) == {"A"}
+    assert schedule.get_sleep_time(now) == 5 * 60
+
+
+def test_failed_refresh_is_rescheduled(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async def fetch_feeds(
+        callback: Any,
+        channel_ids: Collection[str],
+    ) -> None:
+        raise ConnectionError
+
+    monkeypatch.setattr(daemon, "fetch_feeds", fetch_feeds)
+    with Session.begin() as session:
+        session.add(Channel(id="A"))
+    schedule = RefreshSchedule()
+    schedule.load()
+    with pytest.raises(ConnectionError):
+        asyncio.run(daemon.refresh_due_channels(schedule))
+    assert schedule.get_due(datetime.now()) == set()
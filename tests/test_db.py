@@ -0,0 +1,143 @@
+from pathlib import Path
+
+from pydantic import ValidationError
+import pytest
+from sqlalchemy import (
+    Column, Engine, Index, Integer, MetaData, String, Table, create_engine,
+    inspect, text
+)
+
+from yrp import migrations
+from yrp.config import DatabaseConfig
+from yrp.db import Base, set_pragmas
+from yrp.migrations import SCHEMA_VERSION, get_user_version, migrate
+
+
+@pytest.fixture
+def engine(tmp_path: Path) -> Engine:
+    return create_engine(f"sqlite:///{tmp_path / 'yrp.db'}")
+
+
+def get_user_version_of(engine: Engine) -> int:
+    with engine.connect() as connection:
+        return get_user_version(connection)
+
+
+def test_pragmas(engine: Engine) -> None:
+    set_pragmas(engine, DatabaseConfig(busy_timeout_ms=1234))
+    with engine.connect() as connection:
+        assert connection.scalar(text("PRAGMA journal_mode")) == "wal"
+        assert connection.scalar(text("PRAGMA synchronous")) == 1
+        assert connection.scalar(text("PRAGMA busy_timeout")) == 1234
+
+
+def test_invalid_pragma_values_are_rejected() -> None:
+    with pytest.raises(ValidationError):
+        DatabaseConfig(journal_mode="WAL; DROP TABLE video")
+    with pytest.raises(ValidationError):
+        DatabaseConfig(synchronous="SOMETIMES")
+
+
+def test_new_database(engine: Engine) -> None:
+    migrate(engine, Base.metadata)
+    assert get_user_version_of(engine) == SCHEMA_VERSION
+    assert set(inspect(engine).get_table_names()) == set(
+        Base.metadata.tables
+    )
+
+
+def test_unversioned_database_gets_indexes(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE video (id VARCHAR(11) PRIMARY KEY, title VARCHAR,"
+            " publication_dt DATETIME, downloading BOOLEAN, watched BOOLEAN,"
+            " channel_id VARCHAR)"
+        ))
+    migrate(engine, Base.metadata)
+    assert get_user_version_of(engine) == SCHEMA_VERSION
+    index_names = {
+        index["name"] for index in inspect(engine).get_indexes("video")
+    }
+    assert index_names == {
+        "ix_video_watched_publication_dt",
+        "ix_video_channel_id_publication_dt",
+    }
+    with engine.connect() as connection:
+        plan = connection.execute(text(
+            "EXPLAIN QUERY PLAN SELECT id FROM video WHERE watched = 0"
+            " ORDER BY publication_dt DESC"
+        )).all()
+    assert "ix_video_watched_publication_dt" in str(plan)
+
+
+def test_failed_migration_is_rolled_back(
+    engine: Engine,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    migrate(engine, Base.metadata)
+
+    def add_table_then_fail(connection, metadata):  # type: ignore
+        connection.execute(text("CREATE TABLE extra (id INTEGER)"))
+        raise ValueError
+
+    monkeypatch.setattr(
+        migrations,
+        "MIGRATIONS",
+        migrations.MIGRATIONS + [add_table_then_fail],
+    )
+    monkeypatch.setattr(migrations, "SCHEMA_VERSION", SCHEMA_VERSION + 1)
+    with pytest.raises(ValueError):
+        migrate(engine, Base.metadata)
+    assert get_user_version_of(engine) == SCHEMA_VERSION
+    assert "extra" not in inspect(engine).get_table_names()
+
+
+def test_rebuild_table(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE item (id INTEGER PRIMARY KEY, name VARCHAR,"
+            " dropped VARCHAR)"
+        ))
+        connection.execute(text(
+            "INSERT INTO item VALUES (1, 'a', 'x'), (2, 'b', 'y')"
+        ))
+    metadata = MetaData()
+    table = Table(
+        "item",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String, nullable=False),
+        Column("name_length", Integer),
+        Index("ix_item_name", "name"),
+    )
+    with engine.begin() as connection:
+        migrations.rebuild_table(
+            connection,
+            table,
+            dict(name_length="length(name)"),
+        )
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT * FROM item")).all()
+    assert rows == [(1, "a", 1), (2, "b", 1)]
+    assert [
+        index["name"] for index in inspect(engine).get_indexes("item")
+    ] == ["ix_item_name"]
+
+
+def test_channels_get_last_polled(engine: Engine) -> None:
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE channel (id VARCHAR(24) PRIMARY KEY, title VARCHAR,"
+            " last_updated DATETIME)"
+        ))
+        connection.execute(text(
+            "INSERT INTO channel VALUES"
+            " ('A', 'A', '2024-01-01 12:00:00.000000'), ('B', 'B', NULL)"
+        ))
+        migrations.set_user_version(connection, 2)
+    migrate(engine, Base.metadata)
+    with engine.connect() as connection:
+        rows = connection.execute(text(
+            "SELECT id, last_polled FROM channel ORDER BY id"
+        )).all()
+    assert rows == [("A", "2024-01-01 12:00:00.000000"), ("B", None)]
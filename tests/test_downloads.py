@@ -0,0 +1,210 @@
+from datetime import datetime, timedelta
+from typing import Any
+
+import pytest
+from sqlalchemy import select
+import yt_dlp
+
+from yrp.backend import delete_videos, remove_channels
+from yrp.config import DownloadConfig
+from yrp.download import close_youtube_dls, get_youtube_dl
+from yrp.db import DownloadJob, Session, Video
+from yrp.downloads import PRIORITY_PREFETCH, PRIORITY_USER, DownloadManager
+from yrp.progress import ProgressAggregator
+
+
+class FakeDownload:
+    def __init__(self, failures: int = 0) -> None:
+        self.failures = failures
+        self.video_ids: list[str] = []
+
+    def __call__(self, video_id: str, **kwargs: Any) -> None:
+        self.video_ids.append(video_id)
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError(video_id)
+
+
+def add_videos(*video_ids: str, downloading: bool = False) -> None:
+    with Session.begin() as session:
+        session.add_all([
+            Video(
+                id=video_id,
+                title=video_id,
+                publication_dt=datetime.now(),
+                channel_id="A",
+                downloading=downloading,
+            )
+            for video_id in video_ids
+        ])
+
+
+def get_job_states() -> dict[str, str]:
+    with Session() as session:
+        return {
+            video_id: state
+            for video_id, state in session.execute(
+                select(DownloadJob.video_id, DownloadJob.state)
+            )
+        }
+
+
+def test_jobs_run_by_priority() -> None:
+    add_videos("A1", "A2", "A3")
+    download = FakeDownload()
+    manager = DownloadManager(DownloadConfig(), download)
+    manager.enqueue("A1", PRIORITY_PREFETCH)
+    manager.enqueue("A2", PRIORITY_PREFETCH)
+    manager.enqueue("A3", PRIORITY_USER)
+    while manager.run_next():
+        pass
+    assert download.video_ids == ["A3", "A1", "A2"]
+    assert get_job_states() == {}
+
+
+def test_enqueue_again_raises_priority() -> None:
+    add_videos("A1", "A2")
+    download = FakeDownload()
+    manager = DownloadManager(DownloadConfig(), download)
+    manager.enqueue("A1", PRIORITY_PREFETCH)
+    manager.enqueue("A2", PRIORITY_PREFETCH)
+    manager.enqueue("A2", PRIORITY_USER)
+    manager.enqueue("A2", PRIORITY_PREFETCH)
+    manager.run_next()
+    assert download.video_ids == ["A2"]
+
+
+def test_failed_jobs_are_retried() -> None:
+    add_videos("A1")
+    download = FakeDownload(failures=3)
+    download_config = DownloadConfig(max_attempts=2, retry_delay_seconds=0)
+    manager = DownloadManager(download_config, download)
+    manager.enqueue("A1")
+    while manager.run_next():
+        pass
+    assert download.video_ids == ["A1", "A1"]
+    assert get_job_states() == {"A1": "failed"}
+    manager.enqueue("A1")
+    while manager.run_next():
+        pass
+    assert download.video_ids == ["A1", "A1", "A1", "A1"]
+    assert get_job_states() == {}
+
+
+def test_failed_jobs_wait_before_retrying() -> None:
+    add_videos("A1", "A2")
+    download = FakeDownload(failures=1)
+    manager = DownloadManager(DownloadConfig(), download)
+    manager.enqueue("A1", PRIORITY_USER)
+    manager.enqueue("A2", PRIORITY_PREFETCH)
+    while manager.run_next():
+        pass
+    assert download.video_ids == ["A1", "A2"]
+    assert get_job_states() == {"A1": "queued"}
+    with Session() as session:
+        not_before = session.scalar(select(DownloadJob.not_before))
+    assert not_before is not None
+    assert not_before > datetime.now() + timedelta(seconds=30)
+
+
+def test_deleted_videos_lose_their_jobs() -> None:
+    add_videos("A1", "A2")
+    manager = DownloadManager(DownloadConfig(), FakeDownload())
+    manager.enqueue("A1")
+    manager.enqueue("A2")
+    delete_videos(["A1"])
+    assert get_job_states() == {"A2": "queued"}
+    remove_channels(["A"])
+    assert get_job_states() == {}
+
+
+def test_recover_interrupted_jobs() -> None:
+    add_videos("A1", "A2", downloading=True)
+    with Session.begin() as session:
+        session.add(DownloadJob(
+            video_id="A1",
+            state="running",
+            created=datetime.now(),
+            pid=2**22 + 1,
+        ))
+    manager = DownloadManager(DownloadConfig(), FakeDownload())
+    manager.recover()
+    assert get_job_states() == {"A1": "queued"}
+    with Session() as session:
+        assert not any(session.scalars(select(Video.downloading)))
+
+
+class FakeYoutubeDL:
+    def __init__(self, options: dict[str, Any]) -> None:
+        self.options = options
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+def test_youtube_dls_are_closed(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(yt_dlp, "YoutubeDL", FakeYoutubeDL)
+    ydl = get_youtube_dl(dict(format="best"))
+    assert get_youtube_dl(dict(format="best")) is ydl
+    other_ydl = get_youtube_dl(dict(format="worst"))
+    assert ydl.closed
+    assert not other_ydl.closed
+    manager = DownloadManager(DownloadConfig(), FakeDownload())
+    manager.start()
+    manager.stop()
+    assert other_ydl.closed
+    assert not get_youtube_dl(dict(format="worst")).closed
+    close_youtube_dls()
+
+
+def test_jobs_keep_their_options_across_processes() -> None:
+    add_videos("A1", "A2")
+    download = FakeDownload()
+    kwargs: dict[str, dict[str, Any]] = {}
+
+    def record(video_id: str, **download_kwargs: Any) -> None:
+        kwargs[video_id] = download_kwargs
+        download(video_id)
+
+    DownloadManager(DownloadConfig()).enqueue("A1", with_notification=True)
+    DownloadManager(DownloadConfig()).enqueue("A2")
+    # A manager of another process runs the jobs
+    manager = DownloadManager(DownloadConfig(), record)
+    while manager.run_next():
+        pass
+    assert kwargs["A1"]["with_notification"]
+    assert not kwargs["A2"]["with_notification"]
+
+
+def test_progress_is_written_to_the_job() -> None:
+    add_videos("A1")
+    job_progress = []
+
+    def download(
+        video_id: str,
+        progress: ProgressAggregator,
+        **kwargs: Any,
+    ) -> None:
+        progress.hook(dict(downloaded_bytes=1, total_bytes=4))
+        job_progress.append(manager.get_job_progress(["A1"]))
+
+    manager = DownloadManager(DownloadConfig(), download)
+    manager.enqueue("A1")
+    assert manager.get_job_progress(["A1"]) == {"A1": ("queued", None)}
+    manager.run_next()
+    assert job_progress == [{"A1": ("running", 0.25)}]
+    assert manager.get_job_progress(["A1"]) == {}
+
+
+def test_videos_being_downloaded_are_not_claimed() -> None:
+    add_videos("A1", downloading=True)
+    add_videos("A2")
+    download = FakeDownload()
+    manager = DownloadManager(DownloadConfig(), download)
+    manager.enqueue("A1")
+    manager.enqueue("A2")
+    while manager.run_next():
+        pass
+    assert download.video_ids == ["A2"]
+    assert get_job_states() == {"A1": "queued"}
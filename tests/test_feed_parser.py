@@ -0,0 +1,48 @@
+from datetime import datetime, timezone
+from yrp.feed import FeedParser
+
+
+FEED = b"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015"
+      xmlns:media="http://search.yahoo.com/mrss/"
+      xmlns="http://www.w3.org/2005/Atom">
+ <id>yt:channel:UCXuqSBlHAE6Xw-yeJA0Tunw</id>
+ <yt:channelId>UCXuqSBlHAE6Xw-yeJA0Tunw</yt:channelId>
+ <title>Channel A</title>
+ <published>2010-01-01T00:00:00+00:00</published>
+ <entry>
+  <id>yt:video:A2</id>
+  <yt:videoId>A2</yt:videoId>
+  <title>Video A2</title>
+  <published>2000-01-02T12:00:00+00:00</published>
+  <media:group><media:title>Video A2</media:title></media:group>
+ </entry>
+ <entry>
+  <id>yt:video:A1</id>
+  <yt:videoId>A1</yt:videoId>
+  <title>Video A1</title>
+  <published>2000-01-01T12:00:00+01:00</published>
+ </entry>
+</feed>
+"""
+
+
+def test_feed_parser_in_chunks() -> None:
+    parser = FeedParser()
+    entries = []
+    for i in range(0, len(FEED), 7):
+        entries.extend(parser.feed(FEED[i:i+7]))
+    parser.close()
+    assert parser.title == "Channel A"
+    assert [entry["yt_videoid"] for entry in entries] == ["A2", "A1"]
+    assert entries[0]["title"] == "Video A2"
+    published = datetime(2000, 1, 1, 11, tzinfo=timezone.utc)
+    assert entries[1]["published_parsed"] == published.utctimetuple()
+
+
+def test_feed_parser_yields_entries_before_end_of_document() -> None:
+    parser = FeedParser()
+    end_of_first_entry = FEED.index(b"</entry>") + len(b"</entry>")
+    entries = list(parser.feed(FEED[:end_of_first_entry]))
+    assert parser.title == "Channel A"
+    assert [entry["yt_videoid"] for entry in entries] == ["A2"]
@@ -1,9 +1,17 @@
 import asyncio
+import hashlib
 from datetime import datetime
-from yrp.db import Session, AsyncSession, Channel, Video, Base
+from yrp.db import Session, AsyncSession, Channel, FeedCache, Video, Base
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncEngine
-from yrp.backend import upload_feed_data, Feed, Entry, ParsedFeed
+from yrp.backend import upload_feed_data, Feed, VideoEntry, ParsedFeed
+import yrp.backend as backend
+from yrp.config import SchedulerConfig
+from yrp.scheduler import Scheduler
+from yrp.feed import FeedValidators
+from yrp.ingest import FeedUpdate, write_feed_updates
+import aiohttp
+from aiohttp import web
 import pytest
 
 
@@ -13,7 +21,7 @@ async def test_feed_upload(async_engine: AsyncEngine, async_db: None) -> None:
     video_id = 'A1'
     feed = Feed(title=channel_id)
     publication_dt = datetime(year=2000, month=1, day=1)
-    entry = Entry(
+    entry = VideoEntry(
         yt_videoid=video_id,
         title=video_id,
         published_parsed=publication_dt.timetuple(),
@@ -52,7 +60,7 @@ async def test_feed_upload_with_existing_video(
     video_id = 'A1'
     feed = Feed(title=channel_id)
     publication_dt = datetime(year=2000, month=1, day=1)
-    entry = Entry(
+    entry = VideoEntry(
         yt_videoid=video_id,
         title=video_id,
         published_parsed=publication_dt.timetuple(),
@@ -92,3 +100,243 @@ async def test_feed_upload_with_existing_video(
         assert new_video.id == parsed_feed["entries"][0]["yt_videoid"]
         assert new_video.publication_dt == publication_dt
 
+
+
+@pytest.mark.asyncio
+async def test_write_feed_updates_batch(
+    async_engine: AsyncEngine,
+    async_db: None
+) -> None:
+    publication_dt = datetime(year=2000, month=1, day=1)
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+    async with AsyncSession() as session:
+        channel_a = Channel(id='A')
+        channel_a.videos = [
+            Video(
+                id='A1',
+                title='A1',
+                publication_dt=publication_dt,
+                channel_id='A',
+                watched=True,
+            )
+        ]
+        session.add_all([channel_a, Channel(id='B')])
+        await session.commit()
+
+    def make_entry(video_id: str) -> VideoEntry:
+        return VideoEntry(
+            yt_videoid=video_id,
+            title=f'New {video_id}',
+            published_parsed=publication_dt.timetuple(),
+        )
+
+    feed_updates = [
+        FeedUpdate(
+            channel_id='A',
+            title='Channel A',
+            entries=[make_entry('A2'), make_entry('A1')],
+            validators=FeedValidators(
+                etag='"a"',
+                last_modified=None,
+                content_hash=None,
+            ),
+        ),
+        FeedUpdate(
+            channel_id='B',
+            title='Channel B',
+            entries=[make_entry('B1')],
+        ),
+    ]
+    new_videos = await write_feed_updates(feed_updates)
+    assert new_videos == {'A2': publication_dt, 'B1': publication_dt}
+
+    async with AsyncSession() as session:
+        channels = (await session.scalars(select(Channel))).all()
+        assert {c.id: c.title for c in channels} == {
+            'A': 'Channel A',
+            'B': 'Channel B',
+        }
+        videos = (await session.scalars(select(Video))).all()
+        assert {v.id for v in videos} == {'A1', 'A2', 'B1'}
+        existing_video = await session.get_one(Video, 'A1')
+        assert existing_video.title == 'A1'
+        assert existing_video.watched
+        feed_cache = await session.get_one(FeedCache, 'A')
+        assert feed_cache.etag == '"a"'
+        assert all(c.last_polled is not None for c in channels)
+        polled_dt = (await session.get_one(Channel, 'B')).last_polled
+
+    # A feed that was not modified only records the poll
+    assert await write_feed_updates([FeedUpdate(channel_id='B')]) == {}
+    async with AsyncSession() as session:
+        channel_b = await session.get_one(Channel, 'B')
+        assert channel_b.title == 'Channel B'
+        assert channel_b.last_polled > polled_dt
+
+
+@pytest.mark.asyncio
+async def test_updates_of_removed_channels_are_dropped(
+    async_engine: AsyncEngine,
+    async_db: None
+) -> None:
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession.begin() as session:
+        session.add(Channel(id='A'))
+
+    def make_entry(video_id: str) -> VideoEntry:
+        return VideoEntry(
+            yt_videoid=video_id,
+            title=video_id,
+            published_parsed=datetime(2000, 1, 1).timetuple(),
+        )
+
+    validators = FeedValidators(
+        etag='"b"',
+        last_modified=None,
+        content_hash=None,
+    )
+    new_videos = await write_feed_updates([
+        FeedUpdate(
+            channel_id='A',
+            title='Channel A',
+            entries=[make_entry('A1')],
+        ),
+        FeedUpdate(
+            channel_id='B',
+            title='Channel B',
+            entries=[make_entry('B1')],
+            validators=validators,
+        ),
+    ])
+    assert list(new_videos) == ['A1']
+    async with AsyncSession() as session:
+        assert (await session.get_one(Channel, 'A')).title == 'Channel A'
+        assert await session.get(Channel, 'B') is None
+        assert (await session.scalars(select(Video.id))).all() == ['A1']
+        assert await session.get(FeedCache, 'B') is None
+
+
+@pytest.mark.asyncio
+async def test_missing_thumbnail_still_calls_back(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    app = web.Application()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    monkeypatch.setattr(
+        backend,
+        "get_thumbnail_url",
+        f"http://127.0.0.1:{port}/vi/{{video_id}}/mqdefault.jpg".format,
+    )
+    called_back: list[str] = []
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            await backend.download_thumbnail(
+                http_session,
+                'A1',
+                called_back.append,
+                Scheduler(SchedulerConfig()),
+            )
+    finally:
+        await runner.cleanup()
+    assert called_back == ['A1']
+
+
+FEED = b"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015"
+      xmlns="http://www.w3.org/2005/Atom">
+ <title>Channel A</title>
+ <entry>
+  <yt:videoId>A3</yt:videoId>
+  <title>Video A3</title>
+  <published>2000-01-03T12:00:00+00:00</published>
+ </entry>
+ <entry>
+  <yt:videoId>A2</yt:videoId>
+  <title>Video A2</title>
+  <published>2000-01-02T12:00:00+00:00</published>
+ </entry>
+ <entry>
+  <yt:videoId>A1</yt:videoId>
+  <title>Video A1</title>
+  <published>2000-01-01T12:00:00+00:00</published>
+ </entry>
+</feed>
+"""
+
+
+@pytest.mark.asyncio
+async def test_read_new_entries_hashes_whole_body(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async def handle_feed(request: web.Request) -> web.Response:
+        return web.Response(body=FEED)
+
+    app = web.Application()
+    app.router.add_get("/feed", handle_feed)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    monkeypatch.setattr(backend, "FEED_CHUNK_SIZE", 16)
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            url = f"http://127.0.0.1:{port}/feed"
+            async with http_session.get(url) as resp:
+                parsed_feed, content_hash = await backend.read_new_entries(
+                    resp,
+                    'A',
+                    {'A2'},
+                )
+                # The body is drained so the connection can be reused
+                assert resp.content.at_eof()
+    finally:
+        await runner.cleanup()
+    assert parsed_feed["feed"]["title"] == 'Channel A'
+    assert [entry["yt_videoid"] for entry in parsed_feed["entries"]] == ['A3']
+    assert content_hash == hashlib.sha256(FEED).hexdigest()
+
+
+class Abort(BaseException):
+    pass
+
+
+@pytest.mark.asyncio
+async def test_fetch_feeds_writes_fetched_feeds_on_abort(
+    async_engine: AsyncEngine,
+    async_db: None,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    async with AsyncSession.begin() as session:
+        session.add_all([Channel(id='A'), Channel(id='B')])
+
+    async def fetch_feed_into_queue(
+        queue: asyncio.Queue[FeedUpdate],
+        http_session: aiohttp.ClientSession,
+        channel_id: str,
+        *args: object,
+        **kwargs: object,
+    ) -> None:
+        if channel_id == 'B':
+            raise Abort
+        await queue.put(FeedUpdate(channel_id=channel_id, title='Channel A'))
+
+    monkeypatch.setattr(
+        backend,
+        "fetch_feed_into_queue",
+        fetch_feed_into_queue,
+    )
+    with pytest.raises(BaseExceptionGroup):
+        await backend.fetch_feeds(channel_ids=['A', 'B'])
+    async with AsyncSession() as session:
+        assert (await session.get_one(Channel, 'A')).title == 'Channel A'
+    assert asyncio.all_tasks() == {asyncio.current_task()}
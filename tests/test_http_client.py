@@ -0,0 +1,35 @@
+from collections.abc import AsyncIterator
+
+from aiohttp import web
+import pytest
+import pytest_asyncio
+
+from yrp.http_client import PoolStats, create_http_session
+
+
+@pytest_asyncio.fixture
+async def server_url() -> AsyncIterator[str]:
+    async def handler(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield f"http://127.0.0.1:{port}/"
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_pool_stats_count_reused_connections(server_url: str) -> None:
+    stats = PoolStats()
+    async with create_http_session(stats) as http_session:
+        for _ in range(3):
+            async with http_session.get(server_url) as resp:
+                assert await resp.text() == "ok"
+    assert stats.requests == 3
+    assert stats.connections_created == 1
+    assert stats.connections_reused == 2
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+# Modules that dominate the import time of yrp and are only needed once a
+# download, a refresh or a notification actually starts
+DEFERRED_MODULES = {
+    "aiofiles",
+    "aiohttp",
+    "bs4",
+    "gi.repository",
+    "requests",
+    "yt_dlp",
+}
+
+
+def get_imported_modules(module: str) -> dict[str, int]:
+    """Cumulative import time in microseconds of every module imported"""
+    process = subprocess.run(
+        (sys.executable, "-X", "importtime", "-c", f"import {module}"),
+        capture_output=True,
+        text=True,
+        check=True,
+        # Same import path as the tests
+        env=os.environ | dict(PYTHONPATH=os.pathsep.join(sys.path)),
+    )
+    imported_modules = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.removeprefix("import time:").split("|")
+        imported_modules[name.strip()] = int(cumulative)
+    return imported_modules
+
+
+@pytest.mark.parametrize(
+    "module",
+    ["yrp.backend", "yrp.downloads", "yrp.prefetch", "yrp.stream"],
+)
+def test_heavy_modules_are_imported_lazily(module: str) -> None:
+    imported_modules = get_imported_modules(module)
+    assert module in imported_modules
+    assert DEFERRED_MODULES.isdisjoint(imported_modules)
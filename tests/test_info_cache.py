@@ -0,0 +1,77 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any
+import json
+
+from yrp.download import (
+    DEFAULT_INFO_TTL, InfoCache, get_selected_formats, get_stream_expiry
+)
+
+
+NOW = datetime(2024, 1, 1, 12)
+
+
+def make_format(format_id: str, expiry_dt: datetime) -> dict[str, Any]:
+    expire = int(expiry_dt.timestamp())
+    return dict(
+        format_id=format_id,
+        url=f"https://example.com/videoplayback?expire={expire}&id=1",
+    )
+
+
+def test_stream_expiry() -> None:
+    info = dict(formats=[
+        make_format("1", NOW + timedelta(hours=6)),
+        make_format("2", NOW + timedelta(hours=5)),
+        dict(format_id="3", url="https://example.com/expire/0/x"),
+    ])
+    assert get_stream_expiry(info) == datetime.fromtimestamp(0)
+    info["formats"].pop()
+    assert get_stream_expiry(info) == NOW + timedelta(hours=5)
+    assert get_stream_expiry(dict(formats=[])) is None
+
+
+def test_selected_formats() -> None:
+    info = dict(
+        formats=[
+            make_format(format_id, NOW)
+            for format_id in ("1", "2", "3")
+        ],
+        requested_formats=[dict(format_id="1"), dict(format_id="3")],
+    )
+    formats = get_selected_formats(info)["formats"]
+    assert [format_["format_id"] for format_ in formats] == ["1", "3"]
+
+
+def test_info_expires_with_streams(tmp_path: Path) -> None:
+    info_cache = InfoCache(tmp_path)
+    info = dict(id="A1", formats=[make_format("1", NOW + timedelta(hours=1))])
+    info_cache.put("A1", info)
+    assert info_cache.get("A1", NOW) == info
+    assert info_cache.get("A1", NOW + timedelta(hours=1)) is None
+    assert not info_cache.get_path("A1").exists()
+
+
+def test_info_without_streams_expires_after_ttl(tmp_path: Path) -> None:
+    info_cache = InfoCache(tmp_path)
+    info = dict(id="A1", epoch=int(NOW.timestamp()))
+    info_cache.put("A1", info)
+    info_cache.get_path("A2").write_text("{")
+    info_cache.evict(NOW)
+    assert info_cache.get("A1", NOW) == info
+    assert not info_cache.get_path("A2").exists()
+    info_cache.evict(NOW + DEFAULT_INFO_TTL)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_concurrent_puts_replace_info_atomically(tmp_path: Path) -> None:
+    info_cache = InfoCache(tmp_path)
+    infos = [dict(id="A1", epoch=i, title="x" * 2**16) for i in range(32)]
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda info: info_cache.put("A1", info), infos))
+    # One complete info won and no partial file is left behind
+    assert info_cache.get_path("A1").read_text() in {
+        json.dumps(info) for info in infos
+    }
+    assert list(tmp_path.iterdir()) == [info_cache.get_path("A1")]
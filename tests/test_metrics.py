@@ -0,0 +1,141 @@
+from pathlib import Path
+from urllib.request import urlopen
+import json
+import sys
+
+import pytest
+
+import yrp.config as config
+import yrp.download as download
+from yrp.config import MetricsConfig
+from yrp.download import DownloadTimer
+from yrp.metrics import SLOWEST_COUNT, Metrics
+
+
+def test_histogram() -> None:
+    metrics = Metrics(buckets=(0.1, 1))
+    for seconds in (0.05, 0.1, 0.5, 2):
+        metrics.observe("feed_request", seconds)
+    histogram = metrics.histograms["feed_request"]
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.get_cumulative_counts() == [2, 3, 4]
+    assert histogram.count == 4
+    assert histogram.total == pytest.approx(2.65)
+
+
+def test_slowest() -> None:
+    metrics = Metrics()
+    for i in range(SLOWEST_COUNT * 2):
+        metrics.observe("thumbnail", i, video_id=str(i))
+    slowest = metrics.to_json()["stages"]["thumbnail"]["slowest"]
+    assert [item["video_id"] for item in slowest] == [
+        str(i) for i in reversed(range(SLOWEST_COUNT, SLOWEST_COUNT * 2))
+    ]
+
+
+def test_span_records_failures() -> None:
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.span("db_write", feeds=1):
+            raise ValueError
+    assert metrics.histograms["db_write"].count == 1
+    assert metrics.histograms["db_write"].slowest[0][2] == dict(feeds=1)
+
+
+def test_prometheus() -> None:
+    metrics = Metrics(buckets=(0.5,))
+    metrics.observe("feed_parse", 0.25)
+    metrics.add_bytes("feed", 100)
+    metrics.add_bytes("feed", 50)
+    lines = metrics.to_prometheus().splitlines()
+    assert 'yrp_stage_seconds_bucket{stage="feed_parse",le="0.5"} 1' in lines
+    assert 'yrp_stage_seconds_bucket{stage="feed_parse",le="+Inf"} 1' in lines
+    assert 'yrp_stage_seconds_sum{stage="feed_parse"} 0.25' in lines
+    assert 'yrp_stage_seconds_count{stage="feed_parse"} 1' in lines
+    assert 'yrp_bytes_total{stage="feed"} 150' in lines
+
+
+def test_serve() -> None:
+    metrics = Metrics()
+    metrics.add_bytes("thumbnail", 1)
+    port = metrics.serve(0)
+    try:
+        with urlopen(f"http://127.0.0.1:{port}/metrics") as resp:
+            body = resp.read().decode()
+    finally:
+        metrics.stop()
+    assert 'yrp_bytes_total{stage="thumbnail"} 1' in body.splitlines()
+
+
+def test_export(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    metrics = Metrics()
+    metrics.observe("refresh", 1.5, channels=2)
+    metrics.export()
+    assert list(tmp_path.iterdir()) == []
+    path = tmp_path / "metrics.json"
+    metrics_config = MetricsConfig(json_file=path)
+    monkeypatch.setattr(config, "metrics_config", metrics_config)
+    metrics.export()
+    assert list(tmp_path.iterdir()) == [path]
+    stage = json.loads(path.read_text())["stages"]["refresh"]
+    assert stage["count"] == 1
+    assert stage["buckets"]["+Inf"] == 1
+    assert stage["slowest"] == [dict(seconds=1.5, channels=2)]
+
+
+def test_opentelemetry_is_optional(monkeypatch: pytest.MonkeyPatch) -> None:
+    # None in sys.modules makes the import fail even when it is installed
+    monkeypatch.setitem(sys.modules, "opentelemetry", None)
+    metrics = Metrics()
+    metrics.start(MetricsConfig(opentelemetry=True))
+    assert metrics.tracer is None
+    with metrics.span("refresh"):
+        pass
+    assert metrics.histograms["refresh"].count == 1
+
+
+def test_download_timer(monkeypatch: pytest.MonkeyPatch) -> None:
+    metrics = Metrics()
+    monkeypatch.setattr(download, "metrics", metrics)
+    timer = DownloadTimer("video")
+    timer.progress_hook(dict(status="downloading", elapsed=1))
+    for elapsed in (2, 3):
+        timer.progress_hook(
+            dict(status="finished", elapsed=elapsed, total_bytes=10)
+        )
+    timer.postprocessor_hook(dict(status="started", postprocessor="Merger"))
+    timer.postprocessor_hook(dict(status="finished", postprocessor="Merger"))
+    timer.postprocessor_hook(
+        dict(status="finished", postprocessor="FFmpegMetadata")
+    )
+    assert metrics.histograms["ytdlp_transfer"].total == 5
+    assert metrics.bytes == dict(video=20)
+    assert metrics.histograms["ytdlp_merge"].slowest[0][2] == dict(
+        video_id="video",
+        postprocessor="Merger",
+    )
+    assert "ytdlp_postprocess" not in metrics.histograms
+
+
+def test_taken_port_is_logged(caplog: pytest.LogCaptureFixture) -> None:
+    first = Metrics()
+    port = first.serve(0)
+    try:
+        second = Metrics()
+        second.start(MetricsConfig(prometheus_port=port))
+    finally:
+        first.stop()
+    assert second._server is None
+    assert f"Could not serve metrics on port {port}" in caplog.text
+
+
+def test_export_per_process(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    metrics_config = MetricsConfig(json_file=tmp_path / "metrics.json")
+    monkeypatch.setattr(config, "metrics_config", metrics_config)
+    metrics = Metrics()
+    metrics.start(metrics_config, process_name="daemon")
+    metrics.export()
+    assert list(tmp_path.iterdir()) == [tmp_path / "metrics.daemon.json"]
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import pytest
+
+import yrp.config as config
+from yrp.config import DownloadConfig, PrefetchConfig
+from yrp.db import Session, Video
+from yrp.downloads import DownloadManager
+from yrp.prefetch import get_candidates, is_idle_time, prefetch
+
+
+NOW = datetime(2024, 1, 1, 12)
+
+
+@pytest.fixture(autouse=True)
+def video_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(config, "video_dir", tmp_path)
+    return tmp_path
+
+
+def add_video(
+    video_id: str,
+    channel_id: str,
+    age: timedelta,
+    watched: bool = False,
+) -> None:
+    with Session.begin() as session:
+        session.add(Video(
+            id=video_id,
+            title=video_id,
+            publication_dt=NOW - age,
+            channel_id=channel_id,
+            watched=watched,
+        ))
+
+
+def test_is_idle_time() -> None:
+    assert is_idle_time(NOW, [])
+    assert is_idle_time(NOW, ["11:00-13:00"])
+    assert not is_idle_time(NOW, ["13:00-11:00"])
+    assert is_idle_time(NOW.replace(hour=1), ["23:00-06:00"])
+    assert not is_idle_time(NOW, ["23:00-06:00", "08:00-09:00"])
+
+
+def test_candidates_ranked_by_watch_history_and_age(video_dir: Path) -> None:
+    for i in range(4):
+        add_video(f"A{i}", "A", timedelta(days=2), watched=True)
+        add_video(f"B{i}", "B", timedelta(days=2))
+    add_video("A_new", "A", timedelta(hours=1))
+    add_video("A_old", "A", timedelta(hours=20))
+    # Listed by neither the UI nor clean_assets
+    add_video("A_unlisted", "A", timedelta(hours=30))
+    add_video("B_new", "B", timedelta(hours=1))
+    add_video("A_expired", "A", timedelta(days=30))
+    add_video("A_done", "A", timedelta(hours=1))
+    (video_dir / "A_done.mkv").touch()
+    candidates = get_candidates(NOW, PrefetchConfig())
+    assert candidates[:3] == ["A_new", "A_old", "B_new"]
+    assert "A_expired" not in candidates
+    assert "A_unlisted" not in candidates
+    assert "A_done" not in candidates
+
+
+def test_prefetch_fills_free_slots(video_dir: Path) -> None:
+    for i in range(3):
+        add_video(f"A{i}", "A", timedelta(hours=i))
+    (video_dir / "A0.mkv").touch()
+    # Deleted by the next clean_assets, so it does not take a slot
+    add_video("A_old", "A", timedelta(days=3))
+    (video_dir / "A_old.mkv").touch()
+    manager = DownloadManager(DownloadConfig())
+    prefetch_config = PrefetchConfig(max_videos=2)
+    assert prefetch(manager, NOW, prefetch_config) == ["A1"]
+    assert prefetch(manager, NOW, prefetch_config) == []
+    prefetch_config = PrefetchConfig(idle_windows=["00:00-01:00"])
+    assert prefetch(manager, NOW, prefetch_config) == []
+
@@ -0,0 +1,73 @@
+from yrp.config import ProgressConfig
+from yrp.observer import Observable, Observer
+from yrp.progress import Progress, ProgressAggregator, parse_progress
+
+
+class RecordingObserver(Observer):
+    def __init__(self, observable: Observable) -> None:
+        super().__init__(observable)
+        self.updates: list[Progress] = []
+
+    def notify(self, observable: Observable, progress: Progress) -> None:
+        self.updates.append(progress)
+
+
+def make_aggregator() -> tuple[ProgressAggregator, RecordingObserver]:
+    progress_config = ProgressConfig(max_rate_hz=10, min_change=0.01)
+    aggregator = ProgressAggregator("A1", progress_config)
+    return aggregator, RecordingObserver(aggregator)
+
+
+def test_parse_progress() -> None:
+    assert parse_progress(dict(fragment_index=1, fragment_count=3)) == 0.25
+    assert parse_progress(dict(fragment_index=9, fragment_count=3)) == 1
+    assert parse_progress(
+        dict(downloaded_bytes=1, total_bytes_estimate=4)
+    ) == 0.25
+    assert parse_progress(dict(downloaded_bytes=1, total_bytes=None)) is None
+    assert parse_progress(dict(status="finished")) == 1
+
+
+def test_updates_are_coalesced() -> None:
+    aggregator, observer = make_aggregator()
+    for i in range(1000):
+        aggregator.update(
+            dict(status="downloading", downloaded_bytes=i, total_bytes=1000),
+            now=i / 1000,
+        )
+    aggregator.update(
+        dict(status="finished", downloaded_bytes=1000, total_bytes=1000),
+        now=1,
+    )
+    assert len(observer.updates) == 11
+    assert observer.updates[-1].status == "finished"
+    assert observer.updates[-1].fraction == 1
+
+
+def test_small_changes_only_sent_as_heartbeat() -> None:
+    aggregator, observer = make_aggregator()
+    for i in range(30):
+        aggregator.update(
+            dict(downloaded_bytes=i, total_bytes=10_000),
+            now=i / 10,
+        )
+    assert [update.fraction for update in observer.updates] == [
+        0, 10 / 10_000, 20 / 10_000
+    ]
+
+
+def test_speed_and_eta() -> None:
+    aggregator, observer = make_aggregator()
+    for i in range(5):
+        aggregator.update(
+            dict(downloaded_bytes=i * 100, total_bytes=1000),
+            now=i,
+        )
+    last = observer.updates[-1]
+    assert last.speed == 100
+    assert last.eta == 6
+    # Merged downloads start counting from zero for every file
+    aggregator.update(dict(downloaded_bytes=0, total_bytes=1000), now=6)
+    aggregator.update(dict(downloaded_bytes=300, total_bytes=1000), now=7)
+    last = observer.updates[-1]
+    assert last.speed == 100 + 0.3 * 200
@@ -0,0 +1,181 @@
+import asyncio
+from collections.abc import AsyncIterator
+
+import aiohttp
+from aiohttp import web
+import pytest
+import pytest_asyncio
+
+from yrp.config import SchedulerConfig
+from yrp.metrics import Metrics
+import yrp.scheduler as scheduler_module
+from yrp.scheduler import Scheduler, TokenBucket
+
+
+@pytest_asyncio.fixture
+async def flaky_server() -> AsyncIterator[tuple[str, list[int]]]:
+    hits: list[int] = []
+
+    async def handler(request: web.Request) -> web.Response:
+        hits.append(len(hits))
+        if len(hits) <= 2:
+            return web.Response(status=503)
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    yield f"http://127.0.0.1:{port}/", hits
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_request_retries_server_errors(
+    flaky_server: tuple[str, list[int]],
+) -> None:
+    url, hits = flaky_server
+    scheduler = Scheduler(SchedulerConfig(backoff_base=0.001))
+    async with aiohttp.ClientSession() as http_session:
+        async with scheduler.request(http_session, "GET", url) as resp:
+            assert resp.status == 200
+            assert await resp.text() == "ok"
+    assert len(hits) == 3
+
+
+@pytest.mark.asyncio
+async def test_request_gives_up_after_max_retries(
+    flaky_server: tuple[str, list[int]],
+) -> None:
+    url, hits = flaky_server
+    scheduler_config = SchedulerConfig(backoff_base=0.001, max_retries=1)
+    scheduler = Scheduler(scheduler_config)
+    async with aiohttp.ClientSession() as http_session:
+        async with scheduler.request(http_session, "GET", url) as resp:
+            assert resp.status == 503
+    assert len(hits) == 2
+
+
+@pytest.mark.asyncio
+async def test_isolate_keeps_other_tasks_running() -> None:
+    scheduler = Scheduler(SchedulerConfig())
+
+    async def fail() -> None:
+        raise ValueError("bad feed")
+
+    async def succeed() -> str:
+        await asyncio.sleep(0.01)
+        return "done"
+
+    async with asyncio.TaskGroup() as tg:
+        failed = tg.create_task(scheduler.isolate("fail", fail()))
+        succeeded = tg.create_task(scheduler.isolate("succeed", succeed()))
+    assert failed.result() is None
+    assert succeeded.result() == "done"
+    assert [name for name, _ in scheduler.failures] == ["fail"]
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate() -> None:
+    bucket = TokenBucket(rate=100, capacity=2)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    for _ in range(6):
+        await bucket.acquire()
+    # Two tokens are available straight away, the other four take 10ms each
+    assert loop.time() - start >= 0.035
+
+
+@pytest.mark.asyncio
+async def test_busy_host_does_not_hold_global_slots(
+    flaky_server: tuple[str, list[int]],
+) -> None:
+    url, hits = flaky_server
+    scheduler_config = SchedulerConfig(
+        max_concurrency=2,
+        max_concurrency_per_host=1,
+        max_retries=0,
+    )
+    scheduler = Scheduler(scheduler_config)
+    reading = asyncio.Event()
+    release = asyncio.Event()
+
+    async def read_slowly(http_session: aiohttp.ClientSession) -> None:
+        async with scheduler.request(http_session, "GET", url):
+            reading.set()
+            await release.wait()
+
+    other_host_url = url.replace("127.0.0.1", "localhost")
+    async with aiohttp.ClientSession() as http_session:
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(read_slowly(http_session))
+            await reading.wait()
+            # Waits for the slot of its host
+            tg.create_task(read_slowly(http_session))
+            await asyncio.sleep(0.01)
+            request = scheduler.request(http_session, "GET", other_host_url)
+            async with asyncio.timeout(5):
+                async with request as resp:
+                    assert resp.host == "localhost"
+            release.set()
+    assert len(hits) == 3
+
+
+@pytest.mark.asyncio
+async def test_request_records_wait_apart_from_stage(
+    flaky_server: tuple[str, list[int]],
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    metrics = Metrics()
+    monkeypatch.setattr(scheduler_module, "metrics", metrics)
+    url, hits = flaky_server
+    scheduler = Scheduler(SchedulerConfig(max_retries=0))
+    async with aiohttp.ClientSession() as http_session:
+        request = scheduler.request(
+            http_session,
+            "GET",
+            url,
+            stage="feed_request",
+            attributes=dict(channel_id="A"),
+        )
+        async with request as resp:
+            assert resp.status == 503
+    assert metrics.histograms["scheduler_wait"].count == 1
+    assert metrics.histograms["scheduler_wait"].slowest[0][2] == dict(
+        host="127.0.0.1",
+    )
+    assert metrics.histograms["feed_request"].slowest[0][2] == dict(
+        channel_id="A",
+    )
+
+
+@pytest.mark.asyncio
+async def test_retry_after_is_clamped() -> None:
+    hits: list[int] = []
+
+    async def handler(request: web.Request) -> web.Response:
+        hits.append(len(hits))
+        if len(hits) == 1:
+            return web.Response(status=429, headers={"Retry-After": "3600"})
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    scheduler = Scheduler(SchedulerConfig(backoff_max=0.01))
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            url = f"http://127.0.0.1:{port}/"
+            async with asyncio.timeout(5):
+                async with scheduler.request(http_session, "GET", url) as resp:
+                    assert resp.status == 200
+    finally:
+        await runner.cleanup()
+    assert len(hits) == 2
@@ -0,0 +1,122 @@
+from datetime import datetime
+from pathlib import Path
+from subprocess import Popen
+from threading import Event
+from typing import Any
+import sys
+
+import pytest
+from sqlalchemy import create_engine
+
+from yrp.db import Base, Session, Video
+from yrp.downloads import download_manager
+import yrp.stream as stream
+from yrp.stream import VideoStream, stream_video
+
+
+def python_command(code: str) -> tuple[str, ...]:
+    return (sys.executable, "-c", code)
+
+
+DOWNLOAD = python_command(
+    "import sys\n"
+    "for _ in range(64): sys.stdout.buffer.write(b'x' * 2**16)"
+)
+
+
+def test_stream_is_saved_and_played(tmp_path: Path) -> None:
+    path = tmp_path / "A1.mkv"
+    played_path = tmp_path / "played"
+    player = python_command(
+        "import shutil, sys\n"
+        f"with open({str(played_path)!r}, 'wb') as f:\n"
+        "    shutil.copyfileobj(sys.stdin.buffer, f)"
+    )
+    assert VideoStream(path, DOWNLOAD, player).run()
+    assert path.read_bytes() == b"x" * 2**22
+    assert played_path.read_bytes() == b"x" * 2**22
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["A1.mkv", "played"]
+
+
+def test_download_continues_after_player_exits(tmp_path: Path) -> None:
+    path = tmp_path / "A1.mkv"
+    player = python_command("import sys; sys.stdin.buffer.read(10)")
+    assert VideoStream(path, DOWNLOAD, player).run()
+    assert path.stat().st_size == 2**22
+
+
+def test_failed_download_is_discarded(tmp_path: Path) -> None:
+    path = tmp_path / "A1.mkv"
+    download = python_command("import sys; print('x'); sys.exit(1)")
+    player = python_command("import sys; sys.stdin.buffer.read()")
+    assert not VideoStream(path, download, player).run()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_missing_player_stops_download(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    processes: list[Popen[bytes]] = []
+
+    def record_popen(*args: Any, **kwargs: Any) -> Popen[bytes]:
+        process = Popen(*args, **kwargs)
+        processes.append(process)
+        return process
+
+    monkeypatch.setattr(stream, "Popen", record_popen)
+    path = tmp_path / "A1.mkv"
+    player = (str(tmp_path / "missing-player"),)
+    with pytest.raises(FileNotFoundError):
+        VideoStream(path, DOWNLOAD, player).run()
+    [downloader] = processes
+    # Killed and reaped instead of writing to a pipe nobody reads
+    assert downloader.returncode is not None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_video_with_download_job_is_not_streamed(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    monkeypatch.setattr(
+        download_manager,
+        "get_job_states",
+        lambda video_ids: dict(A1="running"),
+    )
+    assert stream_video("A1") is None
+
+
+def test_video_is_streamed_once(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    # The streaming thread needs to share the database
+    Session.configure(bind=create_engine(f"sqlite:///{tmp_path}/yrp.db"))
+    Base.metadata.create_all(Session().get_bind())
+    with Session.begin() as session:
+        session.add(Video(
+            id="A1",
+            title="A1",
+            publication_dt=datetime.now(),
+            channel_id="A",
+        ))
+    streaming = Event()
+    release = Event()
+
+    def run(self: VideoStream) -> bool:
+        streaming.set()
+        release.wait()
+        return False
+
+    monkeypatch.setattr(VideoStream, "run", run)
+    thread = stream_video("A1")
+    assert thread is not None
+    streaming.wait()
+    assert stream_video("A1") is None
+    release.set()
+    thread.join()
+    with Session() as session:
+        assert not session.get_one(Video, "A1").downloading
+    thread = stream_video("A1")
+    assert thread is not None
+    thread.join()
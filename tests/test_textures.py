@@ -0,0 +1,135 @@
+from threading import Event
+from time import sleep
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+import pytest
+
+pytest.importorskip("gi")
+
+import yrp.textures as textures
+from yrp.observer import Observable
+from yrp.textures import TextureCache, ThumbnailObserver
+
+
+class FakeLoad:
+    def __init__(self, textures: dict[str, object]) -> None:
+        self.textures = textures
+        self.video_ids: list[str] = []
+        self.release = Event()
+        self.release.set()
+
+    def __call__(self, video_id: str) -> Optional[object]:
+        self.video_ids.append(video_id)
+        self.release.wait()
+        return self.textures.get(video_id)
+
+
+@pytest.fixture(autouse=True)
+def main_loop(monkeypatch: pytest.MonkeyPatch) -> None:
+    # Callbacks run straight away instead of on the GTK main loop
+    def idle_add(callback: Callable[..., Any], *args: Any) -> None:
+        callback(*args)
+
+    monkeypatch.setattr(
+        textures,
+        "GLib",
+        SimpleNamespace(idle_add=idle_add, Error=Exception),
+    )
+
+
+def make_texture_cache(load: FakeLoad, max_textures: int = 2) -> TextureCache:
+    texture_cache = TextureCache(max_textures=max_textures)
+    texture_cache._load = load  # type: ignore[method-assign]
+    return texture_cache
+
+
+def drain(texture_cache: TextureCache) -> None:
+    # Reloads are submitted while the video is still pending
+    while texture_cache._pending:
+        sleep(0.001)
+    texture_cache._executor.shutdown()
+
+
+def test_requests_are_coalesced() -> None:
+    load = FakeLoad(dict(A1="texture A1"))
+    load.release.clear()
+    texture_cache = make_texture_cache(load)
+    received: list[object] = []
+    texture_cache.request("A1", received.append)
+    texture_cache.request("A1", received.append)
+    load.release.set()
+    drain(texture_cache)
+    assert load.video_ids == ["A1"]
+    assert received == ["texture A1", "texture A1"]
+    texture_cache.request("A1", received.append)
+    assert load.video_ids == ["A1"]
+    assert len(received) == 3
+
+
+def test_least_recently_used_textures_are_dropped() -> None:
+    load = FakeLoad(dict(A1="A1", A2="A2", A3="A3"))
+    texture_cache = make_texture_cache(load)
+    for video_id in ("A1", "A2", "A1", "A3"):
+        texture_cache.request(video_id, lambda texture: None)
+        texture_cache._executor.submit(lambda: None).result()
+    drain(texture_cache)
+    assert list(texture_cache._textures) == ["A1", "A3"]
+
+
+def test_missing_thumbnail_is_loaded_once_added() -> None:
+    load = FakeLoad({})
+    texture_cache = make_texture_cache(load)
+    thumbnails = Observable()
+    ThumbnailObserver(thumbnails, texture_cache)
+    received: list[object] = []
+    texture_cache.request("A1", received.append)
+    texture_cache._executor.submit(lambda: None).result()
+    # Waits for the thumbnail instead of loading it again
+    texture_cache.request("A1", received.append)
+    assert load.video_ids == ["A1"]
+    load.textures["A1"] = "texture A1"
+    thumbnails.notify_observers("A1")
+    drain(texture_cache)
+    assert load.video_ids == ["A1", "A1"]
+    assert received == ["texture A1", "texture A1"]
+
+
+def test_thumbnail_added_while_loading_is_reloaded() -> None:
+    load = FakeLoad({})
+    load.release.clear()
+    texture_cache = make_texture_cache(load)
+    received: list[object] = []
+    texture_cache.request("A1", received.append)
+    load.textures["A1"] = "texture A1"
+    texture_cache.invalidate("A1")
+    load.release.set()
+    drain(texture_cache)
+    assert load.video_ids == ["A1", "A1"]
+    assert received == ["texture A1"]
+
+
+def test_owner_waits_for_one_texture() -> None:
+    load = FakeLoad({})
+    texture_cache = make_texture_cache(load)
+    received: list[tuple[str, object]] = []
+    card = object()
+    for video_id in ("A1", "A2", "A1"):
+        texture_cache.request(
+            video_id,
+            lambda texture, video_id=video_id: received.append(
+                (video_id, texture)
+            ),
+            owner=card,
+        )
+        texture_cache._executor.submit(lambda: None).result()
+    while texture_cache._pending:
+        sleep(0.001)
+    assert texture_cache._missing.keys() == {"A1"}
+    assert len(texture_cache._missing["A1"]) == 1
+    load.textures.update(A1="texture A1", A2="texture A2")
+    texture_cache.invalidate("A1")
+    texture_cache.invalidate("A2")
+    drain(texture_cache)
+    assert received == [("A1", "texture A1")]
+    assert texture_cache._owner_video_ids == {}
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from sqlalchemy import create_engine, func, select, update
+
+from yrp.config import DatabaseConfig, ThumbnailCacheConfig
+from yrp.db import Base, Session, ThumbnailBlob, Video, set_pragmas
+from yrp.observer import Observable, Observer
+from yrp.thumbnails import ThumbnailCache
+
+
+def make_file(directory: Path, name: str, content: bytes) -> Path:
+    path = directory / name
+    path.write_bytes(content)
+    return path
+
+
+def make_cache(directory: Path, max_size_mb: float = 1) -> ThumbnailCache:
+    cache_config = ThumbnailCacheConfig(max_size_mb=max_size_mb)
+    return ThumbnailCache(directory, cache_config)
+
+
+def test_add_and_get(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    assert cache.get("A1") is None
+    path = cache.add("A1", make_file(tmp_path, "tmp", b"A1"))
+    assert cache.get("A1") == path
+    assert path.read_bytes() == b"A1"
+    assert "A1" in cache
+    assert not (tmp_path / "tmp").exists()
+
+
+def test_identical_thumbnails_are_stored_once(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    path_1 = cache.add("A1", make_file(tmp_path, "tmp", b"placeholder"))
+    path_2 = cache.add("A2", make_file(tmp_path, "tmp", b"placeholder"))
+    assert path_1 == path_2
+    cache.discard("A1")
+    assert cache.get("A1") is None
+    assert cache.get("A2") == path_2
+    cache.discard("A2")
+    assert not path_2.exists()
+
+
+class ChangeObserver(Observer):
+    def __init__(self, observable: Observable) -> None:
+        super().__init__(observable)
+        self.video_ids: list[str] = []
+
+    def notify(self, observable: Observable, video_id: str) -> None:
+        self.video_ids.append(video_id)
+
+
+def test_changes_are_notified(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    observer = ChangeObserver(cache)
+    cache.add("A1", make_file(tmp_path, "tmp", b"A1"))
+    cache.discard_many(["A1", "A2"])
+    assert observer.video_ids == ["A1", "A1", "A2"]
+
+
+def test_concurrent_identical_thumbnails(tmp_path: Path) -> None:
+    # The adding threads need to share the database
+    engine = create_engine(f"sqlite:///{tmp_path}/yrp.db")
+    set_pragmas(engine, DatabaseConfig())
+    Session.configure(bind=engine)
+    Base.metadata.create_all(engine)
+    cache_dir = tmp_path / "thumbnails"
+    cache_dir.mkdir()
+    cache = make_cache(cache_dir)
+    video_ids = [f"A{i}" for i in range(16)]
+    paths = [
+        make_file(tmp_path, f"tmp{video_id}", b"placeholder")
+        for video_id in video_ids
+    ]
+    with ThreadPoolExecutor(8) as executor:
+        blob_paths = set(executor.map(cache.add, video_ids, paths))
+    assert len(blob_paths) == 1
+    with Session() as session:
+        blob_count = session.scalar(
+            select(func.count()).select_from(ThumbnailBlob)
+        )
+    assert blob_count == 1
+    assert all(cache.get(video_id) in blob_paths for video_id in video_ids)
+
+
+def test_evict_least_recently_used(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path, max_size_mb=1.5)
+    megabyte = 2**20
+    old_path = cache.add("A1", make_file(tmp_path, "tmp", b"1" * megabyte))
+    new_path = cache.add("A2", make_file(tmp_path, "tmp", b"2" * megabyte))
+    with Session.begin() as session:
+        session.execute(
+            update(ThumbnailBlob)
+            .where(ThumbnailBlob.digest == old_path.stem)
+            .values(last_access=datetime.now() - timedelta(days=1))
+        )
+    cache.evict()
+    assert cache.get("A1") is None
+    assert not old_path.exists()
+    assert cache.get("A2") == new_path
+
+
+def test_retain(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    with Session.begin() as session:
+        session.add(Video(
+            id="A1",
+            title="A1",
+            publication_dt=datetime.now(),
+            channel_id="A",
+        ))
+    kept_path = cache.add("A1", make_file(tmp_path, "tmp", b"A1"))
+    dropped_path = cache.add("A2", make_file(tmp_path, "tmp", b"A2"))
+    cache.retain(select(Video.id))
+    assert cache.get("A1") == kept_path
+    assert cache.get("A2") is None
+    assert not dropped_path.exists()
+
+
+def test_adopt_loose_files(tmp_path: Path) -> None:
+    cache = make_cache(tmp_path)
+    make_file(tmp_path, "A1.jpg", b"A1")
+    make_file(tmp_path, "unknown.txt", b"")
+    cache.adopt_loose_files()
+    path = cache.get("A1")
+    assert path is not None
+    assert path.read_bytes() == b"A1"
+    assert sorted(p.name for p in tmp_path.iterdir()) == [path.parent.name]
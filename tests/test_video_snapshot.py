@@ -0,0 +1,95 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any
+
+from sqlalchemy import event
+
+from yrp.backend import create_video, get_videos, update_fields
+from yrp.config import DownloadConfig
+from yrp.db import Channel, Session, Thumbnail, ThumbnailBlob, Video
+from yrp.downloads import DownloadManager
+from yrp.thumbnails import thumbnail_cache
+
+
+def add_videos(count: int) -> None:
+    with Session.begin() as session:
+        for i in range(count):
+            channel = Channel(id=f"{i:024}", title=f"Channel {i}")
+            session.add(channel)
+            session.add(Video(
+                id=f"{i:011}",
+                title=f"Video {i}",
+                publication_dt=datetime.now(),
+                channel=channel,
+            ))
+
+
+@contextmanager
+def count_queries() -> Iterator[list[str]]:
+    statements: list[str] = []
+    engine = Session.kw["bind"]
+
+    def record(*args: Any) -> None:
+        statements.append(args[2])
+
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+
+
+def test_get_videos_single_query() -> None:
+    add_videos(5)
+    with count_queries() as statements:
+        videos = get_videos()
+        titles = {video.channel_title for video in videos}
+        assert not any(video.watched or video.downloading for video in videos)
+        assert not any(video.thumbnail_downloaded for video in videos)
+        assert {video.thumbnail_path for video in videos} == {None}
+    assert len(statements) == 1
+    assert titles == {f"Channel {i}" for i in range(5)}
+
+
+def test_snapshots_are_shared_and_follow_writes() -> None:
+    add_videos(1)
+    (video,) = get_videos()
+    assert create_video(video.id) is video
+    update_fields(video.id, downloading=True)
+    assert video.downloading
+    video.watched = True
+    assert video.watched
+    with Session() as session:
+        assert session.get_one(Video, video.id).watched
+
+
+def test_snapshots_include_thumbnails() -> None:
+    add_videos(2)
+    digest = "0" * 64
+    with Session.begin() as session:
+        session.add(ThumbnailBlob(
+            digest=digest,
+            size=1,
+            last_access=datetime.now(),
+        ))
+        session.add(Thumbnail(video_id=f"{0:011}", digest=digest))
+    with count_queries() as statements:
+        videos = {video.id: video for video in get_videos()}
+        thumbnail_paths = {
+            video_id: video.thumbnail_path
+            for video_id, video in videos.items()
+        }
+    assert len(statements) == 1
+    assert thumbnail_paths == {
+        f"{0:011}": thumbnail_cache.get_blob_path(digest).absolute(),
+        f"{1:011}": None,
+    }
+
+
+def test_recovered_downloads_update_snapshots() -> None:
+    add_videos(1)
+    (video,) = get_videos()
+    update_fields(video.id, downloading=True)
+    DownloadManager(DownloadConfig()).recover()
+    assert not video.downloading